@@ -1,21 +1,87 @@
 # app.py
 # -*- coding: utf-8 -*-
 
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify, stream_with_context, g
+from flask.json.provider import DefaultJSONProvider
+import os
 import html
+import time
+import sqlite3
+import threading
 import traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Optional, Tuple
 
 import lucene
 from search import (
     search_multi_granularity,
-    DOC_BY_ID,
-    split_sentences,
-    split_paragraphs,
-    get_query_terms,
+    search_many,
+    chapter_hits,
+    recall_chapters,
+    top_up_recall,
+    SEGMENTS,
+    LEVEL_PARAGRAPH,
+    LEVEL_SENTENCE,
+    HITS_PAGE_MAX,
+    init_search,
+    search_ready,
+    startup_status,
 )
-from llm import analyze_query, summarize_with_llm
+from evidence import select_evidence
+from llm import (
+    analyze_query,
+    summarize_with_llm,
+    summarize_with_llm_stream,
+    answer_cache_key,
+    answer_cache_version,
+    ANALYSIS_CACHE,
+    ANSWER_CACHE,
+)
+from cache import index_signature, normalize_query
+import search
+import metrics
+import wire
+from metrics import span, bind_context
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """jsonify / request.get_json 走 wire（有 orjson 时用 orjson），响应体直接是 UTF-8 字节"""
+
+    def dumps(self, obj, **kwargs) -> str:
+        return wire.dumps(obj).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return wire.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(wire.dumps(obj), mimetype=self.mimetype)
+
 
 app = Flask(__name__)
+app.json = FastJSONProvider(app)
+
+# 并发配置（环境变量，每个 worker 进程各自一份）：
+#   SEARCH_THREADS：跑 Lucene 的线程数。线程创建时 attach JVM 一次，之后一直复用
+#   BATCH_SEARCH_THREADS：/api/search/batch 专用的 Lucene 线程数，和交互请求分开，
+#                         批量任务再多也只占这几个线程
+#   MAX_INFLIGHT：同时处理的 /api 请求上限，超出的请求排队
+#   QUEUE_TIMEOUT：排队超过这么多秒返回 503
+SEARCH_THREADS = int(os.environ.get("SEARCH_THREADS", os.cpu_count() or 4))
+BATCH_SEARCH_THREADS = int(os.environ.get("BATCH_SEARCH_THREADS", max(1, SEARCH_THREADS // 4)))
+MAX_INFLIGHT = int(os.environ.get("MAX_INFLIGHT", "32"))
+QUEUE_TIMEOUT = float(os.environ.get("QUEUE_TIMEOUT", "10"))
+
+# 顶部“命中片段”最多展示多少句
+TOP_SNIPPET_LIMIT = 10
+
+# /api/search/batch：一次最多多少条查询；带 LLM 阶段时同时处理几条
+BATCH_MAX_QUERIES = int(os.environ.get("BATCH_MAX_QUERIES", "10000"))
+BATCH_LLM_CONCURRENCY = int(os.environ.get("BATCH_LLM_CONCURRENCY", "4"))
+BATCH_MODES = ("ir", "analyze", "answer")
+
+# /api/chapter/<doc_id>/text 的浏览器缓存时间（秒），语料变化时 ETag 随之变化
+TEXT_MAX_AGE = int(os.environ.get("TEXT_MAX_AGE", "86400"))
 
 
 def ensure_jvm_attached():
@@ -31,179 +97,155 @@ def ensure_jvm_attached():
         env.attachCurrentThread()
 
 
-def bracket_to_mark(text: str) -> str:
-    """
-    把 search.py 中用 [term] 包裹的高亮，转换为 HTML <mark>term</mark>；
-    同时先做 HTML escape，防止 XSS。
-    """
-    escaped = html.escape(text)
-    return escaped.replace("[", "<mark>").replace("]", "</mark>")
+# 所有 Lucene 调用（预召回、多粒度检索）都交给这个线程池：
+# 请求线程（Flask / gunicorn 的线程）本身不碰 JVM，也就不用每个请求都 attach
+LUCENE_POOL = ThreadPoolExecutor(max_workers=SEARCH_THREADS, thread_name_prefix="lucene",
+                                 initializer=ensure_jvm_attached)
+INFLIGHT = threading.BoundedSemaphore(MAX_INFLIGHT)
+# 批量接口的 Lucene 调用只进 BATCH_LUCENE_POOL，不和交互请求抢 LUCENE_POOL；
+# 带 LLM 的查询在 BATCH_POOL 里跑（run_search 再把 Lucene 部分交给 BATCH_LUCENE_POOL）
+BATCH_LUCENE_POOL = ThreadPoolExecutor(max_workers=BATCH_SEARCH_THREADS, thread_name_prefix="lucene-batch",
+                                       initializer=ensure_jvm_attached)
+BATCH_POOL = ThreadPoolExecutor(max_workers=BATCH_LLM_CONCURRENCY, thread_name_prefix="batch")
 
-def select_snippet_sentence(query: str, analysis: dict, res: dict,
-                            max_chapters: int = 5) -> str:
-    """
-    针对 snippet / 原文引用类查询：
-      - 在若干章节中按“句子级”精确定位该句话；
-      - 优先整串匹配，其次按关键词密度挑句；
-      - 返回该句前后各一句作为上下文。
-    """
-    raw_query = (query or "").strip()
-    keywords = analysis.get("keywords") or []
-    sq = (analysis.get("search_query") or raw_query).strip()
-    query_terms = keywords or get_query_terms(sq)
-
-    chapters = res.get("chapters") or []
-    if not chapters:
-        return ""
-
-    best_ctx = ""
-    best_score = 0.0
-
-    for ch in chapters[:max_chapters]:
-        doc_id = str(ch.get("doc_id"))
-        raw_content = DOC_BY_ID.get(doc_id, {}).get("content", "") or ""
-        if not raw_content:
-            continue
+# 请求带上这个头（任意非空值）时，JSON 响应里附带 timings（各阶段毫秒数）
+DEBUG_TIMINGS_HEADER = "X-Debug-Timings"
 
-        sents = split_sentences(raw_content)
-
-        # 1) 优先整串匹配：句子里直接包含整句 query
-        if raw_query and len(raw_query) >= 4:
-            for i, s in enumerate(sents):
-                if raw_query in s:
-                    start = max(0, i - 1)
-                    end = min(len(sents), i + 2)
-                    return "".join(sents[start:end]).strip()
-
-        # 2) 否则按关键词密度挑选句子
-        for i, s in enumerate(sents):
-            score = 0.0
-            for t in query_terms:
-                if t and t in s:
-                    score += len(t)
-            if score > best_score:
-                best_score = score
-                start = max(0, i - 1)
-                end = min(len(sents), i + 2)
-                best_ctx = "".join(sents[start:end]).strip()
-
-    return best_ctx
-
-def build_brief_context(query: str, analysis: dict, res: dict,
-                        max_chapters: int = 5,
-                        max_sents: int = 6,
-                        max_chars: int = 2000) -> str:
-    """
-    为 LLM 构造“精简上下文”：
-      - 从若干章节中选出最相关的少量句子，而不是整段大段原文；
-      - 控制总句数和总字符数，避免噪声和干扰。
-    """
-    keywords = analysis.get("keywords") or []
-    sq = (analysis.get("search_query") or query).strip()
-    query_terms = keywords or get_query_terms(sq)
-
-    chapters = res.get("chapters") or []
-    context_sents = []
-    used_chars = 0
-
-    for ch in chapters[:max_chapters]:
-        doc_id = str(ch.get("doc_id"))
-        book = ch.get("book", "")
-        chapter_title = ch.get("chapter", "")
-        raw_content = DOC_BY_ID.get(doc_id, {}).get("content", "") or ""
-        if not raw_content:
-            continue
 
-        sents = split_sentences(raw_content)
-        # 对本章每个句子打分，选出得分最高的 1~2 句
-        scores = []
-        for i, s in enumerate(sents):
-            score = 0.0
-            for t in query_terms:
-                if t and t in s:
-                    score += len(t)
-            if score > 0:
-                scores.append((score, i, s))
-
-        if not scores:
-            continue
+def _collect_cache_metrics():
+    return (metrics.cache_families("result", search.RESULT_CACHE.stats())
+            + metrics.cache_families("query_tokens", search.QUERY_TOKENS.stats())
+            + metrics.cache_families("analysis", ANALYSIS_CACHE.stats())
+            + metrics.cache_families("answer", ANSWER_CACHE.stats()))
 
-        scores.sort(key=lambda x: x[0], reverse=True)
-        top_local = scores[:2]  # 每章最多取两句
 
-        for _, i, s in top_local:
-            snippet = f"[{book}·{chapter_title}] {s}"
-            if used_chars + len(snippet) > max_chars:
-                return "\n".join(context_sents)
-            context_sents.append(snippet)
-            used_chars += len(snippet)
+# JVM 统计单独一个 attach 过的线程：不排在 LUCENE_POOL 的检索后面，负载高时也抓得到
+METRICS_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="jvm-metrics",
+                                  initializer=ensure_jvm_attached)
 
-            if len(context_sents) >= max_sents:
-                return "\n".join(context_sents)
 
-    return "\n".join(context_sents)
+def _collect_jvm_metrics():
+    """JVM 统计要在 attach 过的线程里取；搜索还没就绪（JVM 可能没启动）时跳过"""
+    if not search_ready():
+        return []
+    return METRICS_POOL.submit(metrics.jvm_families).result(timeout=2.0)
 
 
+metrics.register_collector(_collect_cache_metrics)
+metrics.register_collector(_collect_jvm_metrics)
 
-def select_snippet(query: str, analysis: dict, res: dict,
-                   max_chapters: int = 3) -> str:
-    """
-    针对 snippet / ask_original_text 场景，从检索结果中截取最相关的原文片段。
 
-    策略：
-      1) 在前 max_chapters 个章节里，按“句子”切分；
-      2) 如果整串 query 出现在某句中，返回该句前后各 1 句；
-      3) 否则按关键词打分，选出得分最高的那句，返回前后各 1 句。
+def start_background_init() -> threading.Thread:
     """
-    raw_query = (query or "").strip()
-    keywords = analysis.get("keywords") or []
-    sq = (analysis.get("search_query") or raw_query).strip()
-    query_terms = keywords or get_query_terms(sq)
-
-    chapters = res.get("chapters") or []
-    if not chapters:
-        return ""
-
-    # 1) 尝试整串匹配（适合“前进，前进，不择手段的前进”这种）
-    if raw_query and len(raw_query) >= 4:  # 太短的就不做整串匹配
-        for ch in chapters[:max_chapters]:
-            doc_id = str(ch.get("doc_id"))
-            raw_content = DOC_BY_ID.get(doc_id, {}).get("content", "") or ""
-            if not raw_content:
-                continue
-            sents = split_sentences(raw_content)
-            for i, s in enumerate(sents):
-                if raw_query in s:
-                    start = max(0, i - 1)
-                    end = min(len(sents), i + 2)
-                    return "".join(sents[start:end]).strip()
-
-    # 2) 按关键词打分选句
-    best_sent = ""
-    best_score = 0.0
-    best_context = ""
-
-    for ch in chapters[:max_chapters]:
-        doc_id = str(ch.get("doc_id"))
-        raw_content = DOC_BY_ID.get(doc_id, {}).get("content", "") or ""
-        if not raw_content:
-            continue
+    在后台线程里初始化搜索（词典 → 语料 → JVM + 索引 → 预热），
+    Flask 先监听端口；就绪前 /readyz 返回 503，/api/* 也直接返回 503
+    """
+    def _run():
+        try:
+            init_search()
+        except Exception:
+            traceback.print_exc()
+
+    t = threading.Thread(target=_run, name="search-init", daemon=True)
+    t.start()
+    return t
 
-        sents = split_sentences(raw_content)
-        for i, s in enumerate(sents):
-            score = 0.0
-            for t in query_terms:
-                if t and t in s:
-                    score += len(t)
-            if score > best_score:
-                best_score = score
-                best_sent = s
-                start = max(0, i - 1)
-                end = min(len(sents), i + 2)
-                best_context = "".join(sents[start:end]).strip()
 
-    return best_context or best_sent
+def speculative_recall(query: str):
+    """在 Lucene 线程池里跑：原始 query 一定是 search_query 的一部分，可以先召回"""
+    return recall_chapters(query, phrase=query)
+
+
+def bracket_to_mark(text: str) -> str:
+    """
+    把 search.py 中用 [term] 包裹的高亮，转换为 HTML <mark>term</mark>；
+    同时先做 HTML escape，防止 XSS。
+    """
+    escaped = html.escape(text)
+    return escaped.replace("[", "<mark>").replace("]", "</mark>")
+
 
+@app.before_request
+def reject_until_ready():
+    if not request.path.startswith("/api/"):
+        return None
+    if not search_ready():
+        status = startup_status()
+        return jsonify({"error": "服务正在启动，请稍后重试", "stage": status["stage"]}), 503
+    # 并发上限：流式响应要等整个流结束（teardown_request）才释放
+    if not INFLIGHT.acquire(timeout=QUEUE_TIMEOUT):
+        return jsonify({"error": "服务繁忙，请稍后重试"}), 503
+    g.inflight = True
+    g.started = time.perf_counter()
+    g.timings = metrics.start_request()
+    return None
+
+
+@app.after_request
+def count_request(response):
+    if "started" in g:
+        metrics.REQUESTS_TOTAL.inc(endpoint=request.endpoint or "", status=response.status_code)
+    return response
+
+
+@app.after_request
+def compress_response(response):
+    """按 Accept-Encoding 压缩非流式响应（br 优先，其次 gzip）；SSE 等流式响应原样发送"""
+    if response.direct_passthrough or response.is_streamed or response.status_code != 200 \
+            or "Content-Encoding" in response.headers:
+        return response
+    body = response.get_data()
+    if not wire.compressible(response.mimetype, len(body)):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = wire.negotiate(request.headers.get("Accept-Encoding", ""))
+    if encoding is None:
+        return response
+    response.set_data(wire.compress(body, encoding))
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+@app.teardown_request
+def release_inflight(exc=None):
+    started = g.pop("started", None)
+    if started is not None:
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=request.endpoint or "")
+        metrics.bind_request(None)
+    if g.pop("inflight", False):
+        INFLIGHT.release()
+
+
+def want_timings() -> bool:
+    return bool(request.headers.get(DEBUG_TIMINGS_HEADER))
+
+
+def want_compact() -> bool:
+    """请求 JSON 里 "format": "compact"（或 ?format=compact）时返回紧凑格式的检索结果"""
+    fmt = request.args.get("format")
+    if fmt is None:
+        data = request.get_json(force=True, silent=True)
+        fmt = data.get("format") if isinstance(data, dict) else None
+    return fmt == "compact"
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """Prometheus 抓取：阶段耗时直方图、请求数、缓存命中率、JVM 堆 / GC"""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/healthz")
+def healthz():
+    """进程存活即可"""
+    return jsonify({"status": "ok"})
+
+
+@app.route("/readyz")
+def readyz():
+    """预热完成才返回 200，负载均衡据此决定是否转发流量"""
+    status = startup_status()
+    return jsonify(status), (200 if status["ready"] else 503)
 
 
 @app.route("/")
@@ -212,21 +254,91 @@ def index():
     return render_template("search.html")
 
 
-@app.route("/api/search", methods=["POST"])
-def api_search():
-    # 1. 解析请求 JSON
+def parse_search_request():
+    """解析请求 JSON，返回 (query, 错误响应)"""
     try:
         data = request.get_json(force=True)
     except Exception as e:
-        return jsonify({"error": f"请求体不是合法 JSON: {e}"}), 400
+        return None, (jsonify({"error": f"请求体不是合法 JSON: {e}"}), 400)
 
     query = (data.get("query") or "").strip()
     if not query:
-        return jsonify({"error": "query is empty"}), 400
+        return None, (jsonify({"error": "query is empty"}), 400)
+    return query, None
+
+
+def frontend_results(res: dict, compact: bool = False) -> Tuple[list, list]:
+    """
+    检索结果 → (章节列表, 顶部“命中片段”)。
+    默认格式带高亮好的 HTML：
+      章节 {"doc_id", "book", "chapter", "score", "paragraph_total", "next_cursor",
+            "paragraphs": [{"index", "html"}, ...]}
+      片段 {"doc_id", "book", "chapter", "index", "html"}
+    紧凑格式（compact）不带原文，只有序号和高亮区间，前端按 /api/chapter/<doc_id>/text
+    取章节原文（可长期缓存）后自己加 <mark>：
+      章节的 "paragraphs": [[段落序号, [[start, end], ...]], ...]
+      片段 [doc_id, 句子序号, [[start, end], ...]]（书名、章节名从章节列表里查）
+    """
+    chapters = []
+    top_snippets = []   # 用句子填
+
+    for ch in res.get("chapters", []):
+        hit_paras = ch.get("hit_paragraphs") or []
+        hit_sents = ch.get("hit_sentences") or []
+        if not hit_paras and not hit_sents:
+            continue
+
+        ch_obj = {
+            "doc_id": ch.get("doc_id"),
+            "book": ch.get("book"),
+            "chapter": ch.get("chapter"),
+            "score": ch.get("score"),
+            # 首屏只带前几段；next_cursor 非空时前端可用 /api/chapter/<doc_id>/hits 继续展开
+            "paragraph_total": ch.get("paragraph_total", len(hit_paras)),
+            "next_cursor": ch.get("paragraph_cursor"),
+        }
+
+        # 章节视图用的段落
+        if compact:
+            ch_obj["paragraphs"] = [[p["index"], p["spans"]] for p in hit_paras]
+        else:
+            ch_obj["paragraphs"] = [{"index": p["index"], "html": bracket_to_mark(p["text"])}
+                                    for p in hit_paras]
+
+        # 顶部“命中片段”用：按句子级别添加，够数就不再转换
+        for s in hit_sents:
+            if len(top_snippets) >= TOP_SNIPPET_LIMIT:
+                break
+            if compact:
+                top_snippets.append([ch.get("doc_id"), s["index"], s["spans"]])
+            else:
+                top_snippets.append({
+                    "doc_id": ch.get("doc_id"),
+                    "book": ch.get("book"),
+                    "chapter": ch.get("chapter"),
+                    "index": s["index"],   # 句子索引
+                    "html": bracket_to_mark(s["text"]),
+                })
+
+        chapters.append(ch_obj)
+
+    return chapters, top_snippets
 
-    # 2. 先让 LLM 理解查询
+
+def run_search(query: str, compact: bool = False, pool: ThreadPoolExecutor = None) -> dict:
+    """
+    检索阶段（不含回答生成）：
+      LLM 理解查询（同时预召回） → Lucene 多粒度检索 → 整理前端结果 → 截取原文片段
+    返回的 dict 里既有给前端的字段，也有构造 prompt 要用的中间结果。
+    compact：前端结果用紧凑格式（见 frontend_results）
+    pool：跑 Lucene 的线程池，默认 LUCENE_POOL；批量接口传 BATCH_LUCENE_POOL
+    """
+    pool = pool or LUCENE_POOL
+    # 2. 让 LLM 理解查询；同时在后台用原始 query 预召回章节
+    spec_future = pool.submit(bind_context(speculative_recall), query)
     try:
-        analysis = analyze_query(query)
+        with span("analyze"):
+            analysis = analyze_query(query)
     except Exception as e:
         traceback.print_exc()
         analysis = {
@@ -256,143 +368,434 @@ def api_search():
     print("[SEARCH_QUERY]", search_query)
 
     # 3. 用 search_query 做 Lucene 检索，必要时回退到原始 query
-    def run_ir(q_,s_q):
-        ensure_jvm_attached()
+    #    预召回的结果直接复用：search_query 只比原始 query 多出 LLM 的词，补查这部分即可
+    try:
+        spec_recall = spec_future.result()
+    except Exception:
+        traceback.print_exc()
+        spec_recall = None
+
+    def run_ir(q_, s_q, recall=None):
         if query_type == "snippet":
-            return search_multi_granularity(q_, top_k_chapters=10, ir_query= s_q, snippet_mode=True)
-        else:    
-            return search_multi_granularity(s_q)
+            if recall is not None:
+                recall = top_up_recall(recall, s_q, phrase=q_)
+            return search_multi_granularity(q_, top_k_chapters=10, ir_query=s_q, snippet_mode=True,
+                                            recall=recall)
+        else:
+            if recall is not None:
+                recall = top_up_recall(recall, s_q, phrase=s_q)
+            return search_multi_granularity(s_q, recall=recall)
 
-    res = run_ir(query, search_query)
+    res = pool.submit(bind_context(run_ir), query, search_query, spec_recall).result()
 
     # 如果改写后的检索一个段落都没有命中，则回退用原始 query 再搜一遍
     if not any(ch.get("hit_paragraphs") for ch in res.get("chapters", [])) and search_query.strip() != query.strip():
-        res = run_ir(query,search_query)
+        res = pool.submit(bind_context(run_ir), query, query, spec_recall).result()
 
-    # 4. 构造给前端的章节列表 & 给 LLM 的段落列表
-    chapters_for_frontend = []
-    paragraphs_for_llm = []
-    top_paragraphs = []   # ★ 新增：用来给前端展示“命中段落”
+    # 4. 构造给前端的章节列表 & 顶部“命中片段”
+    chapters_for_frontend, top_snippets = frontend_results(res, compact)
 
-    chapters_for_frontend = []
-    paragraphs_for_llm = []
-    top_snippets = []   # ★ 新名字，用句子填
-    
-    for ch in res.get("chapters", []):
-        hit_paras = ch.get("hit_paragraphs") or []
-        hit_sents = ch.get("hit_sentences") or []
-        if not hit_paras and not hit_sents:
-            continue
-        
-        ch_obj = {
-            "doc_id": ch.get("doc_id"),
-            "book": ch.get("book"),
-            "chapter": ch.get("chapter"),
-            "score": ch.get("score"),
-            "paragraphs": [],
-        }
-    
-        # 章节视图用的段落（保持不变）
-        for p in hit_paras:
-            html_para = bracket_to_mark(p["text"])
-            ch_obj["paragraphs"].append({
-                "index": p["index"],
-                "html": html_para,
-            })
-            paragraphs_for_llm.append({
-                "book": ch.get("book"),
-                "chapter": ch.get("chapter"),
-                "text": p["text"],
-            })
-    
-        # 顶部“命中片段”用：按句子级别添加
-        for s in hit_sents:
-            html_sent = bracket_to_mark(s["text"])
-            top_snippets.append({
-                "doc_id": ch.get("doc_id"),
-                "book": ch.get("book"),
-                "chapter": ch.get("chapter"),
-                "index": s["index"],   # 句子索引
-                "html": html_sent,
-            })
-    
-        chapters_for_frontend.append(ch_obj)
-    
-    # 限制片段数量（比如最多 10 句）
-    TOP_SNIPPET_LIMIT = 10
-    top_snippets = top_snippets[:TOP_SNIPPET_LIMIT]
-    
-    # 5. 是否需要截取一个“原文片段”（snippet）
-    exact_snippet = ""
-    if need_original or query_type == "snippet":
-        exact_snippet = select_snippet_sentence(query, analysis, res)
+    # 5. 原文证据：直接用检索已打过分的命中句，原文片段（要原文时）和精简上下文一遍得到
+    with span("context"):
+        evidence = select_evidence(query, res, SEGMENTS, search.QUOTES,
+                                   want_snippet=need_original or query_type == "snippet")
+
+    return {
+        "query": query,
+        "search_query": search_query,
+        "analysis": analysis,
+        "query_type": query_type,
+        "intent": intent,
+        "need_original": need_original,
+        "res": res,
+        "chapters": chapters_for_frontend,
+        "top_snippets": top_snippets,
+        # 展开更多段落时原样带回，保证翻页和首屏用同一套匹配
+        "hits_query": {"q": res.get("query", query), "snippet": bool(res.get("snippet_mode"))},
+        "compact": compact,
+        "exact_snippet": evidence.snippet,
+        "brief_context": evidence.context,
+    }
+
+
+# 回答 prompt 模板：{query} 为用户问题，{evidence} 为喂给模型的原文（截取的片段或精简上下文）。
+# 模板原文也是回答缓存 key 的一部分，改了模板旧缓存自然失效
+ORIGINAL_TEXT_PROMPT = (
+    "用户问题：{query}\n\n"
+    "下面是小说《三体》中与问题最相关的原文句子及上下文：\n"
+    "{evidence}\n\n"
+    "请严格根据这段原文回答问题。"
+    "如果问题是“内容是什么/有哪些”，请从原文中直接提取对应内容，"
+    "不要添加原文中没有提到的新内容。"
+)
+NO_ORIGINAL_TEXT_PROMPT = (
+    "用户问题：{query}\n\n"
+    "由于没有截取到清晰的原文片段，请尽量根据你对《三体》三部曲的理解回答。"
+)
+STORY_PROMPT = (
+    "用户问题：{query}\n\n"
+    "下面是小说《三体》中和该问题最相关的一些原文句子：\n"
+    "{evidence}\n\n"
+    "请综合这些原文片段，尽量给出一个完整、连贯的回答。"
+    "你可以结合你对《三体》三部曲整体剧情的理解做合理补充，"
+    "但不要与这些原文片段的事实明显矛盾。"
+    "如果某个细节在原文中完全没有体现，可以语气委婉地说明这一点，"
+    "但不要频繁强调“原文不足以回答”，而是尽量把能回答的部分说清楚。"
+)
+CONCEPT_PROMPT = (
+    "用户问题：{query}\n\n"
+    "下面是小说《三体》中和该问题相关的部分原文句子：\n"
+    "{evidence}\n\n"
+    "请优先参考这些原文句子，对概念或问题做出解释。"
+    "对于抽象概念，你可以适度结合你对《三体》的理解；"
+    "但对于具体人物/情节，请以原文为准，不要与原文矛盾。"
+)
+
+
+def answer_template_and_evidence(ctx: dict) -> Tuple[str, str]:
+    """按场景选 prompt 模板，并给出喂给模型的原文证据"""
+    if ctx["need_original"] or ctx["query_type"] == "snippet":
+        # —— 4 / 6 / 7：要原文的场景 —— #
+        if ctx["exact_snippet"]:
+            return ORIGINAL_TEXT_PROMPT, ctx["exact_snippet"]
+        return NO_ORIGINAL_TEXT_PROMPT, ""
+
+    context = ctx["brief_context"]
+    if ctx["intent"] in ("ask_character_profile", "ask_story_detail"):
+        # —— 2 / 5：人物生平 / 情节类（维德这种），严格只看上下文 —— #
+        return STORY_PROMPT, context
+    # —— 1 / 3 以及其它：概念解释为主，可以结合一点先验知识 —— #
+    return CONCEPT_PROMPT, context
+
+
+def build_answer_prompt(ctx: dict) -> Tuple[str, str]:
+    """根据检索阶段的结果，为右侧回答构造 prompt；返回 (prompt, 回答缓存 key)"""
+    template, evidence = answer_template_and_evidence(ctx)
+    prompt = template.format(query=ctx["query"], evidence=evidence)
+    return prompt, answer_cache_key(template, ctx["query"], evidence)
+
+
+def current_answer_version() -> str:
+    """回答缓存的版本：回答 prompt / 模型 + 当前索引提交点，任何一个变了旧回答都不再命中"""
+    return answer_cache_version(index_signature(search.INDEX_DIR))
 
-    # 6. 调用 LLM 生成右侧回答
-    summary = ""
-    llm_error = ""
 
+def lookup_answer(key: str, version: str) -> Optional[str]:
     try:
-        if need_original or query_type == "snippet":
-            # —— 4 / 6 / 7：要原文的场景 —— #
-            if exact_snippet:
-                prompt = (
-                    f"用户问题：{query}\n\n"
-                    f"下面是小说《三体》中与问题最相关的原文句子及上下文：\n"
-                    f"{exact_snippet}\n\n"
-                    "请严格根据这段原文回答问题。"
-                    "如果问题是“内容是什么/有哪些”，请从原文中直接提取对应内容，"
-                    "不要添加原文中没有提到的新内容。"
-                )
-            else:
-                prompt = (
-                    f"用户问题：{query}\n\n"
-                    "由于没有截取到清晰的原文片段，请尽量根据你对《三体》三部曲的理解回答。"
-                )
-
-        elif intent in ("ask_character_profile", "ask_story_detail"):
-            # —— 2 / 5：人物生平 / 情节类（维德这种），严格只看上下文 —— #
-            context = build_brief_context(query, analysis, res)
-            prompt = (
-                f"用户问题：{query}\n\n"
-                "下面是小说《三体》中和该问题最相关的一些原文句子：\n"
-                f"{context}\n\n"
-                "请综合这些原文片段，尽量给出一个完整、连贯的回答。"
-                "你可以结合你对《三体》三部曲整体剧情的理解做合理补充，"
-                "但不要与这些原文片段的事实明显矛盾。"
-                "如果某个细节在原文中完全没有体现，可以语气委婉地说明这一点，"
-                "但不要频繁强调“原文不足以回答”，而是尽量把能回答的部分说清楚。"
-            )
+        return ANSWER_CACHE.get(key, version=version)
+    except sqlite3.Error as e:
+        print("[answer-cache] 读取失败:", e)
+        return None
 
-        else:
-            # —— 1 / 3 以及其它：概念解释为主，可以结合一点先验知识 —— #
-            context = build_brief_context(query, analysis, res)
-            prompt = (
-                f"用户问题：{query}\n\n"
-                "下面是小说《三体》中和该问题相关的部分原文句子：\n"
-                f"{context}\n\n"
-                "请优先参考这些原文句子，对概念或问题做出解释。"
-                "对于抽象概念，你可以适度结合你对《三体》的理解；"
-                "但对于具体人物/情节，请以原文为准，不要与原文矛盾。"
-            )
-
-        summary = summarize_with_llm(prompt)
+
+def store_answer(key: str, version: str, answer: str):
+    if not answer:
+        return
+    try:
+        ANSWER_CACHE.put(key, answer, version=version)
+    except sqlite3.Error as e:
+        print("[answer-cache] 写入失败:", e)
+
+
+def search_payload(ctx: dict) -> dict:
+    """检索阶段给前端的字段（不含回答）"""
+    payload = {
+        "query": ctx["query"],
+        "search_query": ctx["search_query"],
+        "analysis": ctx["analysis"],           # 方便调试
+        "chapters": ctx["chapters"],
+        "top_snippets": ctx["top_snippets"],
+        "hits_query": ctx["hits_query"],
+        "exact_answer": ctx["exact_snippet"],  # 原文片段（前端可以展示“原文摘录”）
+    }
+    if ctx["compact"]:
+        # 前端按这个版本号缓存章节原文，语料一变旧缓存就不再用
+        payload["format"] = "compact"
+        payload["text_version"] = SEGMENTS.source_hash
+    return payload
+
+
+def generate_answer(ctx: dict) -> Tuple[str, str]:
+    """非流式回答（先查回答缓存），返回 (回答, 错误信息)"""
+    summary = ""
+    llm_error = ""
+    try:
+        with span("context"):
+            prompt, key = build_answer_prompt(ctx)
+            version = current_answer_version()
+        with span("answer"):
+            summary = lookup_answer(key, version)
+            if summary is None:
+                summary = summarize_with_llm(prompt)
+                store_answer(key, version, summary)
     except Exception as e:
         traceback.print_exc()
         llm_error = f"LLM 调用失败: {e}"
+    return summary, llm_error
 
-    return jsonify({
-        "query": query,
-        "search_query": search_query,
-        "analysis": analysis,           # 方便调试
-        "chapters": chapters_for_frontend,
-        "top_snippets": top_snippets,   # ★ 新名字
+
+@app.route("/api/search", methods=["POST"])
+def api_search():
+    # 1. 解析请求 JSON
+    query, err = parse_search_request()
+    if err:
+        return err
+
+    ctx = run_search(query, compact=want_compact())
+
+    # 6. 调用 LLM 生成右侧回答
+    summary, llm_error = generate_answer(ctx)
+
+    payload = search_payload(ctx)
+    payload.update({
         "summary": summary,
-        "exact_answer": exact_snippet,  # 原文片段（前端可以展示“原文摘录”）
         "llm_error": llm_error,
     })
+    if want_timings():
+        payload["timings"] = g.timings.as_dict()
+    return jsonify(payload)
 
 
-if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
+@app.route("/api/chapter/<doc_id>/hits")
+def api_chapter_hits(doc_id):
+    """
+    某一章更多的命中段落 / 句子（前端“展开更多”）：
+      GET ?q=...&snippet=0|1&level=paragraph|sentence&cursor=N&limit=M
+    q / snippet 取首屏结果里的 hits_query，cursor 取章节的 next_cursor；
+    返回 {"doc_id", "items": [{"index", "html"}], "next_cursor", "total"}
+    """
+    q = (request.args.get("q") or "").strip()
+    if not q:
+        return jsonify({"error": "q is empty"}), 400
+    level = request.args.get("level", LEVEL_PARAGRAPH)
+    if level not in (LEVEL_PARAGRAPH, LEVEL_SENTENCE):
+        return jsonify({"error": f"unknown level: {level}"}), 400
+    if doc_id not in SEGMENTS:
+        return jsonify({"error": f"unknown chapter: {doc_id}"}), 404
+    try:
+        cursor = max(0, int(request.args.get("cursor", 0)))
+        limit = min(max(1, int(request.args.get("limit", 10))), HITS_PAGE_MAX)
+    except ValueError:
+        return jsonify({"error": "cursor / limit must be integers"}), 400
+    snippet = request.args.get("snippet", "0") not in ("", "0", "false")
+
+    page = LUCENE_POOL.submit(bind_context(chapter_hits), q, doc_id, level,
+                              snippet, cursor, limit).result()
+    return jsonify({
+        "doc_id": doc_id,
+        "items": [{"index": it["index"], "html": bracket_to_mark(it["text"])} for it in page["items"]],
+        "next_cursor": page["next_cursor"],
+        "total": page["total"],
+    })
 
 
+@app.route("/api/chapter/<doc_id>/text")
+def api_chapter_text(doc_id):
+    """
+    整章原文按段落或句子切好（紧凑格式的前端据此自己加高亮）：
+      GET ?level=paragraph|sentence → {"doc_id", "level", "version", "units": [...]}
+    语料不变内容就不变：ETag 取语料版本，浏览器可以长期缓存
+    """
+    level = request.args.get("level", LEVEL_PARAGRAPH)
+    if level not in (LEVEL_PARAGRAPH, LEVEL_SENTENCE):
+        return jsonify({"error": f"unknown level: {level}"}), 400
+    if doc_id not in SEGMENTS:
+        return jsonify({"error": f"unknown chapter: {doc_id}"}), 404
+
+    version = SEGMENTS.source_hash
+    etag = f"{version}-{doc_id}-{level}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        units = SEGMENTS.paragraphs(doc_id) if level == LEVEL_PARAGRAPH else SEGMENTS.sentences(doc_id)
+        response = jsonify({"doc_id": doc_id, "level": level, "version": version, "units": units})
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = TEXT_MAX_AGE
+    return response
+
+
+def batch_llm_results(queries: list, mode: str, compact: bool):
+    """
+    带 LLM 阶段的批量检索：相同查询只跑一次，BATCH_POOL 里并发，
+    同时在途的不超过并发数的两倍；按完成顺序 yield (下标列表, 结果 dict)
+    """
+    groups = {}
+    for i, q in enumerate(queries):
+        groups.setdefault(normalize_query(q), []).append(i)
+
+    def one(q):
+        ctx = run_search(q, compact=compact, pool=BATCH_LUCENE_POOL)
+        payload = search_payload(ctx)
+        if mode == "answer":
+            payload["summary"], payload["llm_error"] = generate_answer(ctx)
+        return payload
+
+    run = bind_context(one)
+    todo = iter(groups.values())
+    pending = {}
+    window = BATCH_LLM_CONCURRENCY * 2
+    try:
+        while True:
+            for indices in todo:
+                pending[BATCH_POOL.submit(run, queries[indices[0]])] = indices
+                if len(pending) >= window:
+                    break
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                yield pending.pop(fut), fut.result()
+    finally:
+        for fut in pending:
+            fut.cancel()
+
+
+@app.route("/api/search/batch", methods=["POST"])
+def api_search_batch():
+    """
+    批量检索（离线分析、评测用），结果以 NDJSON 流式返回，每条输入查询一行：
+      请求 {"queries": [...], "mode": "ir" | "analyze" | "answer", "top_k": 10,
+            "snippet": false, "format": "compact"}
+        - ir（默认）：只做 Lucene 多粒度检索（search.search_many），不调用 LLM；
+                     top_k / snippet 对应 search_multi_granularity 的参数
+        - analyze：和 /api/search 一样先分析查询再检索，不生成回答
+        - answer：再加上回答（summary / llm_error）
+      每行 {"index": 在 queries 里的下标, "query": ..., "chapters": ..., "top_snippets": ..., ...}，
+      按完成顺序输出；出错时最后一行为 {"error": ...}
+    """
+    try:
+        data = request.get_json(force=True)
+    except Exception as e:
+        return jsonify({"error": f"请求体不是合法 JSON: {e}"}), 400
+    queries = data.get("queries") if isinstance(data, dict) else None
+    if not isinstance(queries, list) or not all(isinstance(q, str) for q in queries):
+        return jsonify({"error": "queries must be a list of strings"}), 400
+    if len(queries) > BATCH_MAX_QUERIES:
+        return jsonify({"error": f"too many queries (max {BATCH_MAX_QUERIES})"}), 400
+    mode = data.get("mode", "ir")
+    if mode not in BATCH_MODES:
+        return jsonify({"error": f"unknown mode: {mode}"}), 400
+    try:
+        top_k = max(1, int(data.get("top_k", 10)))
+    except (TypeError, ValueError):
+        return jsonify({"error": "top_k must be an integer"}), 400
+    snippet = bool(data.get("snippet"))
+    compact = data.get("format") == "compact"
+    queries = [q.strip() for q in queries]
+    timings = g.timings
+
+    def line(obj: dict) -> bytes:
+        return wire.dumps(obj) + b"\n"
+
+    def generate():
+        metrics.bind_request(timings)
+        # 空查询直接报错，不参与检索
+        for i, q in enumerate(queries):
+            if not q:
+                yield line({"index": i, "query": q, "error": "query is empty"})
+        valid = [q for q in queries if q]
+        positions = [i for i, q in enumerate(queries) if q]
+        try:
+            if mode == "ir":
+                results = search_many(valid, top_k_chapters=top_k, snippet_mode=snippet,
+                                      executor=BATCH_LUCENE_POOL, threads=BATCH_SEARCH_THREADS)
+            else:
+                results = batch_llm_results(valid, mode, compact)
+            for indices, res in results:
+                if mode == "ir":
+                    chapters, top_snippets = frontend_results(res, compact)
+                    payload = {"chapters": chapters, "top_snippets": top_snippets}
+                    if compact:
+                        payload.update({"format": "compact", "text_version": SEGMENTS.source_hash})
+                else:
+                    payload = res
+                for j in indices:
+                    yield line({"index": positions[j], "query": valid[j], **payload})
+        except Exception as e:
+            traceback.print_exc()
+            yield line({"error": f"批量检索失败: {e}"})
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson",
+                    headers={"X-Accel-Buffering": "no"})
+
+
+def sse_event(event: str, data: dict) -> str:
+    """一条 Server-Sent Event"""
+    return f"event: {event}\ndata: {wire.dumps(data).decode('utf-8')}\n\n"
+
+
+@app.route("/api/search/stream", methods=["POST"])
+def api_search_stream():
+    """
+    流式版本（text/event-stream）：
+      - event: results  检索结果（chapters / top_snippets / exact_answer），检索完立刻推送；
+                        请求带 "format": "compact" 时为紧凑格式（见 frontend_results）
+      - event: token    模型生成的增量文本 {"text": ...}
+      - event: done     回答结束 {"summary": 完整回答, "llm_error": ...}；
+                        检索本身失败时不推 results，直接 done，并带 "error"
+    """
+    query, err = parse_search_request()
+    if err:
+        return err
+    timings = g.timings
+    with_timings = want_timings()
+    compact = want_compact()
+
+    def generate():
+        # 生成器在响应阶段才执行，重新绑定到本请求的计时
+        metrics.bind_request(timings)
+        pieces = []
+        llm_error = ""
+        search_error = ""
+        try:
+            ctx = run_search(query, compact=compact)
+        except Exception as e:
+            traceback.print_exc()
+            ctx = None
+            search_error = f"检索失败: {e}"
+
+        if ctx is not None:
+            yield sse_event("results", search_payload(ctx))
+            try:
+                with span("context"):
+                    prompt, key = build_answer_prompt(ctx)
+                    version = current_answer_version()
+                with span("answer"):
+                    cached = lookup_answer(key, version)
+                if cached is not None:
+                    # 命中缓存：整段作为一个 token 事件推送，事件序列不变
+                    pieces.append(cached)
+                    yield sse_event("token", {"text": cached})
+                else:
+                    # 只计从模型取下一段的时间，不含等客户端读走（yield）的时间
+                    stream = summarize_with_llm_stream(prompt)
+                    while True:
+                        with span("answer"):
+                            piece = next(stream, None)
+                        if piece is None:
+                            break
+                        pieces.append(piece)
+                        yield sse_event("token", {"text": piece})
+                    store_answer(key, version, "".join(pieces).strip())
+            except Exception as e:
+                traceback.print_exc()
+                llm_error = f"LLM 调用失败: {e}"
+
+        done = {"summary": "".join(pieces).strip(), "llm_error": llm_error}
+        if search_error:
+            done["error"] = search_error
+        if with_timings:
+            done["timings"] = timings.as_dict()
+        yield sse_event("done", done)
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(stream_with_context(generate()), mimetype="text/event-stream", headers=headers)
+
+
+if __name__ == "__main__":
+    debug = True
+    # debug 模式下 reloader 的监控进程不需要加载搜索
+    if not debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_background_init()
+    app.run(host="0.0.0.0", port=5000, debug=debug)
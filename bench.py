@@ -0,0 +1,365 @@
+# bench.py
+# -*- coding: utf-8 -*-
+"""
+bench.py
+
+按查询日志回放请求，压测 /api/search：
+
+- 查询日志：JSONL（取 query 字段）或每行一条查询，格式同 python llm.py warm；
+  没有日志时用 search.DEFAULT_WARMUP_QUERIES
+- 负载：--concurrency N 为闭环（N 个并发客户端，一个返回再发下一个），
+        --rate R 为开环（平均每秒 R 个请求，泊松到达）
+- 默认进程内运行：启动本地 LLM 桩服务（llm_stub.py，延迟可配），在本进程里加载 app，
+  用 Flask test client 发请求，完全离线
+- --url 时压一个已经在跑的服务
+- 两种模式都带 X-Debug-Timings 头，从响应的 timings 里取分阶段耗时（见 metrics.py）：
+    analyze   查询分析（analyze_query）
+    tokenize  分词
+    lucene    Lucene 检索（章节召回 + 段落/句子查询）
+    rerank    召回合并与重新排序
+    scan      多粒度整理（段落/句子匹配、高亮）
+    context   原文片段 / 上下文 / prompt 构造
+    answer    回答生成（summarize_with_llm）
+- 进程内模式默认关掉结果缓存（search.RESULT_CACHE）和回答缓存（llm.ANSWER_CACHE），
+  查询日志很短、反复回放时测到的才是真的检索和回答；--keep-caches 保留它们。
+  结果里附带压测期间各缓存的命中率（--url 模式从服务的 /metrics 取，多 worker 时只是其中一个）
+
+示例：
+  python bench.py --log query_log.jsonl --concurrency 8 --requests 200 --llm-latency 0.3
+  python bench.py --rate 5 --duration 60
+  python bench.py --url http://127.0.0.1:5000 --concurrency 16
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional
+
+STAGES = ["analyze", "tokenize", "lucene", "rerank", "scan", "context", "answer"]
+DEBUG_HEADERS = {"X-Debug-Timings": "1"}
+
+
+# ========= 1. 统计 =========
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """最近秩百分位数；sorted_values 需已排序"""
+    if not sorted_values:
+        return 0.0
+    k = math.ceil(p / 100.0 * len(sorted_values)) - 1
+    return sorted_values[max(0, min(len(sorted_values) - 1, k))]
+
+
+class Recorder:
+    """收集端到端耗时、各阶段耗时、状态码（多线程写入）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies: List[float] = []
+        self.stages: Dict[str, List[float]] = defaultdict(list)
+        self.statuses: Counter = Counter()
+
+    def request(self, seconds: float, status):
+        with self._lock:
+            self.latencies.append(seconds)
+            self.statuses[status] += 1
+
+    def stage_timings(self, timings: Optional[dict]):
+        """响应里的 timings：{stage: 毫秒}"""
+        if not timings:
+            return
+        with self._lock:
+            for name, ms in timings.items():
+                if name in STAGES:
+                    self.stages[name].append(ms / 1000.0)
+
+    def summary(self, wall: float) -> dict:
+        def dist(values):
+            v = sorted(values)
+            return {"count": len(v),
+                    "mean_ms": 1000 * sum(v) / len(v) if v else 0.0,
+                    "p50_ms": 1000 * percentile(v, 50),
+                    "p95_ms": 1000 * percentile(v, 95),
+                    "p99_ms": 1000 * percentile(v, 99)}
+
+        with self._lock:
+            return {
+                "requests": len(self.latencies),
+                "wall_s": wall,
+                "throughput_rps": len(self.latencies) / wall if wall > 0 else 0.0,
+                "status": {str(k): v for k, v in self.statuses.items()},
+                "latency": dist(self.latencies),
+                "stages": {name: dist(self.stages[name]) for name in STAGES if self.stages.get(name)},
+            }
+
+
+CACHE_NAMES = ("result", "analysis", "answer")
+
+
+def cache_counts_in_process() -> Dict[str, tuple]:
+    """本进程里各缓存的 (hits, misses)"""
+    import search
+    import llm
+    caches = {"result": search.RESULT_CACHE, "analysis": llm.ANALYSIS_CACHE, "answer": llm.ANSWER_CACHE}
+    return {name: (c.hits, c.misses) for name, c in caches.items()}
+
+
+def cache_counts_http(url: str, timeout: float) -> Dict[str, tuple]:
+    """从 /metrics 里读 threebody_cache_hits_total / misses_total；取不到时返回空"""
+    counts = defaultdict(lambda: [0, 0])
+    try:
+        with urllib.request.urlopen(url.rstrip("/") + "/metrics", timeout=timeout) as resp:
+            text = resp.read().decode("utf-8")
+    except Exception:
+        return {}
+    for line in text.splitlines():
+        for k, metric in enumerate(("threebody_cache_hits_total", "threebody_cache_misses_total")):
+            prefix = metric + '{cache="'
+            if line.startswith(prefix):
+                name, _, value = line[len(prefix):].partition('"} ')
+                counts[name][k] = float(value)
+    return {name: tuple(v) for name, v in counts.items() if name in CACHE_NAMES}
+
+
+def cache_ratios(before: Dict[str, tuple], after: Dict[str, tuple]) -> Dict[str, dict]:
+    """压测期间（after - before）各缓存的命中次数和命中率"""
+    out = {}
+    for name, (hits, misses) in after.items():
+        h0, m0 = before.get(name, (0, 0))
+        hits, misses = hits - h0, misses - m0
+        total = hits + misses
+        out[name] = {"hits": hits, "misses": misses, "hit_rate": hits / total if total else 0.0}
+    return out
+
+
+def print_summary(s: dict):
+    print(f"\n请求数 {s['requests']}，用时 {s['wall_s']:.1f}s，吞吐 {s['throughput_rps']:.2f} req/s")
+    print("状态码:", ", ".join(f"{k}×{v}" for k, v in sorted(s["status"].items())))
+    rows = [("end-to-end", s["latency"])] + list(s["stages"].items())
+    print(f"\n{'stage':<12}{'count':>8}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}  (ms)")
+    for name, d in rows:
+        print(f"{name:<12}{d['count']:>8}{d['mean_ms']:>10.1f}{d['p50_ms']:>10.1f}"
+              f"{d['p95_ms']:>10.1f}{d['p99_ms']:>10.1f}")
+    if s.get("caches"):
+        print("\n缓存命中率（压测期间）:", ", ".join(
+            f"{name} {c['hit_rate']:.1%}（{c['hits']:.0f}/{c['hits'] + c['misses']:.0f}）"
+            for name, c in s["caches"].items()))
+
+
+# ========= 2. 发请求 =========
+
+def in_process_sender(recorder: Recorder) -> Callable[[str], None]:
+    import app
+
+    local = threading.local()
+
+    def send(query: str):
+        client = getattr(local, "client", None)
+        if client is None:
+            client = local.client = app.app.test_client()
+        t0 = time.perf_counter()
+        resp = client.post("/api/search", json={"query": query}, headers=DEBUG_HEADERS)
+        data = resp.get_json(silent=True) or {}
+        recorder.request(time.perf_counter() - t0, resp.status_code)
+        recorder.stage_timings(data.get("timings"))
+
+    return send
+
+
+def http_sender(url: str, recorder: Recorder, timeout: float) -> Callable[[str], None]:
+    endpoint = url.rstrip("/") + "/api/search"
+
+    def send(query: str):
+        body = json.dumps({"query": query}, ensure_ascii=False).encode("utf-8")
+        req = urllib.request.Request(endpoint, data=body, method="POST",
+                                     headers={"Content-Type": "application/json", **DEBUG_HEADERS})
+        t0 = time.perf_counter()
+        timings = None
+        try:
+            with urllib.request.urlopen(req, timeout=timeout) as resp:
+                raw = resp.read()
+                status = resp.status
+            try:
+                timings = json.loads(raw).get("timings")
+            except ValueError:
+                pass
+        except urllib.error.HTTPError as e:
+            status = e.code
+        except Exception as e:
+            status = type(e).__name__
+        recorder.request(time.perf_counter() - t0, status)
+        recorder.stage_timings(timings)
+
+    return send
+
+
+# ========= 3. 负载模式 =========
+
+def query_stream(queries: List[str], shuffle: bool, seed: int) -> Iterator[str]:
+    rng = random.Random(seed)
+    while True:
+        order = list(queries)
+        if shuffle:
+            rng.shuffle(order)
+        yield from order
+
+
+def run_closed_loop(send, queries: Iterator[str], concurrency: int,
+                    n_requests: int, duration: float):
+    """N 个客户端各自循环：发一个、等返回、再发下一个"""
+    lock = threading.Lock()
+    state = {"left": n_requests}
+    deadline = time.monotonic() + duration if duration > 0 else None
+
+    def next_query() -> Optional[str]:
+        with lock:
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            if n_requests > 0:
+                if state["left"] <= 0:
+                    return None
+                state["left"] -= 1
+            return next(queries)
+
+    def client_loop():
+        while True:
+            q = next_query()
+            if q is None:
+                return
+            send(q)
+
+    threads = [threading.Thread(target=client_loop, daemon=True) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def run_open_loop(send, queries: Iterator[str], rate: float,
+                  n_requests: int, duration: float, max_outstanding: int, seed: int):
+    """按泊松到达发请求，不等前一个返回（服务变慢时请求会堆积，更接近线上）"""
+    rng = random.Random(seed)
+    deadline = time.monotonic() + duration if duration > 0 else None
+    sent = 0
+    with ThreadPoolExecutor(max_workers=max_outstanding) as pool:
+        next_at = time.monotonic()
+        while True:
+            if n_requests > 0 and sent >= n_requests:
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            now = time.monotonic()
+            if next_at > now:
+                time.sleep(next_at - now)
+            pool.submit(send, next(queries))
+            sent += 1
+            next_at += rng.expovariate(rate)
+
+
+# ========= 4. 入口 =========
+
+def load_queries(path: Optional[str]) -> List[str]:
+    if path and os.path.exists(path):
+        from llm import iter_log_queries
+        queries = list(iter_log_queries(path))
+        if queries:
+            return queries
+        print(f"[bench] {path} 里没有查询，改用默认查询")
+    from search import DEFAULT_WARMUP_QUERIES
+    return list(DEFAULT_WARMUP_QUERIES)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="按查询日志回放请求，压测 /api/search")
+    parser.add_argument("--log", default="query_log.jsonl", help="查询日志（JSONL 的 query 字段，或每行一条）")
+    parser.add_argument("--concurrency", type=int, default=4, help="闭环并发客户端数")
+    parser.add_argument("--rate", type=float, default=0.0, help="开环到达率（req/s），> 0 时忽略 --concurrency")
+    parser.add_argument("--max-outstanding", type=int, default=256, help="开环模式最多同时在途的请求数")
+    parser.add_argument("--requests", type=int, default=100, help="总请求数（0 = 只按 --duration）")
+    parser.add_argument("--duration", type=float, default=0.0, help="最长压测秒数（0 = 不限）")
+    parser.add_argument("--shuffle", action="store_true", help="打乱查询顺序")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--url", default="", help="压测已在运行的服务")
+    parser.add_argument("--timeout", type=float, default=120.0, help="--url 模式的请求超时")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="LLM 桩服务每次请求的延迟（秒）")
+    parser.add_argument("--llm-jitter", type=float, default=0.1, help="LLM 桩服务延迟抖动（秒）")
+    parser.add_argument("--llm-token-delay", type=float, default=0.02, help="LLM 桩服务流式每块延迟（秒）")
+    parser.add_argument("--warm-analysis-cache", action="store_true",
+                        help="使用现有的 llm_cache.sqlite3（默认用一个空的临时缓存，每个查询都真的走分析）")
+    parser.add_argument("--keep-caches", action="store_true",
+                        help="进程内模式保留结果缓存和回答缓存（默认压测期间关掉，每个请求都真的检索、生成回答）")
+    parser.add_argument("--no-warmup", action="store_true", help="进程内模式跳过搜索预热")
+    parser.add_argument("--json", default="", help="把汇总结果另存为 JSON")
+    args = parser.parse_args(argv)
+    if args.requests <= 0 and args.duration <= 0:
+        parser.error("--requests 和 --duration 至少指定一个")
+
+    recorder = Recorder()
+    stub = None
+
+    if args.url:
+        send = http_sender(args.url, recorder, args.timeout)
+
+        def count_caches():
+            return cache_counts_http(args.url, args.timeout)
+
+        if not args.keep_caches:
+            print("[bench] --url 模式关不掉服务端缓存，命中率见结果")
+    else:
+        # 必须在 import llm / app 之前设置好环境变量
+        from llm_stub import StubLLMServer
+        stub = StubLLMServer(latency=args.llm_latency, jitter=args.llm_jitter,
+                             token_delay=args.llm_token_delay).start()
+        os.environ["LLM_BASE_URL"] = stub.base_url
+        os.environ.setdefault("LLM_API_KEY", "stub.key")
+        if not args.warm_analysis_cache:
+            os.environ["LLM_CACHE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="bench-"), "llm_cache.sqlite3")
+        print(f"[bench] LLM 桩服务 {stub.base_url}（延迟 {args.llm_latency}s ± {args.llm_jitter}s）")
+
+        import search
+        t0 = time.perf_counter()
+        search.init_search(warmup=not args.no_warmup)
+        print(f"[bench] 搜索初始化 {time.perf_counter() - t0:.1f}s")
+        send = in_process_sender(recorder)
+        count_caches = cache_counts_in_process
+        if not args.keep_caches:
+            import llm
+            search.RESULT_CACHE.enabled = False
+            llm.ANSWER_CACHE.enabled = False
+            print("[bench] 已关闭结果缓存和回答缓存（--keep-caches 保留）")
+
+    queries = load_queries(args.log)
+    print(f"[bench] {len(queries)} 条查询，"
+          + (f"开环 {args.rate} req/s" if args.rate > 0 else f"闭环并发 {args.concurrency}"))
+    stream = query_stream(queries, args.shuffle, args.seed)
+
+    caches_before = count_caches()
+    t0 = time.perf_counter()
+    if args.rate > 0:
+        run_open_loop(send, stream, args.rate, args.requests, args.duration,
+                      args.max_outstanding, args.seed)
+    else:
+        run_closed_loop(send, stream, args.concurrency, args.requests, args.duration)
+    summary = recorder.summary(time.perf_counter() - t0)
+    summary["caches"] = cache_ratios(caches_before, count_caches())
+
+    print_summary(summary)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+    if stub is not None:
+        stub.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,29 +4,27 @@
 
 import os
 import json
+import time
 import re
+import argparse
 from collections import defaultdict
-import jieba
+
+from segments import ChapterSegments
+from manifest import load_manifest, save_manifest, chapter_hashes, diff_chapters, dict_hash
+from tokens import init_jieba, tokenize, tokenize_many, TokenCache
+from corpus import ensure_corpus, CORPUS_PATH
+from quotes import ensure_quote_index, QUOTES_PATH
+from unit_matrix import ensure_unit_matrix, UNITS_PATH
 
 #1.分词
 
 USER_DICT_PATH = "vocab.txt"
-if os.path.exists(USER_DICT_PATH):
-    print(f"加载三体自定义词表: {USER_DICT_PATH}")
-    with open(USER_DICT_PATH, "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            w = line.split()[0]   # 只要第一个字段
-            jieba.add_word(w)
-else:
-    print(f"未找到三体词表 {USER_DICT_PATH}，跳过自定义词加载")
+
 
 def jieba_tokenizer(text: str):
-    # 和 search.py 保持一致，只做 strip，不再额外正则清洗
-    from search import tokenize_query
-    return tokenize_query(text).split()
+    # 和 search.py 同源：都走 tokens.tokenize，只去掉空白词，不再额外正则清洗
+    init_jieba(USER_DICT_PATH)
+    return tokenize(text)
 
 
 def simple_tokenizer(text: str):
@@ -40,85 +38,271 @@ def get_tokenizer():
 
 
 # 2. PyLucene 初始化 & 建索引
+#
+# JVM 等分词结束后才启动（init_lucene）：分词进程池的子进程不需要 JVM，
+# 也不应该从一个已经跑着 JVM 的父进程 fork 出来
 
 HAS_LUCENE = False
 try:
     import lucene
+    HAS_LUCENE = True
+except Exception as e:
+    print("未能使用 PyLucene，原因：", e)
+    HAS_LUCENE = False
 
+
+def init_lucene() -> bool:
+    """启动 JVM 并导入建索引用到的 Lucene 类；失败时返回 False"""
+    global HAS_LUCENE, Paths, FSDirectory, WhitespaceAnalyzer, IndexWriter, IndexWriterConfig, Term
+    global Document, StringField, TextField, StoredField, Field, NumericDocValuesField
     try:
-        env = lucene.getVMEnv()
-    except Exception:
-        env = None
-    if env is None:
-        lucene.initVM(vmargs=["-Djava.awt.headless=true"])
+        try:
+            env = lucene.getVMEnv()
+        except Exception:
+            env = None
+        if env is None:
+            lucene.initVM(vmargs=["-Djava.awt.headless=true"])
 
-    print("PyLucene OK, version =", lucene.VERSION)
+        print("PyLucene OK, version =", lucene.VERSION)
 
-    from java.nio.file import Paths
-    from org.apache.lucene.store import FSDirectory
-    from org.apache.lucene.analysis.core import WhitespaceAnalyzer
-    from org.apache.lucene.index import IndexWriter, IndexWriterConfig
-    from org.apache.lucene.document import Document, StringField, TextField, StoredField, Field
+        from java.nio.file import Paths
+        from org.apache.lucene.store import FSDirectory
+        from org.apache.lucene.analysis.core import WhitespaceAnalyzer
+        from org.apache.lucene.index import IndexWriter, IndexWriterConfig, Term
+        from org.apache.lucene.document import (
+            Document, StringField, TextField, StoredField, Field, NumericDocValuesField,
+        )
+    except Exception as e:
+        print("未能使用 PyLucene，原因：", e)
+        HAS_LUCENE = False
+    return HAS_LUCENE
 
-    HAS_LUCENE = True
-except Exception as e:
-    print("未能使用 PyLucene，原因：", e)
-    HAS_LUCENE = False
 
+# 文档粒度：章节 / 段落 / 句子，写在 level 字段里
+LEVEL_CHAPTER = "chapter"
+LEVEL_PARAGRAPH = "paragraph"
+LEVEL_SENTENCE = "sentence"
+
+# 段落、句子用单独的字段，避免影响章节级 content 的词频统计
+UNIT_FIELD = "unit_content"
+
+# 数值 DocValues：search.py 打开索引时一次性读出，建 docnum → 章节/序号 的内存表，
+# 检索时不再逐条取 stored fields
+CHAPTER_DV = "chapter_num"   # 所属章节 id（章节级 Document 就是自己的 id）
+ORDINAL_DV = "ordinal_num"   # 段落/句子在章节内的序号（章节级 Document 为 -1）
+
+
+def chapter_num(doc_id: str) -> int:
+    """threebody.json 的 id 是从 1 开始的整数"""
+    return int(doc_id)
+
+
+def make_unit_doc(level: str, doc_id: str, book: str, chapter: str,
+                  ordinal: int, seg: str) -> "Document":
+    """
+    段落/句子级 Document：
+    - level / doc_id / book / chapter 用 StringField
+    - ordinal 是该单元在章节内的序号（与 segments.py 的切分一致）
+    - seg 是空格拼接的分词结果，只索引不存储，原文由 search.py 按偏移量取
+    """
+    doc = Document()
+    doc.add(StringField("level",   level,   Field.Store.YES))
+    doc.add(StringField("doc_id",  doc_id,  Field.Store.YES))
+    doc.add(StringField("book",    book,    Field.Store.YES))
+    doc.add(StringField("chapter", chapter, Field.Store.YES))
+    doc.add(StoredField("ordinal", ordinal))
+    doc.add(NumericDocValuesField(CHAPTER_DV, chapter_num(doc_id)))
+    doc.add(NumericDocValuesField(ORDINAL_DV, ordinal))
+    doc.add(TextField(UNIT_FIELD, seg, Field.Store.NO))
+    return doc
+
+
+def make_chapter_doc(doc_id: str, book: str, chapter: str, seg: str) -> "Document":
+    """章节级 Document：content 只索引分词结果 seg；原文在 threebody.corpus 里，不存进 Lucene"""
+    doc = Document()
+
+    # 基本字段：可存储、可查询
+    doc.add(StringField("level",   LEVEL_CHAPTER, Field.Store.YES))
+    doc.add(StringField("id",      doc_id,  Field.Store.YES))
+    doc.add(StringField("book",    book,    Field.Store.YES))
+    doc.add(StringField("chapter", chapter, Field.Store.YES))
+    doc.add(NumericDocValuesField(CHAPTER_DV, chapter_num(doc_id)))
+    doc.add(NumericDocValuesField(ORDINAL_DV, -1))
+
+    # 章节标题：也可以作为 TextField，便于搜索
+    if chapter:
+        doc.add(TextField("chapter_text", chapter, Field.Store.YES))
+
+    # 内容分词后用空格拼接，配合 WhitespaceAnalyzer
+    # 注意：这里不再做额外正则清洗，和 search.py 完全同源
+    doc.add(TextField("content", seg, Field.Store.NO))   # 索引分词结果，不存储
+    return doc
+
+
+class ChapterTokens:
+    """一章切分好的段落/句子，以及章节、每段、每句的分词结果（空格拼接）"""
+
+    __slots__ = ("units", "content", "paragraphs", "sentences")
+
+    def __init__(self, units: ChapterSegments, content: str,
+                 paragraphs: list, sentences: list):
+        self.units = units
+        self.content = content
+        self.paragraphs = paragraphs
+        self.sentences = sentences
+
+
+def tokenize_chapters(docs: list, digest: str, workers: int = None,
+                      cache: TokenCache = None) -> dict:
+    """
+    把这些章节的全文、段落、句子一次性交给 tokenize_many：
+    命中落盘缓存的直接取，其余在进程池里并行分词。
+    返回 doc_id → ChapterTokens
+    """
+    texts = []
+    layout = []
+    for d in docs:
+        content = d.get("content", "") or ""
+        units = ChapterSegments(content)
+        paras = units.paragraphs()
+        sents = units.sentences()
+        layout.append((str(d.get("id")), units, len(paras), len(sents)))
+        texts.append(content)
+        texts.extend(paras)
+        texts.extend(sents)
+
+    segs = [" ".join(t) for t in tokenize_many(texts, user_dict=USER_DICT_PATH, cache=cache,
+                                                dict_hash=digest, workers=workers)]
+
+    out = {}
+    pos = 0
+    for doc_id, units, n_para, n_sent in layout:
+        content = segs[pos]
+        paragraphs = segs[pos + 1:pos + 1 + n_para]
+        sentences = segs[pos + 1 + n_para:pos + 1 + n_para + n_sent]
+        pos += 1 + n_para + n_sent
+        out[doc_id] = ChapterTokens(units, content, paragraphs, sentences)
+    return out
+
+
+def index_chapter(writer, d: dict, toks: ChapterTokens, replace: bool):
+    """
+    写入一章：章节级 Document + 段落级、句子级 Document。
+    replace=True 时先删掉该章旧的段落/句子，章节级 Document 用 updateDocument 原地替换。
+    """
+    doc_id = str(d.get("id"))
+    book = d.get("book", "") or ""
+    chapter = d.get("chapter", "") or ""
+
+    chapter_doc = make_chapter_doc(doc_id, book, chapter, toks.content)
+    if replace:
+        writer.deleteDocuments(Term("doc_id", doc_id))
+        writer.updateDocument(Term("id", doc_id), chapter_doc)
+    else:
+        writer.addDocument(chapter_doc)
+
+    # 段落级 & 句子级 Document
+    for j, seg in enumerate(toks.paragraphs):
+        writer.addDocument(make_unit_doc(LEVEL_PARAGRAPH, doc_id, book, chapter, j, seg))
+    for j, seg in enumerate(toks.sentences):
+        writer.addDocument(make_unit_doc(LEVEL_SENTENCE, doc_id, book, chapter, j, seg))
 
-def create_lucene_index(json_path: str, index_dir: str = "index"):
+
+def create_lucene_index(json_path: str, index_dir: str = "index", full: bool = False,
+                        workers: int = None, use_token_cache: bool = True):
     """
     用 PyLucene + jieba 构建索引：
     - 对 content 字段做 jieba 分词，然后用 WhitespaceAnalyzer 建索引
     - id / book / chapter 使用 StringField 存储，content 用 TextField
+    - 每章再按 segments.py 的规则切出段落、句子，各自写成一条 Document（level 区分）
+
+    增量构建：index/manifest.json 记录上次提交时的词典哈希和每章内容哈希。
+    - 词典（vocab.txt）变了、没有清单、或 full=True：OpenMode.CREATE 全量重建
+    - 否则只对哈希变化的章节重新切分、分词并 updateDocument，删掉已不存在的章节
+    清单在 writer.commit() 之后才写，构建中途失败下次会重做这些章节。
+
+    分词：先把要写的章节（连同段落、句子）全部分好词再启动 JVM 建索引，
+    分词在进程池里并行（workers 个进程，默认 CPU 核数），结果落盘到 token_cache.sqlite3，
+    按 (词典哈希, 文本哈希) 复用。
     """
     with open(json_path, "r", encoding="utf-8") as f:
         docs = json.load(f)
 
     print(f"[Lucene] 读取到 {len(docs)} 条文档")
 
-    directory = FSDirectory.open(Paths.get(index_dir))
-    analyzer = WhitespaceAnalyzer()
-    config = IndexWriterConfig(analyzer)
-    config.setOpenMode(IndexWriterConfig.OpenMode.CREATE)
-    writer = IndexWriter(directory, config)
-
-    tokenizer = get_tokenizer()
-  
-
     for i, d in enumerate(docs):
-        doc = Document()
-        doc_id = str(d.get("id", i))
-        book = d.get("book", "") or ""
-        chapter = d.get("chapter", "") or ""
-        content = d.get("content", "") or ""
-
-        # 基本字段：可存储、可查询
-        doc.add(StringField("id",      doc_id,  Field.Store.YES))
-        doc.add(StringField("book",    book,    Field.Store.YES))
-        doc.add(StringField("chapter", chapter, Field.Store.YES))
+        d.setdefault("id", i)
 
-        # 章节标题：也可以作为 TextField，便于搜索
-        if chapter:
-            doc.add(TextField("chapter_text", chapter, Field.Store.YES))
+    new_hashes = chapter_hashes(docs)
+    digest = dict_hash(USER_DICT_PATH)
+    manifest = load_manifest(index_dir)
 
-        # 内容分词后用空格拼接，配合 WhitespaceAnalyzer
-        tokens = tokenizer(content)
-        seg = " ".join(tokens)
-        # 注意：这里不再做额外正则清洗，和 search.py 完全同源
-        doc.add(TextField("content", seg, Field.Store.NO))   # 索引分词结果，不存储
-        doc.add(StoredField("raw_content", content))         # 存储原文
+    rebuild = full or manifest is None or manifest.get("dict_hash") != digest
+    if rebuild:
+        reason = "指定 --full" if full else ("没有清单" if manifest is None else "词典有变化")
+        print(f"[Lucene] 全量重建（{reason}）")
+        changed, removed = list(new_hashes), []
+    else:
+        changed, removed = diff_chapters(manifest["chapters"], new_hashes)
+        if not changed and not removed:
+            ensure_corpus(json_path, CORPUS_PATH, docs)
+            ensure_quote_index(CORPUS_PATH, QUOTES_PATH)
+            ensure_unit_matrix(CORPUS_PATH, UNITS_PATH, user_dict=USER_DICT_PATH,
+                               cache=TokenCache() if use_token_cache else None, workers=workers)
+            print(f"[Lucene] 索引已是最新，无需更新，目录: {index_dir}")
+            return
+        print(f"[Lucene] 增量更新：{len(changed)} 章有变化，{len(removed)} 章已删除")
+
+    changed_set = set(changed)
+    todo = [d for d in docs if str(d.get("id")) in changed_set]
+    cache = TokenCache() if use_token_cache else None
+    t0 = time.perf_counter()
+    tokens_by_id = tokenize_chapters(todo, digest, workers=workers, cache=cache)
+    print(f"[jieba] 分词完成：{len(todo)} 章，用时 {time.perf_counter() - t0:.1f}s")
+
+    if not init_lucene():
+        print("PyLucene 不可用，跳过索引构建")
+        return
 
-        writer.addDocument(doc)
-        if (i + 1) % 10 == 0:
-            print(f"[Lucene] 已索引 {i+1} 条文档")
+    directory = FSDirectory.open(Paths.get(index_dir))
+    analyzer = WhitespaceAnalyzer()
+    config = IndexWriterConfig(analyzer)
+    config.setOpenMode(IndexWriterConfig.OpenMode.CREATE if rebuild
+                       else IndexWriterConfig.OpenMode.CREATE_OR_APPEND)
+    writer = IndexWriter(directory, config)
 
-    writer.commit()
-    writer.close()
-    print(f"[Lucene] 索引构建完成，目录: {index_dir}")
+    try:
+        for doc_id in removed:
+            writer.deleteDocuments(Term("id", doc_id))
+            writer.deleteDocuments(Term("doc_id", doc_id))
+
+        n_done = 0
+        for d in todo:
+            index_chapter(writer, d, tokens_by_id[str(d.get("id"))], replace=not rebuild)
+            n_done += 1
+            if n_done % 10 == 0:
+                print(f"[Lucene] 已索引 {n_done} 条文档")
+
+        # 语料文件、引用索引和出现矩阵要先于索引提交：search.py 看到新的提交时会一并重新打开它们
+        ensure_corpus(json_path, CORPUS_PATH, docs)
+        ensure_quote_index(CORPUS_PATH, QUOTES_PATH)
+        # 章节全文刚在 tokenize_chapters 里分过（或在缓存里）；JVM 已启动，不再开进程池
+        ensure_unit_matrix(CORPUS_PATH, UNITS_PATH, user_dict=USER_DICT_PATH, cache=cache, workers=1)
+        writer.commit()
+    finally:
+        writer.close()
+
+    save_manifest(index_dir, digest, new_hashes)
+    print(f"[Lucene] 索引构建完成（{n_done} 章），目录: {index_dir}")
 
 
 def main():
+    parser = argparse.ArgumentParser(description="构建 / 增量更新三体 Lucene 索引")
+    parser.add_argument("--full", action="store_true", help="忽略清单，全量重建")
+    parser.add_argument("--workers", type=int, default=None, help="分词进程数（默认 CPU 核数）")
+    parser.add_argument("--no-token-cache", action="store_true", help="不读写分词缓存")
+    args = parser.parse_args()
+
     json_path = "threebody.json"   # 输入：72 条合并后的三体三部曲章节
     index_dir = "index"            # Lucene 索引目录（与 search.py 相同）
 
@@ -128,7 +312,8 @@ def main():
 
     if HAS_LUCENE:
         print("使用 PyLucene + jieba 构建 Lucene 索引")
-        create_lucene_index(json_path, index_dir)
+        create_lucene_index(json_path, index_dir, full=args.full,
+                            workers=args.workers, use_token_cache=not args.no_token_cache)
     else:
         print("PyLucene 不可用，跳过索引构建")
 
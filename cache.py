@@ -0,0 +1,323 @@
+# cache.py
+# -*- coding: utf-8 -*-
+"""
+cache.py
+
+进程内结果缓存：
+
+- normalize_query：全角/半角统一（NFKC）、压缩空白，作为缓存 key 的一部分
+- LRUCache：按条数 + 估算内存双重上限的 LRU，带 TTL，统计命中/未命中
+- index_signature：索引目录的当前提交点，用来在重建索引后自动作废缓存
+- SQLiteCache：落盘的 key/value 缓存（多进程共享、重启不丢），用于 LLM 结果
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+
+# ========= 1. 查询归一化 =========
+
+def normalize_query(text: Optional[str]) -> str:
+    """全角转半角（NFKC）、去掉首尾空白、内部连续空白压成一个空格"""
+    if not text:
+        return ""
+    text = unicodedata.normalize("NFKC", text)
+    return " ".join(text.split())
+
+
+# ========= 2. 索引版本 =========
+
+def index_signature(index_dir: str) -> tuple:
+    """
+    Lucene 每次 commit 都会写新的 segments_N，
+    用 (文件名, mtime) 作为索引版本；目录不存在时返回空元组
+    """
+    try:
+        names = [n for n in os.listdir(index_dir) if n.startswith("segments_")]
+    except OSError:
+        return ()
+    sig = []
+    for n in sorted(names):
+        try:
+            sig.append((n, os.stat(os.path.join(index_dir, n)).st_mtime_ns))
+        except OSError:
+            continue
+    return tuple(sig)
+
+
+# ========= 3. 内存估算 =========
+
+def estimate_size(obj: Any, _depth: int = 0) -> int:
+    """粗略估算结果对象占用的字节数（dict / list / str 递归累加）"""
+    size = sys.getsizeof(obj)
+    if _depth > 8:
+        return size
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            size += estimate_size(k, _depth + 1) + estimate_size(v, _depth + 1)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for v in obj:
+            size += estimate_size(v, _depth + 1)
+    return size
+
+
+# ========= 4. LRU + TTL 缓存 =========
+
+class LRUCache:
+    """
+    线程安全的 LRU 缓存：
+      - max_entries: 最多缓存多少条
+      - max_bytes: 估算内存上限，超过时从最久未用的开始淘汰
+      - ttl: 过期秒数（<= 0 表示不过期）
+      - version_fn: 返回“数据版本”的函数（如索引签名），版本变化时清空缓存，
+                    最多每 version_check_interval 秒检查一次
+      - enabled: 置为 False 时 get 一律未命中、put 不写入（压测时关掉缓存用）
+    缓存的值直接返回给调用方，调用方不要修改它。
+    """
+
+    def __init__(self, max_entries: int = 512,
+                 max_bytes: int = 64 * 1024 * 1024,
+                 ttl: float = 600.0,
+                 version_fn: Optional[Callable[[], Hashable]] = None,
+                 version_check_interval: float = 2.0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.version_fn = version_fn
+        self.version_check_interval = version_check_interval
+
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()  # key -> (value, size, expires_at)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self._version = version_fn() if version_fn else None
+        self._version_checked_at = time.monotonic()
+
+        self.enabled = True
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _check_version(self):
+        if self.version_fn is None:
+            return
+        now = time.monotonic()
+        if now - self._version_checked_at < self.version_check_interval:
+            return
+        self._version_checked_at = now
+        version = self.version_fn()
+        if version != self._version:
+            self._version = version
+            self._data.clear()
+            self._bytes = 0
+            self.invalidations += 1
+
+    def _pop(self, key):
+        _, size, _ = self._data.pop(key)
+        self._bytes -= size
+
+    def get(self, key, default=None):
+        if not self.enabled:
+            self.misses += 1
+            return default
+        with self._lock:
+            self._check_version()
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            value, _, expires_at = item
+            if expires_at and expires_at < time.monotonic():
+                self._pop(key)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if not self.enabled:
+            return
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl > 0 else 0.0
+        with self._lock:
+            self._check_version()
+            if key in self._data:
+                self._pop(key)
+            self._data[key] = (value, size, expires_at)
+            self._bytes += size
+            while self._data and (len(self._data) > self.max_entries or self._bytes > self.max_bytes):
+                oldest = next(iter(self._data))
+                self._pop(oldest)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._data),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+# ========= 5. SQLite 持久化缓存 =========
+
+def hash_key(*parts: Any) -> str:
+    """把若干部分拼成一个定长 key（sha256）"""
+    h = hashlib.sha256()
+    for p in parts:
+        h.update(str(p).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class SQLiteCache:
+    """
+    落盘缓存，值以 JSON 存储：
+      - 同一个 sqlite 文件可被多个 worker 进程共享（WAL 模式 + busy_timeout）
+      - version：写入时记录的版本（如 prompt 哈希），purge_stale 可删掉旧版本
+      - max_rows：超过后按最久未访问淘汰；ttl > 0 时过期条目视为未命中
+      - touch_interval：命中时距上次记录的访问时间超过这么多秒才更新 accessed_at，
+        读多的时候不必每次命中都抢写锁（淘汰顺序只需要大致准确）；
+        默认 ttl 的十分之一，不设 ttl 时 TOUCH_INTERVAL 秒
+      - enabled：同 LRUCache.enabled
+    """
+
+    TOUCH_INTERVAL = 300.0
+
+    def __init__(self, path: str, table: str = "cache",
+                 max_rows: int = 100000, ttl: float = 0.0,
+                 evict_every: int = 200, touch_interval: Optional[float] = None):
+        if not re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", table):
+            raise ValueError(f"非法表名: {table}")
+        self.path = path
+        self.table = table
+        self.max_rows = max_rows
+        self.ttl = ttl
+        self.evict_every = evict_every
+        if touch_interval is None:
+            touch_interval = ttl / 10 if ttl > 0 else self.TOUCH_INTERVAL
+        self.touch_interval = touch_interval
+
+        self._local = threading.local()
+        self._puts = 0
+        self.enabled = True
+        self.hits = 0
+        self.misses = 0
+
+        with self._conn() as conn:
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} ("
+                " key TEXT PRIMARY KEY,"
+                " value TEXT NOT NULL,"
+                " version TEXT NOT NULL DEFAULT '',"
+                " created_at REAL NOT NULL,"
+                " accessed_at REAL NOT NULL)"
+            )
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_accessed ON {table}(accessed_at)")
+
+    def _conn(self) -> sqlite3.Connection:
+        """每个线程一个连接（sqlite3 连接不能跨线程共享）"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            d = os.path.dirname(self.path)
+            if d:
+                os.makedirs(d, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str, version: Optional[str] = None, default=None):
+        """version 不为 None 时，只认同版本写入的值"""
+        if not self.enabled:
+            self.misses += 1
+            return default
+        conn = self._conn()
+        row = conn.execute(
+            f"SELECT value, version, created_at, accessed_at FROM {self.table} WHERE key = ?", (key,)
+        ).fetchone()
+        now = time.time()
+        if row is None or (version is not None and row[1] != version) \
+                or (self.ttl > 0 and row[2] + self.ttl < now):
+            self.misses += 1
+            return default
+        if now - row[3] >= self.touch_interval:
+            with conn:
+                conn.execute(f"UPDATE {self.table} SET accessed_at = ? WHERE key = ?", (now, key))
+        self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, value: Any, version: str = ""):
+        if not self.enabled:
+            return
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, version, created_at, accessed_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), version, now, now),
+            )
+        self._puts += 1
+        if self._puts % self.evict_every == 0:
+            self.evict()
+
+    def evict(self) -> int:
+        """行数超过 max_rows 时，删掉最久未访问的那些"""
+        conn = self._conn()
+        n = conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+        extra = n - self.max_rows
+        if extra <= 0:
+            return 0
+        with conn:
+            conn.execute(
+                f"DELETE FROM {self.table} WHERE key IN"
+                f" (SELECT key FROM {self.table} ORDER BY accessed_at LIMIT ?)", (extra,)
+            )
+        return extra
+
+    def purge_stale(self, version: str) -> int:
+        """删掉不是当前版本写入的条目（prompt 或模型变更后调用）"""
+        conn = self._conn()
+        with conn:
+            cur = conn.execute(f"DELETE FROM {self.table} WHERE version != ?", (version,))
+        return cur.rowcount
+
+    def clear(self):
+        conn = self._conn()
+        with conn:
+            conn.execute(f"DELETE FROM {self.table}")
+
+    def stats(self) -> Dict[str, Any]:
+        n = self._conn().execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "entries": n,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / total) if total else 0.0,
+        }
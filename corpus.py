@@ -0,0 +1,348 @@
+# corpus.py
+# -*- coding: utf-8 -*-
+"""
+corpus.py
+
+只读、mmap 共享的语料文件 threebody.corpus（由 threebody.json 生成）：
+
+- 全部章节原文按 UTF-8 首尾相接存成一块
+- 三张 uint32 偏移表：章节（原文范围 + 段落/句子在表中的区间）、段落、句子（含所属段落）
+- 章节元数据（id / book / chapter / section ...，不含 content）存成一段 JSON
+- 每个 worker 进程 mmap 同一个文件，页缓存由操作系统共享；
+  取段落/句子时按字节偏移切片、现解码，不在内存里常驻整份语料
+
+段落/句子的切分规则与 segments.py 完全一致（建文件时就是用 ChapterSegments 切的）。
+"""
+
+import os
+import sys
+import json
+import mmap
+import struct
+import threading
+from array import array
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+from segments import ChapterSegments, normalize_sentence
+from manifest import chapter_hash, file_hash
+
+CORPUS_PATH = "threebody.corpus"
+
+MAGIC = b"TBCORPUS"
+FORMAT_VERSION = 1
+
+# magic, version, n_chapters, n_paras, n_sents, meta_off, meta_len, chap_off, para_off, sent_off, text_off
+HEADER = struct.Struct("<8sIIIIQQQQQQ")
+
+CHAP_COLS = 6   # text_start, text_end, para_first, para_count, sent_first, sent_count
+PARA_COLS = 2   # start, end（字节偏移，相对原文块开头）
+SENT_COLS = 3   # start, end, para（句子所在段落在本章内的序号）
+
+
+# ========= 1. 生成语料文件 =========
+
+def _u32_bytes(values: array) -> bytes:
+    """偏移表统一按小端存"""
+    if sys.byteorder != "little":
+        values = array("I", values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _pad8(n: int) -> int:
+    return (n + 7) & ~7
+
+
+def build_corpus(docs: List[Dict[str, Any]], path: str = CORPUS_PATH, source_hash: str = ""):
+    """把章节列表写成语料文件（先写临时文件再 rename，正在读旧文件的进程不受影响）"""
+    chap = array("I")
+    para = array("I")
+    sent = array("I")
+    texts = []
+    records = []
+    pos = 0
+
+    for d in docs:
+        content = d.get("content", "") or ""
+        seg = ChapterSegments(content)
+        data = content.encode("utf-8")
+
+        # 字符偏移 → 字节偏移（只换算边界点）
+        bounds = sorted(set(seg.para_starts) | set(seg.para_ends)
+                        | set(seg.sent_starts) | set(seg.sent_ends))
+        byte_at = {}
+        prev_c, prev_b = 0, 0
+        for c in bounds:
+            prev_b += len(content[prev_c:c].encode("utf-8"))
+            prev_c = c
+            byte_at[c] = prev_b
+
+        chap.extend((pos, pos + len(data), len(para) // PARA_COLS, seg.paragraph_count,
+                     len(sent) // SENT_COLS, seg.sentence_count))
+        for s, e in zip(seg.para_starts, seg.para_ends):
+            para.extend((pos + byte_at[s], pos + byte_at[e]))
+        for s, e, p in zip(seg.sent_starts, seg.sent_ends, seg.sent_para):
+            sent.extend((pos + byte_at[s], pos + byte_at[e], p))
+
+        record = {k: v for k, v in d.items() if k != "content"}
+        record["id"] = str(d.get("id"))
+        record["hash"] = chapter_hash(d)
+        records.append(record)
+        texts.append(data)
+        pos += len(data)
+
+    meta = json.dumps({"source_hash": source_hash, "chapters": records},
+                      ensure_ascii=False).encode("utf-8")
+    blob = b"".join(texts)
+
+    meta_off = HEADER.size
+    chap_off = _pad8(meta_off + len(meta))
+    para_off = _pad8(chap_off + 4 * len(chap))
+    sent_off = _pad8(para_off + 4 * len(para))
+    text_off = _pad8(sent_off + 4 * len(sent))
+
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(records),
+                            len(para) // PARA_COLS, len(sent) // SENT_COLS,
+                            meta_off, len(meta), chap_off, para_off, sent_off, text_off))
+        for off, data in ((meta_off, meta), (chap_off, _u32_bytes(chap)),
+                          (para_off, _u32_bytes(para)), (sent_off, _u32_bytes(sent)),
+                          (text_off, blob)):
+            f.write(b"\0" * (off - f.tell()))
+            f.write(data)
+    os.replace(tmp, path)
+
+
+def read_source_hash(path: str = CORPUS_PATH) -> Optional[str]:
+    """只读文件头和元数据，取生成时的 threebody.json 哈希；文件不存在或格式不对返回 None"""
+    try:
+        with open(path, "rb") as f:
+            head = f.read(HEADER.size)
+            if len(head) < HEADER.size:
+                return None
+            fields = HEADER.unpack(head)
+            if fields[0] != MAGIC or fields[1] != FORMAT_VERSION:
+                return None
+            f.seek(fields[5])
+            meta = json.loads(f.read(fields[6]).decode("utf-8"))
+    except (OSError, ValueError):
+        return None
+    return meta.get("source_hash")
+
+
+def ensure_corpus(json_path: str, path: str = CORPUS_PATH,
+                  docs: Optional[List[Dict[str, Any]]] = None) -> bool:
+    """语料文件不存在、或不是由当前 threebody.json 生成的，就重新生成；返回是否重新生成了"""
+    source_hash = file_hash(json_path)
+    if not source_hash:
+        raise RuntimeError(f"未找到数据文件: {json_path}")
+    if read_source_hash(path) == source_hash:
+        return False
+    if docs is None:
+        with open(json_path, "r", encoding="utf-8") as f:
+            docs = json.load(f)
+    build_corpus(docs, path, source_hash)
+    print(f"[corpus] 已生成 {path}（{len(docs)} 章）")
+    return True
+
+
+# ========= 2. 读取：mmap + 偏移表 =========
+
+class _MappedCorpus:
+    """一次打开的语料文件；重新打开时整个换掉，不在原对象上修改"""
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, n_chap, n_para, n_sent, meta_off, meta_len,
+         chap_off, para_off, sent_off, text_off) = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise RuntimeError(f"语料文件格式不对: {path}")
+
+        meta = json.loads(self.mm[meta_off:meta_off + meta_len].decode("utf-8"))
+        self.source_hash = meta.get("source_hash", "")
+        self.records: List[Dict[str, Any]] = meta["chapters"]
+        self.index = {r["id"]: i for i, r in enumerate(self.records)}
+
+        self.text_off = text_off
+        self.chap = self._table(chap_off, n_chap * CHAP_COLS)
+        self.para = self._table(para_off, n_para * PARA_COLS)
+        self.sent = self._table(sent_off, n_sent * SENT_COLS)
+
+    def _table(self, off: int, n: int):
+        if sys.byteorder == "little":
+            return memoryview(self.mm)[off:off + 4 * n].cast("I")
+        values = array("I", self.mm[off:off + 4 * n])
+        values.byteswap()
+        return values
+
+    def decode(self, start: int, end: int) -> str:
+        base = self.text_off
+        return self.mm[base + start:base + end].decode("utf-8")
+
+
+class CorpusStore:
+    """
+    doc_id → 章节原文 / 段落 / 句子（段落、句子的切分见 segments.ChapterSegments）。
+    open() 换成新文件时只替换内部的 _MappedCorpus 引用，正在进行的读取仍用旧映射；
+    一次检索要前后读到同一份语料时用 snapshot() + pinned()。
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self._cur: Optional[_MappedCorpus] = None
+        self._local = threading.local()
+        if path:
+            self.open(path)
+
+    def open(self, path: str = CORPUS_PATH):
+        self._cur = _MappedCorpus(path)
+
+    @property
+    def _m(self) -> Optional[_MappedCorpus]:
+        """当前线程 pinned() 住的映射，没有则为最新打开的"""
+        return getattr(self._local, "m", None) or self._cur
+
+    def snapshot(self) -> "CorpusStore":
+        """当前映射的只读快照：之后再 open() 新文件不影响它"""
+        snap = CorpusStore()
+        snap._cur = self._cur
+        return snap
+
+    @contextmanager
+    def pinned(self, snapshot: "CorpusStore"):
+        """with 块内当前线程从 snapshot 的映射读（可嵌套，退出时恢复外层的）"""
+        prev = getattr(self._local, "m", None)
+        self._local.m = snapshot._cur
+        try:
+            yield self
+        finally:
+            self._local.m = prev
+
+    @property
+    def source_hash(self) -> str:
+        return self._m.source_hash if self._m else ""
+
+    def __contains__(self, doc_id) -> bool:
+        return self._m is not None and str(doc_id) in self._m.index
+
+    def __len__(self) -> int:
+        return len(self._m.records) if self._m else 0
+
+    # ----- 元数据 -----
+
+    def records(self) -> List[Dict[str, Any]]:
+        """各章元数据（不含 content），附带 hash（见 manifest.chapter_hash）"""
+        return list(self._m.records) if self._m else []
+
+    def record(self, doc_id) -> Dict[str, Any]:
+        m = self._m
+        i = m.index.get(str(doc_id)) if m else None
+        return m.records[i] if i is not None else {}
+
+    # ----- 文本 -----
+
+    def _row(self, doc_id):
+        m = self._m
+        i = m.index.get(str(doc_id)) if m else None
+        if i is None:
+            return m, None
+        return m, m.chap[i * CHAP_COLS:(i + 1) * CHAP_COLS]
+
+    def text(self, doc_id) -> str:
+        m, row = self._row(doc_id)
+        return m.decode(row[0], row[1]) if row is not None else ""
+
+    def paragraph_count(self, doc_id) -> int:
+        _, row = self._row(doc_id)
+        return row[3] if row is not None else 0
+
+    def sentence_count(self, doc_id) -> int:
+        _, row = self._row(doc_id)
+        return row[5] if row is not None else 0
+
+    def paragraphs(self, doc_id) -> List[str]:
+        m, row = self._row(doc_id)
+        if row is None:
+            return []
+        p = m.para
+        return [m.decode(p[j * PARA_COLS], p[j * PARA_COLS + 1])
+                for j in range(row[2], row[2] + row[3])]
+
+    def sentences(self, doc_id) -> List[str]:
+        m, row = self._row(doc_id)
+        if row is None:
+            return []
+        s = m.sent
+        return [normalize_sentence(m.decode(s[j * SENT_COLS], s[j * SENT_COLS + 1]))
+                for j in range(row[4], row[4] + row[5])]
+
+    def paragraph(self, doc_id, i: int) -> str:
+        m, row = self._row(doc_id)
+        if row is None or not 0 <= i < row[3]:
+            raise IndexError(f"段落越界: {doc_id}#{i}")
+        j = (row[2] + i) * PARA_COLS
+        return m.decode(m.para[j], m.para[j + 1])
+
+    def sentence(self, doc_id, i: int) -> str:
+        m, row = self._row(doc_id)
+        if row is None or not 0 <= i < row[5]:
+            raise IndexError(f"句子越界: {doc_id}#{i}")
+        j = (row[4] + i) * SENT_COLS
+        return normalize_sentence(m.decode(m.sent[j], m.sent[j + 1]))
+
+    def sentence_paragraph(self, doc_id, i: int) -> int:
+        """第 i 句所在段落的序号"""
+        m, row = self._row(doc_id)
+        if row is None or not 0 <= i < row[5]:
+            raise IndexError(f"句子越界: {doc_id}#{i}")
+        return m.sent[(row[4] + i) * SENT_COLS + 2]
+
+    def unit_range(self, doc_id, level: str) -> tuple:
+        """本章段落（level="paragraph"）或句子在全语料里的序号区间 (first, count)"""
+        _, row = self._row(doc_id)
+        if row is None:
+            return 0, 0
+        return (row[2], row[3]) if level == "paragraph" else (row[4], row[5])
+
+    # ----- 偏移 → 位置 -----
+
+    def text_range(self, doc_id) -> Optional[tuple]:
+        """本章原文在原文块里的字节区间 (start, end)"""
+        m, row = self._row(doc_id)
+        return (row[0], row[1]) if row is not None else None
+
+    def locate(self, offset: int) -> Optional[tuple]:
+        """
+        原文块里的字节偏移 → (doc_id, 段落序号, 句子序号)；
+        落在句子之间的空白上时算作前一句（本章第一句之前算第 0 句）
+        """
+        m = self._m
+        if m is None:
+            return None
+        chap, n = m.chap, len(m.records)
+        lo, hi = 0, n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if chap[mid * CHAP_COLS] <= offset:
+                lo = mid + 1
+            else:
+                hi = mid
+        i = lo - 1
+        if i < 0 or offset >= chap[i * CHAP_COLS + 1]:
+            return None
+        row = chap[i * CHAP_COLS:(i + 1) * CHAP_COLS]
+        first, count = row[4], row[5]
+        if count == 0:
+            return m.records[i]["id"], 0, 0
+        sent = m.sent
+        lo, hi = first, first + count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if sent[mid * SENT_COLS] <= offset:
+                lo = mid + 1
+            else:
+                hi = mid
+        j = max(lo - 1, first)
+        return m.records[i]["id"], sent[j * SENT_COLS + 2], j - first
@@ -0,0 +1,128 @@
+# evidence.py
+# -*- coding: utf-8 -*-
+"""
+evidence.py
+
+回答用的原文证据，直接复用多粒度检索已经打过分的句子（hit_sentences 的序号 + match_score），
+不再重新切分、重新扫描章节：
+
+- snippet：原文片段。先查全语料的引用索引（quotes.QuoteIndex），整句查询在原文里出现过就直接定位，
+  不受 Lucene 章节排名影响；否则在前几章里优先取包含整句查询的那句（没有引用索引时看这几章的全部句子，
+  不只是每章前几条命中句），再否则取分数最高的一句。
+  最后按句子序号从语料里取前后各一句拼成上下文
+- context：给模型的精简上下文。每章取分数最高的两句，带“[书名·章节]”前缀，
+  控制总句数和总字符数
+
+一次请求只做一遍：遍历前若干章的命中句，两种证据同时得到。
+"""
+
+from typing import Any, Dict, List, Optional, Tuple
+
+# 整句查询短于这个长度时不做整串匹配
+MIN_EXACT_CHARS = 4
+
+
+class Evidence:
+    """一次请求的原文证据"""
+
+    __slots__ = ("snippet", "context", "sentences")
+
+    def __init__(self, snippet: str = "", context: str = "",
+                 sentences: Optional[List[Tuple[str, int]]] = None):
+        self.snippet = snippet            # 原文片段（命中句 ± 1 句）
+        self.context = context            # 精简上下文（多行）
+        self.sentences = sentences or []  # context 用到的句子 [(doc_id, 句子序号), ...]
+
+
+def sentence_window(store, doc_id: str, index: int, radius: int = 1,
+                    end_index: Optional[int] = None) -> str:
+    """第 index（到 end_index）句及前后各 radius 句，直接按序号从语料里取"""
+    n = store.sentence_count(doc_id)
+    start = max(0, index - radius)
+    end = min(n, (index if end_index is None else end_index) + radius + 1)
+    return "".join(store.sentence(doc_id, i) for i in range(start, end)).strip()
+
+
+def _pick_quote(hits, chapters) -> Optional[Tuple[str, int, int]]:
+    """多处出现时取检索排名最靠前的章节里的第一处，都不在检索结果里就取语料中的第一处"""
+    rank = {str(ch.get("doc_id")): i for i, ch in enumerate(chapters)}
+    best = min(hits, key=lambda h: rank.get(h.doc_id, len(rank)))
+    return best.doc_id, best.sentence, best.end_sentence
+
+
+def select_evidence(query: str, res: Dict[str, Any], store, quotes=None,
+                    want_snippet: bool = True,
+                    snippet_chapters: int = 5,
+                    context_chapters: int = 5,
+                    per_chapter: int = 2,
+                    max_sents: int = 6,
+                    max_chars: int = 2000) -> Evidence:
+    """
+    res：search_multi_granularity 的结果；store：语料（search.SEGMENTS）；
+    quotes：引用索引（search.QUOTES），没有时在前 snippet_chapters 章的全部句子里找整串
+    want_snippet：不需要原文片段的场景（概念 / 人物类）只构造 context
+    """
+    raw_query = (query or "").strip()
+    exact = raw_query if len(raw_query) >= MIN_EXACT_CHARS else ""
+    chapters = res.get("chapters") or []
+
+    exact_hit = None       # (doc_id, 起始句序号, 结束句序号)
+    if want_snippet and exact and quotes:
+        hits = quotes.find(exact, doc_ids=[str(ch.get("doc_id")) for ch in chapters])
+        if hits:
+            exact_hit = _pick_quote(hits, chapters)
+    best_hit = None
+    best_score = 0.0
+
+    context_lines: List[str] = []
+    context_sents: List[Tuple[str, int]] = []
+    used_chars = 0
+    context_full = False
+
+    for rank, ch in enumerate(chapters[:max(snippet_chapters, context_chapters)]):
+        doc_id = str(ch.get("doc_id"))
+        hit_sents = ch.get("hit_sentences") or []
+        if not hit_sents:
+            continue
+
+        # 原文片段：整串命中优先（按章节顺序、句子顺序取第一处），否则取最高分
+        if want_snippet and exact_hit is None and rank < snippet_chapters:
+            for s in hit_sents:
+                if s.get("match_score", 0) > best_score:
+                    best_score = s["match_score"]
+                    best_hit = (doc_id, s["index"])
+            if exact:
+                if quotes:
+                    # 引用索引已查过全语料，这里只兜底归一化上的差异，看命中句就够了
+                    candidates = ((s["index"], store.sentence(doc_id, s["index"]))
+                                  for s in sorted(hit_sents, key=lambda x: x["index"]))
+                else:
+                    # 没有引用索引：命中句每章只有前几条，整串可能在分数低的句子里
+                    candidates = enumerate(store.sentences(doc_id))
+                for i, text in candidates:
+                    if exact in text:
+                        exact_hit = (doc_id, i, i)
+                        break
+
+        # 精简上下文：hit_sentences 已按分数从高到低排好
+        if not context_full and rank < context_chapters:
+            for s in hit_sents[:per_chapter]:
+                line = f"[{ch.get('book', '')}·{ch.get('chapter', '')}] {store.sentence(doc_id, s['index'])}"
+                if used_chars + len(line) > max_chars:
+                    context_full = True
+                    break
+                context_lines.append(line)
+                context_sents.append((doc_id, s["index"]))
+                used_chars += len(line)
+                if len(context_lines) >= max_sents:
+                    context_full = True
+                    break
+
+    snippet = ""
+    if want_snippet and exact_hit is not None:
+        doc_id, first, last = exact_hit
+        snippet = sentence_window(store, doc_id, first, end_index=last)
+    elif want_snippet and best_hit is not None:
+        snippet = sentence_window(store, *best_hit)
+
+    return Evidence(snippet, "\n".join(context_lines), context_sents)
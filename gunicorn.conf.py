@@ -0,0 +1,32 @@
+# gunicorn.conf.py
+# -*- coding: utf-8 -*-
+"""
+生产部署：gunicorn -c gunicorn.conf.py app:app
+
+- 预派生多进程（pre-fork），每个 worker 进程各自启动 JVM、mmap 同一份索引和语料文件
+- worker 里用 gthread：请求线程处理 HTTP / LLM，Lucene 调用交给 app.LUCENE_POOL
+- 不 preload：JVM 和 SQLite 连接都不能跨 fork 继承，app 在每个 worker 里各自导入
+- worker 导入 app 之后在后台初始化搜索，/readyz 在预热完成后才返回 200
+
+环境变量：
+  BIND             监听地址，默认 0.0.0.0:5000
+  WEB_CONCURRENCY  worker 进程数，默认 CPU 核数
+  WEB_THREADS      每个 worker 的请求线程数，默认 16
+  WEB_TIMEOUT      单个请求超时秒数（流式回答可能较长），默认 120
+  另见 app.py 的 SEARCH_THREADS / MAX_INFLIGHT / QUEUE_TIMEOUT 和 search.py 的 LUCENE_VMARGS
+"""
+
+import os
+import multiprocessing
+
+bind = os.environ.get("BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "gthread"
+threads = int(os.environ.get("WEB_THREADS", "16"))
+timeout = int(os.environ.get("WEB_TIMEOUT", "120"))
+preload_app = False
+
+
+def post_worker_init(worker):
+    from app import start_background_init
+    start_background_init()
@@ -0,0 +1,327 @@
+# intent.py
+# -*- coding: utf-8 -*-
+"""
+intent.py
+
+本地查询理解：大部分查询（裸关键词、带标点的原文引用）不用走一次大模型，
+在本地给出与 llm.analyze_query 相同结构的结果，外加一个置信度：
+
+- 规则：
+    · 整个查询（或空格分开的每一段）都是 vocab.txt 里的词或章节标题 → keyword；
+      人物还是概念（intent）规则分不出来，只作先验：模型也判为 keyword 时用模型的 intent
+      和置信度，否则置信度低于阈值，仍交给大模型
+    · 带句内标点、没有疑问词的长句 → snippet / locate_original
+- 模型：字符 1~3-gram 的朴素贝叶斯，用缓存里大模型给出的分析结果训练
+  （python llm.py train-intent query_log.jsonl），分别预测 query_type 和 intent
+- search_query / keywords：查询里出现的词表词和章节标题（长词优先、互不重叠），
+  没有时用去掉疑问成分后的查询
+
+llm.analyze_query 只在置信度 ≥ INTENT_THRESHOLD 时采用本地结果，否则仍调用大模型。
+"""
+
+import os
+import re
+import json
+import math
+import random
+import threading
+from collections import Counter, defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from cache import normalize_query
+from matcher import TermMatcher
+
+VOCAB_PATH = "vocab.txt"
+CHAPTERS_PATH = "threebody.json"
+INTENT_MODEL_PATH = os.environ.get("INTENT_MODEL_PATH", "intent_model.json")
+INTENT_THRESHOLD = float(os.environ.get("INTENT_THRESHOLD", "0.9"))
+
+# 训练样本少于这个数时不用模型（只用规则）
+MIN_TRAIN_EXAMPLES = 50
+NGRAM_MAX = 3
+
+QUERY_TYPES = ("snippet", "keyword", "question")
+INTENTS = ("locate_original", "ask_original_text", "ask_meaning",
+           "ask_character_profile", "ask_story_detail", "ask_other")
+
+QUESTION_WORDS = ("什么", "谁", "哪", "吗", "呢", "怎么", "怎样", "如何", "为什么", "为何",
+                  "多少", "几个", "是否", "有没有", "是不是", "介绍", "讲讲", "说说", "?", "？")
+# 检索串里去掉的疑问 / 客套成分（长的在前）
+FILLER_WORDS = ("请问", "请", "具体", "完整", "的内容", "内容", "是什么", "是谁", "有哪些", "有什么",
+                "干了什么", "为什么", "怎么样", "怎么", "如何", "什么", "哪些", "哪个", "介绍一下",
+                "介绍", "讲讲", "说说", "吗", "呢", "啊")
+SENTENCE_PUNCT = "，。！？；：…、,.!?;:"
+QUOTE_CHARS = "“”‘’「」『』\"'《》"
+# 关键词列表的分隔符（“程心，云天明”仍是关键词查询，不是原文引用）
+LIST_SEPARATORS = re.compile(r"[\s，、,;；]+")
+
+# 规则命中时的置信度；关键词规则只定得了 query_type，置信度必须低于 INTENT_THRESHOLD
+SNIPPET_CONFIDENCE = 0.95
+KEYWORD_CONFIDENCE = 0.6
+
+
+# ========= 1. 词表 =========
+
+def load_lexicon(vocab_path: str = VOCAB_PATH, chapters_path: str = CHAPTERS_PATH) -> Tuple[set, set]:
+    """返回 (vocab 词集合, 章节标题集合)；文件不存在时为空"""
+    vocab, titles = set(), set()
+    if os.path.exists(vocab_path):
+        with open(vocab_path, "r", encoding="utf-8") as f:
+            for line in f:
+                w = line.strip().split(" ")[0]
+                if w:
+                    vocab.add(w)
+    if os.path.exists(chapters_path):
+        with open(chapters_path, "r", encoding="utf-8") as f:
+            for d in json.load(f):
+                t = (d.get("chapter") or "").strip()
+                if t:
+                    titles.add(t)
+    return vocab, titles
+
+
+def strip_query(query: str) -> str:
+    """去掉引号、句内标点和疑问成分，剩下的作为检索串"""
+    q = query
+    for ch in QUOTE_CHARS + SENTENCE_PUNCT:
+        q = q.replace(ch, " ")
+    for w in FILLER_WORDS:
+        q = q.replace(w, " ")
+    return " ".join(q.split())
+
+
+# ========= 2. 字符 n-gram 朴素贝叶斯 =========
+
+def char_ngrams(text: str, n_max: int = NGRAM_MAX) -> List[str]:
+    s = "^" + normalize_query(text).replace(" ", "_") + "$"
+    grams = []
+    for n in range(1, n_max + 1):
+        grams.extend(s[i:i + n] for i in range(len(s) - n + 1))
+    return grams
+
+
+class NaiveBayes:
+    """多项式朴素贝叶斯，拉普拉斯平滑；可序列化为 JSON"""
+
+    def __init__(self, alpha: float = 1.0):
+        self.alpha = alpha
+        self.class_counts: Dict[str, int] = {}
+        self.feature_counts: Dict[str, Dict[str, int]] = {}
+        self.totals: Dict[str, int] = {}
+        self.vocab_size = 0
+
+    def fit(self, texts: Sequence[str], labels: Sequence[str]) -> "NaiveBayes":
+        class_counts = Counter(labels)
+        feature_counts: Dict[str, Counter] = defaultdict(Counter)
+        vocab = set()
+        for text, label in zip(texts, labels):
+            grams = char_ngrams(text)
+            feature_counts[label].update(grams)
+            vocab.update(grams)
+        self.class_counts = dict(class_counts)
+        self.feature_counts = {c: dict(fc) for c, fc in feature_counts.items()}
+        self.totals = {c: sum(fc.values()) for c, fc in feature_counts.items()}
+        self.vocab_size = len(vocab)
+        return self
+
+    def predict(self, text: str) -> Tuple[Optional[str], float]:
+        """返回 (最可能的类别, 后验概率)"""
+        if not self.class_counts:
+            return None, 0.0
+        grams = char_ngrams(text)
+        n_docs = sum(self.class_counts.values())
+        scores = {}
+        for c, n in self.class_counts.items():
+            fc = self.feature_counts.get(c, {})
+            denom = math.log(self.totals.get(c, 0) + self.alpha * (self.vocab_size + 1))
+            s = math.log(n / n_docs)
+            for g in grams:
+                s += math.log(fc.get(g, 0) + self.alpha) - denom
+            scores[c] = s
+        best = max(scores, key=scores.get)
+        top = scores[best]
+        z = sum(math.exp(v - top) for v in scores.values())
+        return best, 1.0 / z
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"alpha": self.alpha, "class_counts": self.class_counts,
+                "feature_counts": self.feature_counts, "totals": self.totals,
+                "vocab_size": self.vocab_size}
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "NaiveBayes":
+        m = cls(d.get("alpha", 1.0))
+        m.class_counts = d.get("class_counts", {})
+        m.feature_counts = d.get("feature_counts", {})
+        m.totals = d.get("totals", {})
+        m.vocab_size = d.get("vocab_size", 0)
+        return m
+
+
+# ========= 3. 分类器 =========
+
+class IntentClassifier:
+    """
+    classify(query) → (分析结果 dict, 置信度)
+    词表和模型在第一次调用时加载；模型文件不存在时只用规则。
+    """
+
+    def __init__(self, model_path: str = INTENT_MODEL_PATH,
+                 vocab_path: str = VOCAB_PATH, chapters_path: str = CHAPTERS_PATH):
+        self.model_path = model_path
+        self.vocab_path = vocab_path
+        self.chapters_path = chapters_path
+        self._lock = threading.Lock()
+        self._loaded = False
+        self.vocab: set = set()
+        self.titles: set = set()
+        self.matcher: Optional[TermMatcher] = None
+        self.type_model: Optional[NaiveBayes] = None
+        self.intent_model: Optional[NaiveBayes] = None
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            self.vocab, self.titles = load_lexicon(self.vocab_path, self.chapters_path)
+            # 长词优先：同一位置先匹配更长的词
+            self.matcher = TermMatcher(sorted(self.vocab | self.titles, key=len, reverse=True))
+            self.load_model()
+            self._loaded = True
+
+    def load_model(self):
+        try:
+            with open(self.model_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.type_model = NaiveBayes.from_dict(data["query_type"])
+        self.intent_model = NaiveBayes.from_dict(data["intent"])
+
+    def save_model(self, path: Optional[str] = None):
+        path = path or self.model_path
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"query_type": self.type_model.to_dict(),
+                       "intent": self.intent_model.to_dict()}, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    def fit(self, pairs: Iterable[Tuple[str, Dict[str, Any]]]) -> int:
+        """pairs：(查询, 大模型给出的分析结果)；返回训练样本数"""
+        texts, types, intents = [], [], []
+        for q, a in pairs:
+            if a.get("query_type") in QUERY_TYPES and a.get("intent") in INTENTS:
+                texts.append(q)
+                types.append(a["query_type"])
+                intents.append(a["intent"])
+        if len(texts) < MIN_TRAIN_EXAMPLES:
+            self.type_model = self.intent_model = None
+        else:
+            self.type_model = NaiveBayes().fit(texts, types)
+            self.intent_model = NaiveBayes().fit(texts, intents)
+        return len(texts)
+
+    # ----- 规则 -----
+
+    def _keywords(self, query: str) -> List[str]:
+        if not self.matcher:
+            return []
+        res = self.matcher.scan(query)
+        return [query[s:e] for s, e in res.spans]
+
+    def _is_lexicon_query(self, query: str) -> bool:
+        """每一段（按空格、逗号、顿号分开）都是词表词或章节标题"""
+        parts = [p.strip(QUOTE_CHARS) for p in LIST_SEPARATORS.split(query) if p]
+        return bool(parts) and all(p in self.vocab or p in self.titles for p in parts)
+
+    @staticmethod
+    def _has_question_word(query: str) -> bool:
+        return any(w in query for w in QUESTION_WORDS)
+
+    def _rule(self, query: str) -> Optional[Tuple[str, str, float]]:
+        """(query_type, intent, 置信度)；规则判断不了时返回 None"""
+        if self._has_question_word(query):
+            return None
+        if self._is_lexicon_query(query):
+            return "keyword", "ask_meaning", KEYWORD_CONFIDENCE
+        body = query.strip(QUOTE_CHARS + SENTENCE_PUNCT)
+        if len(body) >= 6 and any(ch in body for ch in SENTENCE_PUNCT):
+            return "snippet", "locate_original", SNIPPET_CONFIDENCE
+        return None
+
+    # ----- 对外接口 -----
+
+    def classify(self, query: str) -> Tuple[Dict[str, Any], float]:
+        self._ensure_loaded()
+        q = normalize_query(query)
+
+        rule = self._rule(q)
+        type_pred = self.type_model.predict(q) if self.type_model else (None, 0.0)
+        intent_pred = self.intent_model.predict(q) if self.intent_model else (None, 0.0)
+
+        if rule is not None:
+            query_type, intent, confidence = rule
+            # 关键词查询的 intent（人物 / 概念）规则分不出来：模型也判为 keyword 时
+            # query_type 已有两方一致，置信度取模型对 intent 的把握
+            if query_type == "keyword" and type_pred[0] == "keyword" and intent_pred[0] is not None:
+                intent = intent_pred[0]
+                confidence = max(confidence, intent_pred[1])
+        elif type_pred[0] is not None:
+            query_type, intent = type_pred[0], intent_pred[0]
+            confidence = min(type_pred[1], intent_pred[1])
+        else:
+            query_type, intent, confidence = "question", "ask_other", 0.0
+
+        if query_type == "snippet":
+            keywords = []
+            search_query = query.strip().strip(QUOTE_CHARS)
+        else:
+            keywords = self._keywords(q)
+            search_query = " ".join(keywords) or strip_query(q) or q
+
+        return {
+            "query_type": query_type,
+            "intent": intent,
+            "search_query": search_query,
+            "keywords": keywords[:5],
+            "need_original_text": intent in ("locate_original", "ask_original_text"),
+        }, confidence
+
+
+def evaluate(clf: IntentClassifier, pairs: Sequence[Tuple[str, Dict[str, Any]]],
+             threshold: float = INTENT_THRESHOLD) -> Dict[str, float]:
+    """本地结果与大模型结果比较：覆盖率（置信度过阈值的比例）和覆盖部分的一致率"""
+    covered = agree_type = agree_both = 0
+    for q, a in pairs:
+        local, conf = clf.classify(q)
+        if conf < threshold:
+            continue
+        covered += 1
+        if local["query_type"] == a.get("query_type"):
+            agree_type += 1
+            if local["intent"] == a.get("intent"):
+                agree_both += 1
+    n = len(pairs)
+    return {
+        "examples": n,
+        "coverage": covered / n if n else 0.0,
+        "query_type_agreement": agree_type / covered if covered else 0.0,
+        "intent_agreement": agree_both / covered if covered else 0.0,
+    }
+
+
+def train_and_evaluate(clf: IntentClassifier, pairs: List[Tuple[str, Dict[str, Any]]],
+                       holdout: float = 0.2, seed: int = 0) -> Dict[str, float]:
+    """先留出一部分评估，再用全部样本训练（调用方负责 save_model）"""
+    clf._ensure_loaded()
+    pairs = list(pairs)
+    random.Random(seed).shuffle(pairs)
+    n_test = int(len(pairs) * holdout)
+    test, train = pairs[:n_test], pairs[n_test:]
+    clf.fit(train)
+    report = evaluate(clf, test) if test else {}
+    report["trained_on"] = clf.fit(pairs)
+    report["model_used"] = clf.type_model is not None
+    return report
@@ -3,17 +3,38 @@
 """
 大模型模块：
 - analyze_query：结构化理解用户查询（keyword / question / snippet + intent）
-- summarize_with_llm：根据 prompt 生成回答（由 app.py 构造 prompt）
+- summarize_with_llm：根据 prompt 生成回答（由 app.py 构造 prompt）；summarize_with_llm_stream 为流式版本
+- analyze_query 的结果落盘缓存在 llm_cache.sqlite3；python llm.py warm/purge/stats 管理
+- summarize_with_llm 的回答缓存在同一个文件的 answer 表：key = 模板 + 归一化问题 + 原文证据，
+  版本 = 回答 prompt / 模型 + 索引提交点（由 app.py 计算并读写）
+- 简单查询（裸关键词、原文引用）由 intent.py 在本地判断，置信度够高时不调用模型；
+  python llm.py train-intent 用缓存里的模型结果训练本地分类器
+- HTTP 调用走 llm_client.LLMClient（连接池、截止时间、重试、并发上限、对冲），接口地址等见该模块
 """
 
-from typing import Dict, Any
+from typing import Dict, Any, List, Tuple, Iterable, Iterator
+import os
+import sys
 import json
+import sqlite3
+import hashlib
+import argparse
 
-from zhipuai import ZhipuAI
+from cache import SQLiteCache, normalize_query, hash_key
+from llm_client import LLMClient
+from intent import IntentClassifier, INTENT_THRESHOLD, train_and_evaluate
+import metrics
 
 
-# 用你的实际 API Key（建议和 use.py 保持一致）
-client = ZhipuAI(api_key="my key")
+# API Key 用环境变量 LLM_API_KEY（或 ZHIPUAI_API_KEY）；
+# 接口地址默认是智谱官方，设置 LLM_BASE_URL（或 ZHIPUAI_BASE_URL）可指向本地兼容服务（如 llm_stub.py）
+client = LLMClient.from_env()
+
+# 每次调用的总时间预算（秒，含排队和重试）
+ANALYZE_DEADLINE = float(os.environ.get("LLM_ANALYZE_DEADLINE", "8"))
+ANSWER_DEADLINE = float(os.environ.get("LLM_ANSWER_DEADLINE", "60"))
+# 查询分析超过这么多秒还没返回就再发一份，先回来的算数；0 = 不对冲
+ANALYZE_HEDGE_AFTER = float(os.environ.get("LLM_ANALYZE_HEDGE_AFTER", "0"))
 
 
 # ========= 1. 查询分析：7 种场景都走这里 =========
@@ -90,6 +111,26 @@ ANALYZE_SYSTEM_PROMPT = """
 """
 
 
+ANALYZE_MODEL = "glm-4-flash"
+
+# prompt / 模型一改，版本号就变，旧缓存自动失效（purge 子命令可清理）
+ANALYZE_PROMPT_VERSION = hashlib.sha256(
+    (ANALYZE_MODEL + "\0" + ANALYZE_SYSTEM_PROMPT).encode("utf-8")
+).hexdigest()[:16]
+
+# 查询分析结果的落盘缓存：多个 worker 进程共享，重启不丢
+LLM_CACHE_PATH = os.environ.get("LLM_CACHE_PATH", "llm_cache.sqlite3")
+ANALYSIS_CACHE = SQLiteCache(LLM_CACHE_PATH, table="analysis", max_rows=200000)
+
+
+# 本地分类器：词表 / 模型在第一次分析时加载
+LOCAL_INTENT = IntentClassifier()
+
+
+def analysis_cache_key(query: str) -> str:
+    return hash_key(normalize_query(query), ANALYZE_PROMPT_VERSION, ANALYZE_MODEL)
+
+
 def _safe_json_loads(text: str) -> Dict[str, Any]:
     """从大模型输出中尽量抠出 JSON 对象"""
     try:
@@ -108,48 +149,69 @@ def _safe_json_loads(text: str) -> Dict[str, Any]:
     return {}
 
 
-def analyze_query(query: str) -> Dict[str, Any]:
+def analyze_query(query: str, use_cache: bool = True, use_local: bool = True) -> Dict[str, Any]:
     """
     使用 LLM 分析查询：
     - 判断 query_type (snippet/keyword/question)
     - 推断 intent
     - 返回 search_query / keywords / need_original_text
-    """
-    user_prompt = f"用户的原始查询是：{query}\n\n请严格按照上面的说明，只输出一个 JSON 对象。"
 
-    resp = client.chat.completions.create(
-        model="glm-4-flash",
-        messages=[
-            {"role": "system", "content": ANALYZE_SYSTEM_PROMPT},
-            {"role": "user", "content": user_prompt},
-        ],
-        temperature=0.2,
-        top_p=0.9,
-        max_tokens=400,
-        stream=False,
-    )
+    结果先查 ANALYSIS_CACHE（key = 归一化 query + prompt 版本）；
+    未命中时先用本地分类器，置信度 ≥ INTENT_THRESHOLD 就直接用（不写缓存），否则才调用模型。
+    """
+    key = analysis_cache_key(query)
+    if use_cache:
+        try:
+            cached = ANALYSIS_CACHE.get(key, version=ANALYZE_PROMPT_VERSION)
+        except sqlite3.Error as e:
+            print("[analysis-cache] 读取失败:", e)
+            cached = None
+        if cached is not None:
+            metrics.ANALYSIS_SOURCE.inc(source="cache")
+            return cached
+
+    if use_local:
+        local, confidence = LOCAL_INTENT.classify(query)
+        if confidence >= INTENT_THRESHOLD:
+            metrics.ANALYSIS_SOURCE.inc(source="local")
+            return _postprocess_analysis(local, query)
+
+    metrics.ANALYSIS_SOURCE.inc(source="llm")
+    data, parsed = _analyze_query_llm(query)
+
+    # 模型输出没解析出 JSON 时只用兜底结果，不写缓存
+    if use_cache and parsed:
+        try:
+            ANALYSIS_CACHE.put(key, data, version=ANALYZE_PROMPT_VERSION)
+        except sqlite3.Error as e:
+            print("[analysis-cache] 写入失败:", e)
+    return data
 
-    content = resp.choices[0].message.content.strip()
-    data = _safe_json_loads(content)
 
-def analyze_query(query: str) -> Dict[str, Any]:
+def _analyze_query_llm(query: str) -> Tuple[Dict[str, Any], bool]:
+    """真正调用模型并做后处理，返回 (分析结果, 是否成功解析出 JSON)"""
     user_prompt = f"用户的原始查询是：{query}\n\n请严格按照上面的说明，只输出一个 JSON 对象。"
 
-    resp = client.chat.completions.create(
-        model="glm-4-flash",
-        messages=[
+    content = client.chat(
+        [
             {"role": "system", "content": ANALYZE_SYSTEM_PROMPT},
             {"role": "user", "content": user_prompt},
         ],
+        deadline=ANALYZE_DEADLINE,
+        hedge_after=ANALYZE_HEDGE_AFTER,
+        call="analyze",
+        model=ANALYZE_MODEL,
         temperature=0.2,
         top_p=0.9,
         max_tokens=400,
-        stream=False,
-    )
-
-    content = resp.choices[0].message.content.strip()
+    ).strip()
     data = _safe_json_loads(content)
+    parsed = bool(data)
+    return _postprocess_analysis(data, query), parsed
 
+
+def _postprocess_analysis(data: Dict[str, Any], query: str) -> Dict[str, Any]:
+    """补齐缺失字段，并按字面规则修正（模型结果和本地结果都要过一遍）"""
     q = (query or "").strip()
 
     # 1. 基本兜底
@@ -193,6 +255,28 @@ ANSWER_SYSTEM_PROMPT = """你是一名对刘慈欣《三体》三部曲极其熟
 3. 回答使用自然、流畅的中文，不要加项目符号或标题，不要使用【】等装饰性前缀。
 4. 当你明显无法回答某个细节时，可以简要说明“小说中没有明确交代这一点”或“这部分情节不太确定”，但不要频繁强调“原文不足以回答”。"""
 
+ANSWER_MODEL = "glm-4-flash"
+
+ANSWER_PROMPT_VERSION = hashlib.sha256(
+    (ANSWER_MODEL + "\0" + ANSWER_SYSTEM_PROMPT).encode("utf-8")
+).hexdigest()[:16]
+
+# 回答缓存：同一个问题、同样的原文证据，直接复用上次的回答
+#   ANSWER_CACHE_TTL：秒数，默认一天；ANSWER_CACHE_ROWS：最多条数，超出按最久未访问淘汰
+ANSWER_CACHE_TTL = float(os.environ.get("ANSWER_CACHE_TTL", "86400"))
+ANSWER_CACHE = SQLiteCache(LLM_CACHE_PATH, table="answer",
+                           max_rows=int(os.environ.get("ANSWER_CACHE_ROWS", "50000")),
+                           ttl=ANSWER_CACHE_TTL)
+
+
+def answer_cache_key(template: str, question: str, evidence: str) -> str:
+    """template：app.py 里选中的 prompt 模板原文；evidence：喂给模型的原文片段 / 上下文"""
+    return hash_key(template, normalize_query(question), evidence)
+
+
+def answer_cache_version(index_version: Any) -> str:
+    return hash_key(ANSWER_PROMPT_VERSION, index_version)[:16]
+
 
 
 def summarize_with_llm(prompt: str) -> str:
@@ -200,17 +284,129 @@ def summarize_with_llm(prompt: str) -> str:
     接收一个完整的 prompt（由 app.py 组织好，包含问题 + 可选上下文），
     返回模型生成的回答文本。
     """
-    resp = client.chat.completions.create(
-        model="glm-4-flash",
-        messages=[
+    return client.chat(
+        [
             {"role": "system", "content": ANSWER_SYSTEM_PROMPT},
             {"role": "user", "content": prompt},
         ],
+        deadline=ANSWER_DEADLINE,
+        call="answer",
+        model=ANSWER_MODEL,
+        temperature=0.7,
+        top_p=0.9,
+        max_tokens=800,
+    ).strip()
+
+
+def summarize_with_llm_stream(prompt: str) -> Iterator[str]:
+    """
+    summarize_with_llm 的流式版本：模型每生成一段文本就 yield 一段，
+    供 /api/search/stream 通过 SSE 转发给前端。
+    """
+    yield from client.chat_stream(
+        [
+            {"role": "system", "content": ANSWER_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt},
+        ],
+        deadline=ANSWER_DEADLINE,
+        call="answer_stream",
+        model=ANSWER_MODEL,
         temperature=0.7,
         top_p=0.9,
         max_tokens=800,
-        stream=False,
     )
 
-    return resp.choices[0].message.content.strip()
 
+# ========= 3. 命令行：预热 / 清理分析缓存 =========
+
+def iter_log_queries(path: str) -> Iterable[str]:
+    """查询日志：每行一个 JSON（取 query 字段）或一行纯文本"""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("{"):
+                try:
+                    q = json.loads(line).get("query")
+                except Exception:
+                    q = None
+            else:
+                q = line
+            if q and str(q).strip():
+                yield str(q).strip()
+
+
+def warm_analysis_cache(path: str) -> Dict[str, int]:
+    """按查询日志预热：已缓存的跳过，相同（归一化后）查询只调用一次模型"""
+    stats = {"total": 0, "cached": 0, "analyzed": 0, "failed": 0}
+    seen = set()
+    for q in iter_log_queries(path):
+        stats["total"] += 1
+        key = analysis_cache_key(q)
+        if key in seen:
+            continue
+        seen.add(key)
+        if ANALYSIS_CACHE.get(key, version=ANALYZE_PROMPT_VERSION) is not None:
+            stats["cached"] += 1
+            continue
+        try:
+            analyze_query(q, use_local=False)
+            stats["analyzed"] += 1
+        except Exception as e:
+            print(f"[warm] 分析失败: {q!r}: {e}")
+            stats["failed"] += 1
+    return stats
+
+
+def cached_analyses(path: str) -> List[Tuple[str, Dict[str, Any]]]:
+    """查询日志里已有模型分析结果（当前 prompt 版本）的查询，去重"""
+    pairs, seen = [], set()
+    for q in iter_log_queries(path):
+        key = analysis_cache_key(q)
+        if key in seen:
+            continue
+        seen.add(key)
+        a = ANALYSIS_CACHE.get(key, version=ANALYZE_PROMPT_VERSION)
+        if a is not None:
+            pairs.append((q, a))
+    return pairs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="analyze_query 结果缓存管理")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_warm = sub.add_parser("warm", help="从查询日志预热缓存")
+    p_warm.add_argument("log", help="查询日志（JSONL 的 query 字段，或每行一条查询）")
+    sub.add_parser("purge", help="删除旧 prompt 版本 / 旧索引写入的缓存")
+    sub.add_parser("stats", help="查看缓存条目数")
+    p_train = sub.add_parser("train-intent", help="用缓存里的模型分析结果训练本地意图分类器")
+    p_train.add_argument("log", help="查询日志（先用 warm 子命令让模型分析一遍）")
+    args = parser.parse_args(argv)
+
+    if args.cmd == "warm":
+        print(warm_analysis_cache(args.log))
+    elif args.cmd == "purge":
+        n = ANALYSIS_CACHE.purge_stale(ANALYZE_PROMPT_VERSION)
+        print(f"已删除 {n} 条旧版本分析缓存（当前版本 {ANALYZE_PROMPT_VERSION}）")
+        from cache import index_signature
+        from manifest import INDEX_DIR
+        version = answer_cache_version(index_signature(INDEX_DIR))
+        n = ANSWER_CACHE.purge_stale(version)
+        print(f"已删除 {n} 条旧版本回答缓存（当前版本 {version}）")
+    elif args.cmd == "stats":
+        print({"analysis": ANALYSIS_CACHE.stats(), "answer": ANSWER_CACHE.stats()})
+    elif args.cmd == "train-intent":
+        pairs = cached_analyses(args.log)
+        report = train_and_evaluate(LOCAL_INTENT, pairs)
+        if report["model_used"]:
+            LOCAL_INTENT.save_model()
+            print(f"模型已保存到 {LOCAL_INTENT.model_path}")
+        else:
+            print(f"样本太少（{report['trained_on']} 条），未保存模型，仍只用规则")
+        print(report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,262 @@
+# llm_client.py
+# -*- coding: utf-8 -*-
+"""
+llm_client.py
+
+大模型 HTTP 传输层（OpenAI / 智谱兼容的 POST {base_url}/chat/completions），
+llm.py 的 analyze_query / summarize_with_llm 都走这里：
+
+- 连接池：一个 requests.Session，keep-alive 复用连接，每个 worker 进程一份
+- 截止时间：每次调用一个总预算（Deadline），重试、排队、流式读取都算在里面，超时抛 LLMTimeout
+- 重试：连接失败、读超时、429 / 5xx 才重试，指数退避 + 全抖动（full jitter）
+- 并发上限：同时在途的调用数受信号量限制，排队到截止时间还拿不到名额抛 LLMBusy
+- 对冲（hedging）：短调用（查询分析）在 hedge_after 秒内没返回就再发一份，谁先成功用谁
+- 流式：只在还没收到任何内容之前重试，已经开始输出后出错直接抛出
+
+环境变量（未设置 LLM_* 时沿用 ZHIPUAI_*）：
+  LLM_BASE_URL / ZHIPUAI_BASE_URL   接口地址，默认智谱官方；可指向 llm_stub.py 等本地兼容服务
+  LLM_API_KEY / ZHIPUAI_API_KEY     以 Bearer 方式发送
+  LLM_POOL_SIZE                     连接池大小，默认 32
+  LLM_MAX_CONCURRENCY               同时在途的调用数上限，默认 16
+  LLM_CONNECT_TIMEOUT               建连超时秒数，默认 3
+  LLM_RETRIES                       失败后最多重试几次，默认 2
+  LLM_BACKOFF                       退避基数秒数，默认 0.25
+"""
+
+import os
+import json
+import time
+import random
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any, Callable, Dict, Iterator, List
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+DEFAULT_BASE_URL = "https://open.bigmodel.cn/api/paas/v4"
+
+# 这些状态码视为暂时性错误，可以重试
+RETRY_STATUS = (408, 409, 429, 500, 502, 503, 504)
+
+
+def _env(name: str, fallback: str = "", default: str = "") -> str:
+    return os.environ.get(name) or (os.environ.get(fallback) if fallback else "") or default
+
+
+# ========= 1. 异常与截止时间 =========
+
+class LLMError(Exception):
+    """大模型调用失败"""
+
+
+class LLMTimeout(LLMError):
+    """超过本次调用的截止时间"""
+
+
+class LLMBusy(LLMError):
+    """并发名额在截止时间前没有空出来"""
+
+
+class LLMHTTPError(LLMError):
+    def __init__(self, status: int, body: str = ""):
+        super().__init__(f"HTTP {status}: {body[:200]}")
+        self.status = status
+
+
+class Deadline:
+    """一次调用的总时间预算"""
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return self.expires - time.monotonic()
+
+    def check(self):
+        if self.remaining() <= 0:
+            raise LLMTimeout(f"超过截止时间（{self.seconds:g}s）")
+
+
+# ========= 2. 客户端 =========
+
+class LLMClient:
+    """线程安全；一个进程用一个实例（连接池和并发名额都是进程级的）"""
+
+    def __init__(self, base_url: str = DEFAULT_BASE_URL, api_key: str = "",
+                 pool_size: int = 32, max_concurrency: int = 16,
+                 connect_timeout: float = 3.0, retries: int = 2, backoff: float = 0.25):
+        self.base_url = base_url.rstrip("/")
+        self.url = self.base_url + "/chat/completions"
+        self.connect_timeout = connect_timeout
+        self.retries = retries
+        self.backoff = backoff
+
+        self.session = requests.Session()
+        # 重试由下面自己做（要受截止时间约束），urllib3 这一层不重试
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Content-Type": "application/json"})
+        if api_key:
+            self.session.headers["Authorization"] = f"Bearer {api_key}"
+
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        # 对冲请求在这里跑；调用方线程只负责等结果
+        self._hedge_pool = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="llm-hedge")
+
+    @classmethod
+    def from_env(cls) -> "LLMClient":
+        return cls(
+            base_url=_env("LLM_BASE_URL", "ZHIPUAI_BASE_URL", DEFAULT_BASE_URL),
+            api_key=_env("LLM_API_KEY", "ZHIPUAI_API_KEY"),
+            pool_size=int(_env("LLM_POOL_SIZE", default="32")),
+            max_concurrency=int(_env("LLM_MAX_CONCURRENCY", default="16")),
+            connect_timeout=float(_env("LLM_CONNECT_TIMEOUT", default="3")),
+            retries=int(_env("LLM_RETRIES", default="2")),
+            backoff=float(_env("LLM_BACKOFF", default="0.25")),
+        )
+
+    # ----- 基础设施 -----
+
+    @contextmanager
+    def _slot(self, deadline: Deadline):
+        if not self._slots.acquire(timeout=max(deadline.remaining(), 0)):
+            raise LLMBusy("大模型并发已满")
+        try:
+            yield
+        finally:
+            self._slots.release()
+
+    def _timeout(self, deadline: Deadline):
+        deadline.check()
+        remaining = deadline.remaining()
+        return (min(self.connect_timeout, remaining), remaining)
+
+    def _sleep_before_retry(self, attempt: int, deadline: Deadline):
+        """全抖动：在 [0, backoff * 2^attempt] 里随机等待，不超过剩余时间"""
+        delay = random.uniform(0, self.backoff * (2 ** attempt))
+        if delay >= deadline.remaining():
+            raise LLMTimeout("剩余时间不够再重试一次")
+        time.sleep(delay)
+
+    def _post(self, payload: Dict[str, Any], deadline: Deadline, stream: bool) -> requests.Response:
+        try:
+            resp = self.session.post(self.url, data=json.dumps(payload, ensure_ascii=False).encode("utf-8"),
+                                     timeout=self._timeout(deadline), stream=stream)
+        except requests.Timeout as e:
+            raise LLMTimeout(str(e)) from e
+        except requests.RequestException as e:
+            raise LLMError(str(e)) from e
+        if resp.status_code != 200:
+            body = resp.text
+            resp.close()
+            raise LLMHTTPError(resp.status_code, body)
+        return resp
+
+    @staticmethod
+    def _retryable(e: Exception) -> bool:
+        if isinstance(e, LLMHTTPError):
+            return e.status in RETRY_STATUS
+        return isinstance(e, LLMError) and not isinstance(e, LLMBusy)
+
+    def _with_retries(self, call: str, fn: Callable[[], Any], deadline: Deadline):
+        attempt = 0
+        while True:
+            try:
+                result = fn()
+                metrics.LLM_CALLS.inc(call=call, outcome="ok")
+                return result
+            except LLMError as e:
+                if attempt >= self.retries or not self._retryable(e) or deadline.remaining() <= 0:
+                    metrics.LLM_CALLS.inc(call=call, outcome=type(e).__name__)
+                    raise
+                metrics.LLM_CALLS.inc(call=call, outcome="retry")
+                self._sleep_before_retry(attempt, deadline)
+                attempt += 1
+
+    def _hedged(self, call: str, fn: Callable[[], Any], hedge_after: float, deadline: Deadline):
+        """
+        先发一份，hedge_after 秒内没结果再发一份；返回先成功的那份。
+        两份都失败时抛第一份的异常。输掉的那份不取消，跑完后自行丢弃。
+        """
+        first = self._hedge_pool.submit(fn)
+        done, _ = wait([first], timeout=min(hedge_after, max(deadline.remaining(), 0)))
+        if done:
+            return first.result()
+
+        metrics.LLM_CALLS.inc(call=call, outcome="hedge")
+        pending = {first, self._hedge_pool.submit(fn)}
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=max(deadline.remaining(), 0), return_when=FIRST_COMPLETED)
+            if not done:
+                raise LLMTimeout(f"超过截止时间（{deadline.seconds:g}s）")
+            for f in done:
+                try:
+                    return f.result()
+                except LLMError as e:
+                    error = error or e
+        raise error
+
+    # ----- 对外接口 -----
+
+    def chat(self, messages: List[Dict[str, str]], deadline: float, hedge_after: float = 0.0,
+             call: str = "chat", **params) -> str:
+        """
+        非流式调用，返回 choices[0].message.content。
+        deadline：总预算秒数；hedge_after > 0 时对每次尝试做对冲。
+        """
+        dl = Deadline(deadline)
+        payload = {"messages": messages, "stream": False, **params}
+
+        def once() -> str:
+            with self._slot(dl):
+                resp = self._post(payload, dl, stream=False)
+                try:
+                    data = resp.json()
+                    return data["choices"][0]["message"]["content"] or ""
+                except (ValueError, KeyError, IndexError, TypeError) as e:
+                    raise LLMError(f"无法解析的响应: {resp.text[:200]}") from e
+                finally:
+                    resp.close()
+
+        if hedge_after > 0:
+            return self._with_retries(call, lambda: self._hedged(call, once, hedge_after, dl), dl)
+        return self._with_retries(call, once, dl)
+
+    def chat_stream(self, messages: List[Dict[str, str]], deadline: float,
+                    call: str = "chat_stream", **params) -> Iterator[str]:
+        """
+        流式调用（SSE），逐段 yield delta.content。
+        并发名额一直占到流结束（或调用方提前关闭生成器）。
+        """
+        dl = Deadline(deadline)
+        payload = {"messages": messages, "stream": True, **params}
+
+        with self._slot(dl):
+            resp = self._with_retries(call, lambda: self._post(payload, dl, stream=True), dl)
+            try:
+                for line in resp.iter_lines(decode_unicode=False):
+                    dl.check()
+                    if not line or not line.startswith(b"data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == b"[DONE]":
+                        break
+                    try:
+                        chunk = json.loads(data)
+                    except ValueError:
+                        continue
+                    for choice in chunk.get("choices") or []:
+                        piece = (choice.get("delta") or {}).get("content")
+                        if piece:
+                            yield piece
+            except requests.RequestException as e:
+                raise LLMError(str(e)) from e
+            finally:
+                resp.close()
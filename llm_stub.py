@@ -0,0 +1,157 @@
+# llm_stub.py
+# -*- coding: utf-8 -*-
+"""
+llm_stub.py
+
+本地假的大模型服务（OpenAI / 智谱兼容的 POST .../chat/completions），用于离线压测和调试：
+
+- 查询分析请求（system prompt 是查询理解助手）：返回一个合法的分析 JSON，search_query 取用户查询
+- 其它请求：返回一段固定的中文回答；stream=true 时按 SSE 分块推送，最后 data: [DONE]
+- 延迟可配置：每次请求先等 latency ± jitter 秒，流式时每块再等 token_delay 秒
+
+单独运行：python llm_stub.py --port 8001 --latency 0.3
+然后让 llm.py 指向它：LLM_BASE_URL=http://127.0.0.1:8001/api/paas/v4
+"""
+
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ANSWER_TEXT = (
+    "这是本地桩服务返回的回答，用于压测检索与回答生成链路的耗时。"
+    "它不代表真实模型的输出，只保证长度和分块方式与真实回答大致相当。"
+) * 4
+
+
+def _analysis_for(query: str) -> dict:
+    return {
+        "query_type": "question",
+        "intent": "ask_story_detail",
+        "search_query": query,
+        "keywords": [w for w in query.split() if w][:4],
+        "need_original_text": False,
+    }
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    # 由 StubLLMServer 设置
+    latency = 0.3
+    jitter = 0.1
+    token_delay = 0.02
+    chunk_chars = 8
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _sleep(self, seconds: float):
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_error(404)
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self.send_error(400)
+            return
+
+        messages = body.get("messages") or []
+        system = next((m.get("content", "") for m in messages if m.get("role") == "system"), "")
+        user = next((m.get("content", "") for m in reversed(messages) if m.get("role") == "user"), "")
+        if "查询理解助手" in system:
+            text = json.dumps(_analysis_for(user), ensure_ascii=False)
+        else:
+            text = ANSWER_TEXT
+
+        self._sleep(self.latency + random.uniform(-self.jitter, self.jitter))
+        model = body.get("model", "stub")
+        created = int(time.time())
+
+        if body.get("stream"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            for i in range(0, len(text), self.chunk_chars):
+                chunk = {"id": "stub", "created": created, "model": model,
+                         "choices": [{"index": 0, "delta": {"role": "assistant",
+                                                            "content": text[i:i + self.chunk_chars]}}]}
+                self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+                self._sleep(self.token_delay)
+            done = {"id": "stub", "created": created, "model": model,
+                    "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+            self.wfile.write(f"data: {json.dumps(done)}\n\ndata: [DONE]\n\n".encode("utf-8"))
+            self.wfile.flush()
+            self.close_connection = True
+            return
+
+        payload = json.dumps({
+            "id": "stub", "created": created, "model": model, "object": "chat.completion",
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": text}}],
+            "usage": {"prompt_tokens": len(user), "completion_tokens": len(text),
+                      "total_tokens": len(user) + len(text)},
+        }, ensure_ascii=False).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class StubLLMServer:
+    """在后台线程里跑的桩服务；port=0 时自动选一个空闲端口"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0,
+                 latency: float = 0.3, jitter: float = 0.1, token_delay: float = 0.02):
+        handler = type("ConfiguredStubHandler", (StubHandler,), {
+            "latency": latency, "jitter": jitter, "token_delay": token_delay,
+        })
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/api/paas/v4"
+
+    def start(self) -> "StubLLMServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="llm-stub", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地大模型桩服务（chat/completions）")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=0.3, help="每次请求的基础延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.1, help="延迟随机抖动（秒）")
+    parser.add_argument("--token-delay", type=float, default=0.02, help="流式每块之间的延迟（秒）")
+    args = parser.parse_args()
+
+    server = StubLLMServer(args.host, args.port, args.latency, args.jitter, args.token_delay)
+    print(f"LLM 桩服务: {server.base_url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
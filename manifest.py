@@ -0,0 +1,105 @@
+# manifest.py
+# -*- coding: utf-8 -*-
+"""
+manifest.py
+
+增量构建用的内容哈希清单：
+
+- chapter_hash：一章（id / book / chapter / content）的内容哈希，任何一个字变了哈希就变
+- dict_hash：分词词典（vocab.txt）+ jieba 版本 + 索引结构版本的哈希，变了就必须全量重建
+- 清单（index/manifest.json）记录上一次成功提交到索引时的 dict_hash 和每章哈希，
+  build_index.py 据此只重新切分、分词、updateDocument 有变化的章节
+"""
+
+import os
+import json
+import hashlib
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+MANIFEST_NAME = "manifest.json"
+
+# Lucene 索引目录（build_index / search 共用）；放在这里是为了让只需要索引版本的地方
+# （如 llm.py 的缓存清理）不必 import search 而拉起 PyLucene 和 jieba
+INDEX_DIR = "index"
+
+# 索引里 Document 的字段结构有变化时加 1，强制全量重建
+INDEX_SCHEMA_VERSION = 2
+
+
+# ========= 1. 哈希 =========
+
+def chapter_hash(doc: Dict[str, Any]) -> str:
+    """章节内容哈希：只包含会写进索引的字段"""
+    h = hashlib.sha1()
+    for key in ("id", "book", "chapter", "content"):
+        h.update(str(doc.get(key, "") or "").encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def file_hash(path: str) -> str:
+    """文件内容哈希；文件不存在时返回空串"""
+    h = hashlib.sha1()
+    try:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 16), b""):
+                h.update(block)
+    except OSError:
+        return ""
+    return h.hexdigest()
+
+
+def dict_hash(user_dict_path: str) -> str:
+    """分词结果取决于词典和 jieba 版本；再加上索引结构版本"""
+    try:
+        import jieba
+        jieba_version = getattr(jieba, "__version__", "")
+    except ImportError:
+        jieba_version = ""
+    parts = [file_hash(user_dict_path), jieba_version, str(INDEX_SCHEMA_VERSION)]
+    return hashlib.sha1("\0".join(parts).encode("utf-8")).hexdigest()
+
+
+# ========= 2. 清单读写 =========
+
+def manifest_path(index_dir: str) -> str:
+    return os.path.join(index_dir, MANIFEST_NAME)
+
+
+def load_manifest(index_dir: str) -> Optional[Dict[str, Any]]:
+    """读不到或格式不对时返回 None（视为需要全量重建）"""
+    try:
+        with open(manifest_path(index_dir), "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(data, dict) or not isinstance(data.get("chapters"), dict):
+        return None
+    return data
+
+
+def save_manifest(index_dir: str, dict_digest: str, chapters: Dict[str, str]):
+    """先写临时文件再 rename，避免中途失败留下半个清单"""
+    path = manifest_path(index_dir)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"dict_hash": dict_digest, "chapters": chapters}, f,
+                  ensure_ascii=False, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+# ========= 3. 比较 =========
+
+def chapter_hashes(docs: Iterable[Dict[str, Any]]) -> Dict[str, str]:
+    return {str(d.get("id")): chapter_hash(d) for d in docs}
+
+
+def diff_chapters(old: Dict[str, str], new: Dict[str, str]) -> Tuple[List[str], List[str]]:
+    """
+    返回 (changed, removed)：
+      - changed：新增或内容变了的章节 id
+      - removed：清单里有、新语料里没有的章节 id
+    """
+    changed = [doc_id for doc_id, h in new.items() if old.get(doc_id) != h]
+    removed = [doc_id for doc_id in old if doc_id not in new]
+    return changed, removed
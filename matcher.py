@@ -0,0 +1,165 @@
+# matcher.py
+# -*- coding: utf-8 -*-
+"""
+matcher.py
+
+多关键词单遍匹配：
+
+- 每次查询构建一次 TermMatcher（关键词 + 权重），对每个段落/句子只扫描一遍
+- 一次扫描同时得到：命中了哪些词（用于 match_score）、高亮区间（用于 [term] 高亮）
+- 有 pyahocorasick 时用 Aho-Corasick 自动机；没有时退回到一个带前瞻的正则，结果一致
+
+高亮规则与原来的 re.compile("|".join(terms)).sub(...) 一致：
+从左到右，同一位置按 terms 的顺序取第一个能匹配的词，高亮区间互不重叠。
+"""
+
+import re
+from typing import List, Dict, Tuple, Iterable, Optional
+
+HAS_AHOCORASICK = False
+try:
+    import ahocorasick
+    HAS_AHOCORASICK = True
+except ImportError:
+    ahocorasick = None
+
+
+class ScanResult:
+    """一次扫描的结果"""
+
+    __slots__ = ("found", "spans", "score")
+
+    def __init__(self, found: set, spans: List[Tuple[int, int]], score: float):
+        self.found = found    # 命中的关键词集合
+        self.spans = spans    # 高亮区间 [(start, end), ...]，已按位置排序、互不重叠
+        self.score = score    # 命中关键词的权重和（有基础分时再加上 bonus）
+
+
+class TermMatcher:
+    """
+    terms: 关键词，顺序即高亮优先级（同一位置先匹配排在前面的词）
+    weights: 关键词 → 权重，不在其中的词权重为 0（只高亮、不计分）
+    bonus: 关键词 → 额外加分，只有基础分 > 0 时才加（如 snippet 整句）
+    """
+
+    def __init__(self, terms: Iterable[str],
+                 weights: Optional[Dict[str, float]] = None,
+                 bonus: Optional[Dict[str, float]] = None):
+        seen = set()
+        self.terms: List[str] = []
+        for t in terms:
+            if t and t not in seen:
+                seen.add(t)
+                self.terms.append(t)
+        for t in list(weights or {}) + list(bonus or {}):
+            if t and t not in seen:
+                seen.add(t)
+                self.terms.append(t)
+
+        self.weights = [float((weights or {}).get(t, 0.0)) for t in self.terms]
+        self.bonus = [float((bonus or {}).get(t, 0.0)) for t in self.terms]
+
+        self._automaton = None
+        self._regex = None
+        # 正则后端：同一位置只会报出优先级最高的词，被它“遮住”的词要补回来：
+        #   - 它的前缀词一定也命中
+        #   - 以它开头的更长的词需要在该位置再验证一下
+        self._prefixes: List[List[int]] = []
+        self._extensions: List[List[int]] = []
+
+        if not self.terms:
+            return
+        if HAS_AHOCORASICK:
+            a = ahocorasick.Automaton()
+            for i, t in enumerate(self.terms):
+                a.add_word(t, (i, len(t)))
+            a.make_automaton()
+            self._automaton = a
+        else:
+            alt = "|".join(f"({re.escape(t)})" for t in self.terms)
+            self._regex = re.compile(f"(?=(?:{alt}))")
+            self._prefixes = [
+                [j for j, u in enumerate(self.terms) if j != i and t.startswith(u)]
+                for i, t in enumerate(self.terms)
+            ]
+            self._extensions = [
+                [j for j, u in enumerate(self.terms) if j != i and u.startswith(t)]
+                for i, t in enumerate(self.terms)
+            ]
+
+    def __bool__(self) -> bool:
+        return bool(self.terms)
+
+    # ----- 底层：所有命中位置 -----
+
+    def _first_at_each_position(self, text: str) -> Tuple[Dict[int, int], set]:
+        """
+        返回 ({start: 该位置优先级最高的词下标}, 命中词下标集合)
+        """
+        best: Dict[int, int] = {}
+        found = set()
+        if self._automaton is not None:
+            for end, (i, n) in self._automaton.iter(text):
+                found.add(i)
+                start = end - n + 1
+                j = best.get(start)
+                if j is None or i < j:
+                    best[start] = i
+        elif self._regex is not None:
+            for m in self._regex.finditer(text):
+                i = m.lastindex - 1
+                start = m.start()
+                best[start] = i
+                found.add(i)
+                found.update(self._prefixes[i])
+                for j in self._extensions[i]:
+                    if j not in found and text.startswith(self.terms[j], start):
+                        found.add(j)
+        return best, found
+
+    # ----- 对外接口 -----
+
+    def scan(self, text: str) -> ScanResult:
+        """扫描一遍，同时给出命中词、高亮区间和分数"""
+        best, found_idx = self._first_at_each_position(text)
+
+        spans = []
+        last_end = 0
+        for start in sorted(best):
+            if start < last_end:
+                continue
+            end = start + len(self.terms[best[start]])
+            spans.append((start, end))
+            last_end = end
+
+        score = sum(self.weights[i] for i in found_idx)
+        if score > 0:
+            score += sum(self.bonus[i] for i in found_idx)
+
+        return ScanResult({self.terms[i] for i in found_idx}, spans, score)
+
+    def term_weights(self) -> Dict[str, float]:
+        """计分的词 → 权重（不含只高亮的词）"""
+        return {t: w for t, w in zip(self.terms, self.weights) if w}
+
+    def bonus_terms(self) -> Dict[str, float]:
+        """有额外加分的词 → 加分"""
+        return {t: b for t, b in zip(self.terms, self.bonus) if b}
+
+    def score(self, text: str) -> float:
+        return self.scan(text).score
+
+    def highlight(self, text: str, spans: Optional[List[Tuple[int, int]]] = None) -> str:
+        """命中的词用 [term] 包起来；已有 scan 结果时直接传 spans，避免再扫一遍"""
+        if spans is None:
+            spans = self.scan(text).spans
+        if not spans:
+            return text
+        parts = []
+        pos = 0
+        for s, e in spans:
+            parts.append(text[pos:s])
+            parts.append(f"[{text[s:e]}]")
+            pos = e
+        parts.append(text[pos:])
+        return "".join(parts)
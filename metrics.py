@@ -0,0 +1,271 @@
+# metrics.py
+# -*- coding: utf-8 -*-
+"""
+metrics.py
+
+进程内指标，Prometheus 文本格式导出（/metrics）：
+
+- span(stage)：给一段代码计时，写入 threebody_stage_seconds{stage=...} 直方图；
+  同一线程里嵌套的 span 只记“独占”时间（外层扣掉内层），各阶段相加约等于总耗时
+- 每个请求一个 RequestTimings（contextvars），span 同时累加进去，
+  app.py 在请求带调试头时把它放进响应；提交到线程池的任务用 bind_context 带上当前请求
+- Histogram / Counter：带标签的简单实现，线程安全
+- register_collector：抓取时才计算的指标（缓存命中率、JVM 堆 / GC 等）
+"""
+
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0)
+
+# 一条样本：(指标名, 标签, 值)
+Sample = Tuple[str, Dict[str, str], float]
+
+
+# ========= 1. 指标类型 =========
+
+def _label_str(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    parts = []
+    for k, v in labels.items():
+        v = str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        parts.append(f'{k}="{v}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def _fmt(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class Histogram:
+    """带标签的直方图：observe(seconds, label=value...)"""
+
+    def __init__(self, name: str, help: str, label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._series: Dict[tuple, list] = {}   # labels → [bucket counts..., sum, count]
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.label_names)
+        with self._lock:
+            s = self._series.get(key)
+            if s is None:
+                s = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, b in enumerate(self.buckets):
+                if value <= b:
+                    s[i] += 1
+            s[-2] += value
+            s[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = [(k, list(v)) for k, v in self._series.items()]
+        for key, s in sorted(series):
+            labels = dict(zip(self.label_names, key))
+            for b, n in zip(self.buckets, s):
+                lines.append(f"{self.name}_bucket{_label_str({**labels, 'le': _fmt(b)})} {n}")
+            lines.append(f"{self.name}_bucket{_label_str({**labels, 'le': '+Inf'})} {s[-1]}")
+            lines.append(f"{self.name}_sum{_label_str(labels)} {_fmt(s[-2])}")
+            lines.append(f"{self.name}_count{_label_str(labels)} {s[-1]}")
+        return lines
+
+
+class Counter:
+    """带标签的计数器"""
+
+    def __init__(self, name: str, help: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, v in items:
+            lines.append(f"{self.name}{_label_str(dict(zip(self.label_names, key)))} {_fmt(v)}")
+        return lines
+
+
+STAGE_SECONDS = Histogram("threebody_stage_seconds", "各阶段耗时（秒，嵌套时为独占时间）", ["stage"])
+REQUEST_SECONDS = Histogram("threebody_request_seconds", "请求总耗时（秒，流式为整个流）", ["endpoint"])
+REQUESTS_TOTAL = Counter("threebody_requests_total", "请求数", ["endpoint", "status"])
+LLM_CALLS = Counter("threebody_llm_calls_total", "大模型调用结果（ok / retry / hedge / 异常类名）",
+                    ["call", "outcome"])
+
+ANALYSIS_SOURCE = Counter("threebody_analysis_total", "查询分析结果来源（cache / local / llm）", ["source"])
+
+_METRICS = [STAGE_SECONDS, REQUEST_SECONDS, REQUESTS_TOTAL, LLM_CALLS, ANALYSIS_SOURCE]
+
+
+# ========= 2. 请求级计时 =========
+
+class RequestTimings:
+    """一个请求里各阶段的累计耗时（可能在多个线程里写入）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stages: Dict[str, float] = {}
+        self.started = time.perf_counter()
+
+    def add(self, stage: str, seconds: float):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def as_dict(self) -> Dict[str, float]:
+        """毫秒，保留一位小数；total 为请求开始到现在"""
+        with self._lock:
+            out = {k: round(v * 1000, 1) for k, v in self.stages.items()}
+        out["total"] = round((time.perf_counter() - self.started) * 1000, 1)
+        return out
+
+
+_current: contextvars.ContextVar = contextvars.ContextVar("request_timings", default=None)
+_local = threading.local()
+
+
+def start_request() -> RequestTimings:
+    timings = RequestTimings()
+    _current.set(timings)
+    return timings
+
+
+def bind_request(timings: Optional[RequestTimings]):
+    """在别的上下文里（如流式响应的生成器）继续记到同一个请求上"""
+    _current.set(timings)
+
+
+def current_timings() -> Optional[RequestTimings]:
+    return _current.get()
+
+
+def bind_context(fn: Callable) -> Callable:
+    """把当前上下文（含正在处理的请求）带进线程池任务：pool.submit(bind_context(fn), ...)"""
+    ctx = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        return ctx.run(fn, *args, **kwargs)
+    return run
+
+
+@contextmanager
+def span(stage: str):
+    """阶段计时；嵌套时外层只记扣掉内层后的时间"""
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    stack.append(0.0)
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - t0
+        child = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+        own = max(elapsed - child, 0.0)
+        STAGE_SECONDS.observe(own, stage=stage)
+        timings = _current.get()
+        if timings is not None:
+            timings.add(stage, own)
+
+
+# ========= 3. 抓取时计算的指标 =========
+
+# collector() -> [(name, type, help, [(labels, value), ...]), ...]
+Family = Tuple[str, str, str, List[Tuple[Dict[str, str], float]]]
+_collectors: List[Callable[[], Iterable[Family]]] = []
+
+
+def register_collector(fn: Callable[[], Iterable[Family]]):
+    _collectors.append(fn)
+
+
+def cache_families(name: str, stats: Dict[str, float]) -> List[Family]:
+    """把 LRUCache / SQLiteCache 的 stats() 转成指标"""
+    labels = {"cache": name}
+    out = [
+        ("threebody_cache_hits_total", "counter", "缓存命中次数", [(labels, stats.get("hits", 0))]),
+        ("threebody_cache_misses_total", "counter", "缓存未命中次数", [(labels, stats.get("misses", 0))]),
+        ("threebody_cache_hit_ratio", "gauge", "缓存命中率", [(labels, stats.get("hit_rate", 0.0))]),
+        ("threebody_cache_entries", "gauge", "缓存条目数", [(labels, stats.get("entries", 0))]),
+    ]
+    if "evictions" in stats:
+        out.append(("threebody_cache_evictions_total", "counter", "缓存淘汰次数",
+                    [(labels, stats["evictions"])]))
+    return out
+
+
+def jvm_families() -> List[Family]:
+    """
+    JVM 堆和 GC 统计，必须在已 attach JVM 的线程里调用。
+    PyLucene 没有包装 java.lang.management 时只给出 Runtime 的堆数据。
+    """
+    out: List[Family] = []
+    try:
+        from java.lang import Runtime
+        rt = Runtime.getRuntime()
+        total, free, max_ = rt.totalMemory(), rt.freeMemory(), rt.maxMemory()
+        out.append(("threebody_jvm_heap_bytes", "gauge", "JVM 堆内存",
+                    [({"area": "used"}, total - free), ({"area": "committed"}, total),
+                     ({"area": "max"}, max_)]))
+    except Exception:
+        return out
+    try:
+        from java.lang.management import ManagementFactory
+        counts, times = [], []
+        for gc in ManagementFactory.getGarbageCollectorMXBeans():
+            labels = {"gc": gc.getName()}
+            counts.append((labels, gc.getCollectionCount()))
+            times.append((labels, gc.getCollectionTime() / 1000.0))
+        out.append(("threebody_jvm_gc_collections_total", "counter", "JVM GC 次数", counts))
+        out.append(("threebody_jvm_gc_seconds_total", "counter", "JVM GC 累计耗时（秒）", times))
+    except Exception:
+        pass
+    return out
+
+
+def _render_family(name: str, kind: str, help: str, samples) -> List[str]:
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    for labels, value in samples:
+        lines.append(f"{name}{_label_str(labels)} {_fmt(value)}")
+    return lines
+
+
+def render() -> str:
+    """Prometheus 文本格式（text/plain; version=0.0.4）"""
+    lines: List[str] = []
+    for m in _METRICS:
+        lines.extend(m.render())
+
+    # 同名指标（如多个缓存）合并到一个 family 下
+    families: Dict[str, list] = {}
+    for collect in _collectors:
+        try:
+            for name, kind, help, samples in collect():
+                fam = families.setdefault(name, [kind, help, []])
+                fam[2].extend(samples)
+        except Exception as e:
+            lines.append(f"# collector error: {type(e).__name__}: {e}")
+    for name, (kind, help, samples) in families.items():
+        lines.extend(_render_family(name, kind, help, samples))
+    return "\n".join(lines) + "\n"
@@ -1,9 +1,14 @@
 # prepare_docs.py
 # -*- coding: utf-8 -*-
+import os
 import re
-from typing import List, Dict
+import json
+from typing import List, Dict, Optional
+
+from manifest import chapter_hashes, diff_chapters
 
 ALL_FILE = "threebody.txt"
+OUT_FILE = "threebody.json"
 
 
 # ====== 三体1 ======
@@ -210,14 +215,41 @@ def load_all_docs() -> List[Dict]:
     return docs
 
 
+def write_docs_if_changed(docs: List[Dict], path: str = OUT_FILE) -> Optional[List[str]]:
+    """
+    只有章节内容有变化时才重写 threebody.json（先写临时文件再 rename），
+    文件的 mtime 不变，下游 build_index.py / search.py 就不会做无用功。
+    返回新增或内容变化的章节 id；文件没有重写时返回 None。
+    """
+    old_docs = None
+    if os.path.exists(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                old_docs = json.load(f)
+        except ValueError:
+            old_docs = None
+
+    if old_docs == docs:
+        return None
+
+    changed, removed = diff_chapters(chapter_hashes(old_docs or []), chapter_hashes(docs))
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(docs, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+    if removed:
+        print("Removed chapters:", ", ".join(removed))
+    return changed
+
+
 if __name__ == "__main__":
     docs = load_all_docs()
     print("Total docs:", len(docs))
     for d in docs[:5]:
         print(d["book"], d["chapter"][:30])
 
-    import json
-    with open("threebody.json", "w", encoding="utf-8") as f:
-        json.dump(docs, f, ensure_ascii=False, indent=2)
-
-
+    changed = write_docs_if_changed(docs)
+    if changed is None:
+        print(f"{OUT_FILE} unchanged")
+    else:
+        print(f"{OUT_FILE} updated, changed chapters:", ", ".join(changed) or "(none)")
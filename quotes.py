@@ -0,0 +1,281 @@
+# quotes.py
+# -*- coding: utf-8 -*-
+"""
+quotes.py
+
+全语料的原文引用定位：字符级后缀数组，文件 threebody.quotes（由 threebody.corpus 生成）
+
+- 归一化：NFKC、转小写，只保留文字和数字（标点、空白、引号都去掉），
+  “前进，前进，不择手段地前进！”和“前进前进 不择手段地前进”视为同一串
+- 归一化后的全文按 UTF-32BE 存放：字节序比较 = 码点序比较，二分查找时直接比较 mmap 切片，不用解码
+- 后缀数组按前 SORT_PREFIX 个字符排序；更长的查询先按前缀定位，再逐个校验全串
+- 每个归一化字符记下它在语料原文块里的字节偏移，命中后用 CorpusStore.locate
+  换算成 章节 / 段落 / 句子；章节之间插入分隔符，命中不会跨章
+
+查询耗时 O(m log n)（m 为查询长度），与命中在哪一章、Lucene 排名无关。
+"""
+
+import os
+import sys
+import json
+import mmap
+import struct
+import unicodedata
+from array import array
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from corpus import CorpusStore, CORPUS_PATH, read_source_hash, _u32_bytes, _pad8
+
+QUOTES_PATH = "threebody.quotes"
+
+MAGIC = b"TBQUOTES"
+FORMAT_VERSION = 1
+
+# magic, version, n_chars, meta_off, meta_len, text_off, sa_off, sa_len, origin_off
+HEADER = struct.Struct("<8sIIQQQQQQ")
+
+# 后缀排序时比较的前缀长度（字符）
+SORT_PREFIX = 48
+# 章节分隔符：归一化后的查询里不会出现
+SEPARATOR = "\0"
+# 归一化后短于这个长度的查询不查（太短的串到处都是）
+MIN_QUOTE_CHARS = 4
+
+
+# ========= 1. 归一化 =========
+
+def _normalized_chars(ch: str) -> str:
+    out = []
+    for c in unicodedata.normalize("NFKC", ch).lower():
+        if unicodedata.category(c)[0] in "LN":
+            out.append(c)
+    return "".join(out)
+
+
+def normalize_quote(text: str) -> str:
+    """查询和语料用同一套归一化"""
+    return "".join(_normalized_chars(ch) for ch in (text or ""))
+
+
+class QuoteHit:
+    """一处命中：起止句子（含），以及在语料原文块里的字节偏移"""
+
+    __slots__ = ("doc_id", "paragraph", "sentence", "end_paragraph", "end_sentence", "offset")
+
+    def __init__(self, doc_id: str, paragraph: int, sentence: int,
+                 end_paragraph: int, end_sentence: int, offset: int):
+        self.doc_id = doc_id
+        self.paragraph = paragraph
+        self.sentence = sentence
+        self.end_paragraph = end_paragraph
+        self.end_sentence = end_sentence
+        self.offset = offset
+
+    def to_dict(self) -> Dict[str, object]:
+        return {k: getattr(self, k) for k in self.__slots__}
+
+
+# ========= 2. 生成索引文件 =========
+
+def build_quote_index(store: CorpusStore, path: str = QUOTES_PATH):
+    """从已打开的语料生成后缀数组文件（先写临时文件再 rename）"""
+    chars: List[str] = []
+    origin = array("I")
+    for record in store.records():
+        doc_id = record["id"]
+        start, end = store.text_range(doc_id)
+        pos = start
+        for ch in store.text(doc_id):
+            for c in _normalized_chars(ch):
+                chars.append(c)
+                origin.append(pos)
+            pos += len(ch.encode("utf-8"))
+        chars.append(SEPARATOR)
+        origin.append(end)
+    text = "".join(chars)
+
+    # 按首字符分桶后桶内排序，避免一次性为所有位置生成排序键
+    buckets: Dict[str, List[int]] = {}
+    for i, c in enumerate(text):
+        if c != SEPARATOR:
+            buckets.setdefault(c, []).append(i)
+    sa = array("I")
+    for c in sorted(buckets):
+        positions = buckets[c]
+        positions.sort(key=lambda i: text[i:i + SORT_PREFIX])
+        sa.extend(positions)
+
+    meta = json.dumps({"source_hash": store.source_hash, "sort_prefix": SORT_PREFIX}).encode("utf-8")
+    blob = text.encode("utf-32-be")
+
+    meta_off = HEADER.size
+    text_off = _pad8(meta_off + len(meta))
+    sa_off = _pad8(text_off + len(blob))
+    origin_off = _pad8(sa_off + 4 * len(sa))
+
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(text), meta_off, len(meta),
+                            text_off, sa_off, len(sa), origin_off))
+        for off, data in ((meta_off, meta), (text_off, blob),
+                          (sa_off, _u32_bytes(sa)), (origin_off, _u32_bytes(origin))):
+            f.write(b"\0" * (off - f.tell()))
+            f.write(data)
+    os.replace(tmp, path)
+
+
+def _read_meta(path: str) -> Optional[dict]:
+    try:
+        with open(path, "rb") as f:
+            head = f.read(HEADER.size)
+            if len(head) < HEADER.size:
+                return None
+            fields = HEADER.unpack(head)
+            if fields[0] != MAGIC or fields[1] != FORMAT_VERSION:
+                return None
+            f.seek(fields[3])
+            return json.loads(f.read(fields[4]).decode("utf-8"))
+    except (OSError, ValueError):
+        return None
+
+
+def ensure_quote_index(corpus_path: str = CORPUS_PATH, path: str = QUOTES_PATH,
+                       store: Optional[CorpusStore] = None) -> bool:
+    """索引文件不存在、或不是由当前语料文件生成的，就重新生成；返回是否重新生成了"""
+    source_hash = read_source_hash(corpus_path)
+    meta = _read_meta(path)
+    if meta is not None and meta.get("source_hash") == source_hash \
+            and meta.get("sort_prefix") == SORT_PREFIX:
+        return False
+    if store is None or store.source_hash != source_hash:
+        store = CorpusStore(corpus_path)
+    build_quote_index(store, path)
+    print(f"[quotes] 已生成 {path}")
+    return True
+
+
+# ========= 3. 查询 =========
+
+class _MappedQuotes:
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, n_chars, meta_off, meta_len,
+         text_off, sa_off, sa_len, origin_off) = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise RuntimeError(f"引用索引格式不对: {path}")
+        meta = json.loads(self.mm[meta_off:meta_off + meta_len].decode("utf-8"))
+        self.source_hash = meta.get("source_hash", "")
+        self.sort_prefix = meta.get("sort_prefix", SORT_PREFIX)
+        self.n_chars = n_chars
+        self.text_off = text_off
+        self.sa = self._table(sa_off, sa_len)
+        self.origin = self._table(origin_off, n_chars)
+
+    def _table(self, off: int, n: int):
+        if sys.byteorder == "little":
+            return memoryview(self.mm)[off:off + 4 * n].cast("I")
+        values = array("I", self.mm[off:off + 4 * n])
+        values.byteswap()
+        return values
+
+    def key(self, pos: int, n: int) -> bytes:
+        """从 pos 开始的 n 个归一化字符（UTF-32BE 字节）"""
+        start = self.text_off + 4 * pos
+        end = self.text_off + 4 * min(pos + n, self.n_chars)
+        return self.mm[start:end]
+
+    def range(self, qb: bytes, n: int) -> Tuple[int, int]:
+        """前 n 个字符等于 qb 的后缀在 sa 里的区间 [lo, hi)"""
+        sa = self.sa
+        lo, hi = 0, len(sa)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(sa[mid], n) < qb:
+                lo = mid + 1
+            else:
+                hi = mid
+        first = lo
+        hi = len(sa)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(sa[mid], n) <= qb:
+                lo = mid + 1
+            else:
+                hi = mid
+        return first, lo
+
+
+class QuoteIndex:
+    """
+    find(query) → 精确出现位置（按在语料中的先后顺序）；
+    find(query, doc_ids=检索排名的章节) → 每章第一处，按章节排名排序后再截断。
+    open() 换新文件时只替换内部映射，与 CorpusStore 一致。
+    """
+
+    def __init__(self, path: Optional[str] = None, store: Optional[CorpusStore] = None):
+        self._m: Optional[_MappedQuotes] = None
+        self.store = store
+        if path:
+            self.open(path)
+
+    def open(self, path: str = QUOTES_PATH, store: Optional[CorpusStore] = None):
+        self._m = _MappedQuotes(path)
+        if store is not None:
+            self.store = store
+
+    def __bool__(self) -> bool:
+        return self._m is not None
+
+    def find(self, query: str, limit: int = 50,
+             doc_ids: Optional[Sequence[str]] = None) -> List[QuoteHit]:
+        """
+        doc_ids：候选章节（按检索排名）。给出时每章只留第一处，先按排名、再按语料顺序
+        （不在 doc_ids 里的章节排最后）排好再取前 limit 个，常见引用不会因为语料顺序靠后被截掉
+        """
+        m, store = self._m, self.store
+        q = normalize_quote(query)
+        if m is None or store is None or len(q) < MIN_QUOTE_CHARS:
+            return []
+        n = len(q)
+        k = min(n, m.sort_prefix)
+        qb = q.encode("utf-32-be")
+        lo, hi = m.range(qb[:4 * k], k)
+
+        positions = []
+        for j in range(lo, hi):
+            p = m.sa[j]
+            # 超过排序前缀的部分逐个校验
+            if n > k and m.key(p, n) != qb:
+                continue
+            positions.append(p)
+        positions.sort()
+
+        if doc_ids is None:
+            positions = positions[:limit]
+        hits = []
+        seen = set()
+        for p in positions:
+            start = store.locate(m.origin[p])
+            if start is None or (doc_ids is not None and start[0] in seen):
+                continue
+            end = store.locate(m.origin[p + n - 1])
+            if end is None:
+                continue
+            seen.add(start[0])
+            hits.append(QuoteHit(start[0], start[1], start[2], end[1], end[2], m.origin[p]))
+        if doc_ids is not None:
+            rank = {str(d): i for i, d in enumerate(doc_ids)}
+            # sort 是稳定的：同一排名（都不在 doc_ids 里）的仍按语料顺序
+            hits.sort(key=lambda h: rank.get(h.doc_id, len(rank)))
+            hits = hits[:limit]
+        return hits
+
+
+if __name__ == "__main__":
+    store = CorpusStore(CORPUS_PATH)
+    ensure_quote_index(CORPUS_PATH, QUOTES_PATH, store)
+    index = QuoteIndex(QUOTES_PATH, store)
+    for q in sys.argv[1:] or ["前进，前进，不择手段地前进！"]:
+        for hit in index.find(q):
+            print(q, hit.to_dict(), store.sentence(hit.doc_id, hit.sentence))
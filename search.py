@@ -14,61 +14,284 @@ search.py
 """
 
 import os
-import re
-import json
-from typing import List, Dict, Any
+import math
+import time
+import heapq
+import threading
+from array import array
+from collections import Counter
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import List, Dict, Any, Iterable, Iterator, Optional, Tuple
 
-import jieba
 import lucene
 from java.nio.file import Paths
-from org.apache.lucene.store import FSDirectory
-from org.apache.lucene.index import DirectoryReader
-from org.apache.lucene.search import IndexSearcher
-from org.apache.lucene.analysis.core import WhitespaceAnalyzer
-from org.apache.lucene.queryparser.classic import QueryParser
-
-
+from org.apache.lucene.store import MMapDirectory
+from org.apache.lucene.index import DirectoryReader, Term
+from org.apache.lucene.search import (
+    IndexSearcher, TermQuery, BooleanQuery, BooleanClause, BoostQuery, PhraseQuery,
+    ConstantScoreQuery, DocIdSetIterator,
+)
+
+from segments import paragraph_spans, sentence_spans, normalize_sentence
+from corpus import CorpusStore, ensure_corpus, CORPUS_PATH
+from quotes import QuoteIndex, ensure_quote_index, QUOTES_PATH
+from unit_matrix import UnitMatrix, UNITS_PATH
+from matcher import TermMatcher
+from cache import LRUCache, normalize_query, index_signature
+from tokens import tokenize, tokenize_many, init_jieba
+from metrics import span, bind_context
+from manifest import INDEX_DIR
+
+
+# 自定义词典在 init_search() 里经 tokens.init_jieba 加载一次
 USER_DICT = "vocab.txt"
-if os.path.exists(USER_DICT):
-    print(f"[jieba] 加载自定义词典: {USER_DICT}")
-    jieba.load_userdict(USER_DICT)
-else:
-    print(f"[jieba] 未找到自定义词典 {USER_DICT}，仅使用默认词典")
 
 
 # ========= 1. 初始化 Lucene Searcher =========
 
-def init_searcher(index_dir: str = "index") -> IndexSearcher:
-    """初始化 PyLucene 和 IndexSearcher"""
+# JVM 参数，多 worker 部署时用 LUCENE_VMARGS 控制每个进程的堆大小，如 "-Xms256m,-Xmx512m"
+LUCENE_VMARGS = os.environ.get("LUCENE_VMARGS", "")
+
+
+def init_searcher(index_dir: str = INDEX_DIR) -> IndexSearcher:
+    """
+    初始化 PyLucene 和 IndexSearcher。
+    索引用 MMapDirectory 打开：多个 worker 进程读同一份索引文件时共享页缓存，不各自拷一份到堆里。
+    """
     try:
         env = lucene.getVMEnv()
     except Exception:
         env = None
     if env is None:
-        lucene.initVM(vmargs=["-Djava.awt.headless=true"])
+        vmargs = ["-Djava.awt.headless=true"] + [a for a in LUCENE_VMARGS.split(",") if a.strip()]
+        lucene.initVM(vmargs=vmargs)
 
-    directory = FSDirectory.open(Paths.get(index_dir))
+    directory = MMapDirectory(Paths.get(index_dir))
     reader = DirectoryReader.open(directory)
     searcher = IndexSearcher(reader)
     return searcher
 
 
-SEARCHER = init_searcher()
-ANALYZER = WhitespaceAnalyzer()
-QP = QueryParser("content", ANALYZER)
+# 与 build_index.py 保持一致：level 区分粒度，段落/句子的分词写在 unit_content
+LEVEL_CHAPTER = "chapter"
+LEVEL_PARAGRAPH = "paragraph"
+LEVEL_SENTENCE = "sentence"
+UNIT_FIELD = "unit_content"
+CHAPTER_DV = "chapter_num"
+ORDINAL_DV = "ordinal_num"
+
 
+class IndexView:
+    """
+    一个打开的 IndexSearcher + docnum → 语料记录 的内存表：
+      - records[docnum]：所属章节的元数据（DOC_BY_ID 的值）
+      - ordinals[docnum]：段落/句子在章节内的序号，章节级 Document 为 -1
+    表在打开索引时从数值 DocValues 一次性读出，检索时按 hit.doc 直接下标访问，
+    不再为每个命中跨 JNI 解压 stored fields。索引重新打开时整张表重建。
+
+    store 是和这一代索引一起打开的语料快照（CorpusStore.snapshot），两者一起换、一起用。
+    refs：正在用这个 view 的检索数（见 pinned_view）；换下来（retire）之后等 refs 归零才关 reader。
+    """
 
-# ========= 2. 加载原始 threebody.json =========
+    def __init__(self, searcher: IndexSearcher, docs_by_id: Dict[str, Dict[str, Any]],
+                 store: Optional[CorpusStore] = None):
+        self.searcher = searcher
+        self.store = store if store is not None else CorpusStore()
+        self.refs = 0
+        self.retired = False
+        self.reader = DirectoryReader.cast_(searcher.getIndexReader())
+        # 旧索引只有章节级 Document（没有 level 字段），此时只能走 Python 扫描
+        self.has_unit_docs = self.reader.docFreq(Term("level", LEVEL_SENTENCE)) > 0
+        # BM25 单个词分数的上界（idf 在 docFreq = 1 时最大），用于章节排序的档位加分
+        n_docs = max(self.reader.getDocCount("content"), 1)
+        self.max_idf = math.log(1 + (n_docs - 1 + 0.5) / (1 + 0.5))
+
+        n = self.reader.maxDoc()
+        self.records: List[Optional[Dict[str, Any]]] = [None] * n
+        self.ordinals = array("i", [-1]) * n
+        for ctx in self.reader.leaves():
+            self._load_leaf(ctx, docs_by_id)
+
+    def _load_leaf(self, ctx, docs_by_id):
+        leaf = ctx.reader()
+        base = ctx.docBase
+        chap_dv = leaf.getNumericDocValues(CHAPTER_DV)
+        ord_dv = leaf.getNumericDocValues(ORDINAL_DV)
+
+        if chap_dv is None:
+            # 没有 DocValues 的旧索引：打开时逐条读一次 stored fields，之后同样查表
+            for doc in range(leaf.maxDoc()):
+                d = self.searcher.doc(base + doc)
+                doc_id = d.get("doc_id") or d.get("id")
+                self.records[base + doc] = docs_by_id.get(doc_id)
+                if d.get("ordinal") is not None:
+                    self.ordinals[base + doc] = int(d.get("ordinal"))
+            return
+
+        doc = chap_dv.nextDoc()
+        while doc != DocIdSetIterator.NO_MORE_DOCS:
+            self.records[base + doc] = docs_by_id.get(str(chap_dv.longValue()))
+            doc = chap_dv.nextDoc()
+        if ord_dv is not None:
+            doc = ord_dv.nextDoc()
+            while doc != DocIdSetIterator.NO_MORE_DOCS:
+                self.ordinals[base + doc] = ord_dv.longValue()
+                doc = ord_dv.nextDoc()
+
+    def record(self, docnum: int) -> Dict[str, Any]:
+        return self.records[docnum] or {}
+
+    def doc_id(self, docnum: int) -> str:
+        return str(self.record(docnum).get("id"))
+
+    def ordinal(self, docnum: int) -> int:
+        return self.ordinals[docnum]
+
+    # acquire / release / retire 都在 _VIEW_LOCK 下调用；关 reader 的线程必须已 attach 到 JVM
+
+    def acquire(self):
+        self.refs += 1
+
+    def release(self):
+        self.refs -= 1
+        if self.retired and self.refs == 0:
+            self.reader.close()
+
+    def retire(self):
+        self.retired = True
+        if self.refs == 0:
+            self.reader.close()
+
+
+# 每章首屏带回多少条（按分数取前 N 条并高亮），其余由 chapter_hits 按游标分页取；
+# 全局句子 / 段落列表同样只保留前 GLOBAL_TOP_N 条
+UNITS_PER_CHAPTER = {LEVEL_PARAGRAPH: 5, LEVEL_SENTENCE: 10}
+GLOBAL_TOP_N = 50
+HITS_PAGE_MAX = 50
+
+
+# ========= 2. 加载语料（threebody.json → mmap 的 threebody.corpus）=========
 
 DATA_PATH = "threebody.json"
 
-if not os.path.exists(DATA_PATH):
-    raise RuntimeError(f"未找到数据文件: {DATA_PATH}")
+# 语料和索引都在 init_search() 里加载，import 本模块不做任何重活。
+# 这里先放空容器，加载时就地填充：from search import SEGMENTS 拿到的始终是同一个对象
+#   - RAW_DOCS / DOC_BY_ID：各章元数据（id / book / chapter ...），不含原文
+#   - SEGMENTS：mmap 的语料文件，章节原文、段落、句子按偏移量现取现解码，
+#     多个 worker 进程共享同一份页缓存
+#   - QUOTES：全语料的原文引用定位（后缀数组，同样 mmap），snippet 查询先查它
+#   - UNITS：段落/句子 × 词表的出现矩阵（同样 mmap，由 build_index 生成），
+#     段落/句子打分默认用它，计分词不在词表里时才走索引检索或逐条扫描
+RAW_DOCS: List[Dict[str, Any]] = []
+DOC_BY_ID: Dict[str, Dict[str, Any]] = {}
+SEGMENTS = CorpusStore()
+QUOTES = QuoteIndex(store=SEGMENTS)
+UNITS = UnitMatrix()
+
+# 当前打开的索引；重建索引后由 maybe_refresh_index 换成新的 IndexView
+#   _INDEX_LOCK：同一时间只有一个线程在重新打开索引（慢）
+#   _VIEW_LOCK：换 INDEX_VIEW 和增减引用计数（快）
+INDEX_VIEW: Optional[IndexView] = None
+_INDEX_LOCK = threading.Lock()
+_VIEW_LOCK = threading.Lock()
+_INDEX_CHECK_INTERVAL = 2.0
+_index_checked_at = time.monotonic()
+_corpus_mtime = None
+# 当前线程 pinned_view() 住的 IndexView
+_PINNED = threading.local()
+
+
+def _reload_corpus() -> int:
+    """
+    threebody.json 有变化时（语料文件过期则先重新生成）重新 mmap threebody.corpus、threebody.quotes
+    和 threebody.units，
+    并就地更新 RAW_DOCS / DOC_BY_ID（其他模块 from search import 的是同一个对象）。
+    返回内容有变化的章节数。
+    """
+    global _corpus_mtime
+    if not os.path.exists(DATA_PATH):
+        raise RuntimeError(f"未找到数据文件: {DATA_PATH}")
+    mtime = os.stat(DATA_PATH).st_mtime_ns
+    if mtime == _corpus_mtime:
+        return 0
+    ensure_corpus(DATA_PATH, CORPUS_PATH)
+    SEGMENTS.open(CORPUS_PATH)
+    ensure_quote_index(CORPUS_PATH, QUOTES_PATH, SEGMENTS)
+    QUOTES.open(QUOTES_PATH)
+    # 出现矩阵只打开、不在这里生成（要对全语料分词，交给 build_index）；
+    # 文件缺失或和语料对不上时 _matrix_usable 为假，打分退回索引检索 / 扫描
+    if os.path.exists(UNITS_PATH):
+        UNITS.open(UNITS_PATH)
+
+    records = SEGMENTS.records()
+    by_id = {r["id"]: r for r in records}
+    changed = sum(1 for doc_id, r in by_id.items()
+                  if DOC_BY_ID.get(doc_id, {}).get("hash") != r.get("hash"))
+
+    DOC_BY_ID.update(by_id)
+    for doc_id in set(DOC_BY_ID) - set(by_id):
+        del DOC_BY_ID[doc_id]
+    RAW_DOCS[:] = records
+    _corpus_mtime = mtime
+    return changed
+
+
+def maybe_refresh_index(force: bool = False) -> bool:
+    """
+    索引目录有新的 commit 时重新打开 reader 并重建 docnum 表（最多每 2 秒检查一次）。
+    threebody.json 有变化时语料文件也一并重新打开，和新 reader 装进同一个 IndexView 一起换上。
+    旧 view 可能还在被正在进行的检索使用，等它们都 release 之后才关闭旧 reader。
+    """
+    global INDEX_VIEW, _index_checked_at
+    now = time.monotonic()
+    if not force and now - _index_checked_at < _INDEX_CHECK_INTERVAL:
+        return False
+    with _INDEX_LOCK:
+        _index_checked_at = now
+        old = INDEX_VIEW
+        if old is None:
+            return False
+        new_reader = DirectoryReader.openIfChanged(old.reader)
+        if new_reader is None:
+            return False
+        n_changed = _reload_corpus()
+        if n_changed:
+            print(f"[data] threebody.json 有 {n_changed} 章更新")
+        view = IndexView(IndexSearcher(new_reader), DOC_BY_ID, SEGMENTS.snapshot())
+        with _VIEW_LOCK:
+            INDEX_VIEW = view
+            old.retire()
+        print(f"[Lucene] 索引已更新，重新打开 reader（maxDoc={new_reader.maxDoc()}）")
+        return True
+
+
+@contextmanager
+def pinned_view():
+    """
+    一次检索从头到尾用同一个 IndexView：持有引用（换下来的 reader 不会被关掉），
+    并让当前线程的 SEGMENTS 读这一代的语料快照。可嵌套，内层直接复用外层的。
+    """
+    view = getattr(_PINNED, "view", None)
+    if view is not None:
+        yield view
+        return
+    with _VIEW_LOCK:
+        view = INDEX_VIEW
+        view.acquire()
+    _PINNED.view = view
+    try:
+        with SEGMENTS.pinned(view.store):
+            yield view
+    finally:
+        _PINNED.view = None
+        with _VIEW_LOCK:
+            view.release()
 
-with open(DATA_PATH, "r", encoding="utf-8") as f:
-    RAW_DOCS: List[Dict[str, Any]] = json.load(f)
 
-DOC_BY_ID: Dict[str, Dict[str, Any]] = {str(d.get("id")): d for d in RAW_DOCS}
+def _current_view() -> IndexView:
+    """pinned_view() 里为住的那个，否则为最新的"""
+    return getattr(_PINNED, "view", None) or INDEX_VIEW
 
 
 # ========= 3. 工具函数：分词 / 分段 / 分句 =========
@@ -79,12 +302,6 @@ STOPWORDS = set("""
 """.split())
 STOPWORDS.update({"什么", "怎样", "怎么", "如何", "为什么", "为何", "谁"})
 
-USER_DICT = "vocab.txt"
-if os.path.exists(USER_DICT):
-    print(f"[jieba] 加载自定义词典: {USER_DICT}")
-    jieba.load_userdict(USER_DICT)
-else:
-    print(f"[jieba] 未找到自定义词典 {USER_DICT}，仅使用默认词典")
 
 
 def get_query_terms(text: str, max_terms: int = 4) -> List[str]:
@@ -95,7 +312,7 @@ def get_query_terms(text: str, max_terms: int = 4) -> List[str]:
     - 去掉停用词和单字
     - 按长度从大到小排序，只取前 max_terms 个
     """
-    terms = [t.strip() for t in jieba.lcut(text) if t.strip()]
+    terms = [t.strip() for t in query_tokens(text)]
     candidates = [t for t in terms if len(t) > 1 and t not in STOPWORDS]
 
     # 去重并保持顺序
@@ -116,200 +333,528 @@ def get_query_terms(text: str, max_terms: int = 4) -> List[str]:
     return [q] if q else []
 
 
+# 查询分词结果：同一条查询在召回、复用检查、关键词提取里要分好几次；
+# search_many 先整批分好放进来，后面逐条检索时全部命中
+QUERY_TOKENS = LRUCache(max_entries=4096, max_bytes=8 * 1024 * 1024, ttl=0)
+
+
+def query_tokens(text: str) -> List[str]:
+    """tokens.tokenize 的结果（带缓存，返回值请当作只读）"""
+    tokens = QUERY_TOKENS.get(text)
+    if tokens is None:
+        with span("tokenize"):
+            tokens = tokenize(text)
+        QUERY_TOKENS.put(text, tokens)
+    return tokens
+
+
+def prime_query_tokens(texts: Iterable[str], workers: int = 1):
+    """批量分词，把还没缓存的查询一次分完（workers > 1 时交给 tokens.tokenize_many 的进程池）"""
+    todo = [t for t in dict.fromkeys(texts) if t and QUERY_TOKENS.get(t) is None]
+    if not todo:
+        return
+    with span("tokenize"):
+        results = tokenize_many(todo, user_dict=USER_DICT, workers=workers)
+    for text, tokens in zip(todo, results):
+        QUERY_TOKENS.put(text, tokens)
+
+
 def tokenize_query(text: str) -> str:
-    """和建索引时保持一致：jieba 分词，再空格拼接"""
-    tokens = [t for t in jieba.lcut(text) if t.strip()]
-    return " ".join(tokens)
+    """和建索引时保持一致：tokens.tokenize（jieba 分词），再空格拼接"""
+    return " ".join(query_tokens(text))
 
 
 def split_paragraphs(raw: str) -> List[str]:
-    """按空行拆段"""
-    parts = re.split(r"\n\s*\n+", raw.strip())
-    return [p.strip() for p in parts if p.strip()]
+    """按空行拆段（已入库的章节请直接用 SEGMENTS.paragraphs(doc_id)）"""
+    return [raw[s:e] for s, e in paragraph_spans(raw)]
 
 
 def split_sentences(raw: str) -> List[str]:
     """
-    简单句子切分：
+    简单句子切分（已入库的章节请直接用 SEGMENTS.sentences(doc_id)）：
     - 按中文句号/问号/叹号
-    - 以及英文 . ? ! 后面拆分
+    - 以及英文 ? ! 后面拆分
     """
-    text = re.sub(r"\s+", " ", raw)
-    parts = re.split(r"(?<=[。！？!?])\s*", text)
-    return [s.strip() for s in parts if s.strip()]
+    return [normalize_sentence(raw[s:e]) for s, e in sentence_spans(raw)]
+
+
+# ========= 4. Lucene 查询构造 =========
+
+def chapter_query(query, view: IndexView = None):
+    """只在章节级 Document 上检索（旧索引没有 level 字段，原样返回）"""
+    view = view or _current_view()
+    if not view.has_unit_docs:
+        return query
+    b = BooleanQuery.Builder()
+    b.add(query, BooleanClause.Occur.MUST)
+    b.add(TermQuery(Term("level", LEVEL_CHAPTER)), BooleanClause.Occur.FILTER)
+    return b.build()
+
 
+def _term_query(field: str, text: str):
+    """把一个关键词分词后变成 TermQuery（单个词）或 PhraseQuery（多个词）"""
+    tokens = tokenize_query(text).split()
+    if not tokens:
+        return None
+    if len(tokens) == 1:
+        return TermQuery(Term(field, tokens[0]))
+    pb = PhraseQuery.Builder()
+    for t in tokens:
+        pb.add(Term(field, t))
+    return pb.build()
+
+
+def unit_query(level: str, doc_ids: List[str], query_terms: List[str],
+               core_term: str = "", phrase: str = ""):
+    """
+    段落/句子级查询，权重与 Python 扫描版的 match_score 对齐：
+      - 每个关键词权重 = 词长，snippet 模式下核心词 ×3
+      - snippet 整句额外 5 × 句长
+      - 只在给定章节（doc_id）范围内、给定粒度（level）上检索
+    """
+    should = BooleanQuery.Builder()
+    n_clauses = 0
+    for term in query_terms:
+        q = _term_query(UNIT_FIELD, term)
+        if q is None:
+            continue
+        w = len(term)
+        if core_term and term == core_term:
+            w *= 3
+        should.add(BoostQuery(q, float(w)), BooleanClause.Occur.SHOULD)
+        n_clauses += 1
+    if n_clauses == 0:
+        return None
+
+    b = BooleanQuery.Builder()
+    if phrase:
+        q = _term_query(UNIT_FIELD, phrase)
+        if q is not None:
+            # 整句只加分，不单独决定是否命中
+            b.add(BoostQuery(q, float(5 * len(phrase))), BooleanClause.Occur.SHOULD)
+    b.add(should.build(), BooleanClause.Occur.MUST)
+    b.add(TermQuery(Term("level", level)), BooleanClause.Occur.FILTER)
+
+    ids = BooleanQuery.Builder()
+    for doc_id in doc_ids:
+        ids.add(TermQuery(Term("doc_id", str(doc_id))), BooleanClause.Occur.SHOULD)
+    b.add(ids.build(), BooleanClause.Occur.FILTER)
+    return b.build()
+
+
+def search_units(level: str, doc_ids: List[str], query_terms: List[str],
+                 core_term: str = "", phrase: str = "",
+                 top_k: int = None) -> Dict[str, List[tuple]]:
+    """
+    在索引里直接检索段落/句子，按章节分组返回：
+      { doc_id: [(ordinal, score), ...] }，组内按 score 从高到低
+    top_k 缺省取这些章节该粒度的总条数，即不截断：每章的命中数就是该章的总数，
+    和 chapter_hits 翻页时看到的一致
+    """
+    grouped: Dict[str, List[tuple]] = {str(d): [] for d in doc_ids}
+    if not doc_ids:
+        return grouped
+    q = unit_query(level, doc_ids, query_terms, core_term, phrase)
+    if q is None:
+        return grouped
+
+    view = _current_view()
+    top_k = top_k or max(sum(SEGMENTS.unit_range(d, level)[1] for d in doc_ids), 1)
+    with span("lucene"):
+        score_docs = view.searcher.search(q, top_k).scoreDocs
+    for hit in score_docs:
+        doc_id = view.doc_id(hit.doc)
+        if doc_id in grouped:
+            grouped[doc_id].append((view.ordinal(hit.doc), float(hit.score)))
+    return grouped
+
+
+def build_query_matcher(query_terms: List[str], highlight_terms: List[str] = None,
+                        core_term: str = "", phrase: str = "") -> TermMatcher:
+    """
+    每次查询构建一次的多关键词匹配器：
+      - 基于关键词的基础分：词越长权重稍高
+      - snippet 模式下，核心词（如“虫子”）额外 ×3
+      - 整句 snippet 出现，再额外加一大笔分（只在有基础分时加），保证排到最前
+      - highlight_terms 的顺序即高亮优先级
+    """
+    weights = {}
+    for term in query_terms:
+        if term:
+            w = len(term)
+            if core_term and term == core_term:
+                w *= 3
+            weights[term] = w
+    bonus = {phrase: 5 * len(phrase)} if phrase else None
+    return TermMatcher(highlight_terms if highlight_terms is not None else query_terms,
+                       weights, bonus)
+
+
+def _unit_key(hit: Tuple[int, float]):
+    """分数高的在前，同分按位置"""
+    return (hit[1], -hit[0])
+
+
+def _scan_unit_scores(units: List[str], matcher: TermMatcher) -> List[Tuple[int, float]]:
+    """
+    Python 扫描版：每个段落/句子用 matcher 扫一遍，只算分数、不高亮
+    （用不上出现矩阵、索引里也没有段落/句子 Document 时的兜底）
+    """
+    scored = []
+    for idx, unit in enumerate(units):
+        score = matcher.score(unit)
+        if score > 0:
+            scored.append((idx, score))
+    return scored
+
+
+def _matrix_usable(matcher: TermMatcher) -> bool:
+    """出现矩阵已打开、和当前语料一致，且计分词都在它的词表里"""
+    if not UNITS or UNITS.source_hash != SEGMENTS.source_hash:
+        return False
+    return UNITS.columns(t for t, w in matcher.term_weights().items() if w) is not None
+
+
+def _unit_scores(level: str, doc_id: str, matcher: TermMatcher) -> List[Tuple[int, float]]:
+    """
+    Python 打分版：
+    出现矩阵可用时（_matrix_usable）直接按列累加本章的行区间，只对命中的几条取原文算整句加分；
+    否则退回 _scan_unit_scores 逐条扫原文
+    """
+    scored = None
+    if _matrix_usable(matcher):
+        first, count = SEGMENTS.unit_range(doc_id, level)
+        scored = UNITS.score(level, first, count, matcher.term_weights())
+    if scored is None:
+        units = SEGMENTS.paragraphs(doc_id) if level == LEVEL_PARAGRAPH else SEGMENTS.sentences(doc_id)
+        return _scan_unit_scores(units, matcher)
+
+    bonus = matcher.bonus_terms()
+    if bonus and scored:
+        fetch = SEGMENTS.paragraph if level == LEVEL_PARAGRAPH else SEGMENTS.sentence
+        out = []
+        for idx, score in scored:
+            text = fetch(doc_id, idx)
+            out.append((idx, score + sum(b for t, b in bonus.items() if t in text)))
+        scored = out
+    return scored
+
+
+def top_units(scored: Iterable[Tuple[int, float]], n: int) -> List[Tuple[int, float]]:
+    """堆选出分数最高的 n 条（不对全部命中排序）"""
+    return heapq.nlargest(n, scored, key=_unit_key)
+
+
+def _materialize(level: str, doc_id: str, hits: List[Tuple[int, float]],
+                 matcher: TermMatcher) -> List[Dict[str, Any]]:
+    """
+    只给要展示的那几条取原文、做高亮；
+    spans 为高亮区间（字符下标），紧凑响应只回传它，由前端自己加高亮
+    """
+    fetch = SEGMENTS.paragraph if level == LEVEL_PARAGRAPH else SEGMENTS.sentence
+    out = []
+    for idx, score in hits:
+        text = fetch(doc_id, idx)
+        spans = matcher.scan(text).spans
+        out.append({"index": idx, "text": matcher.highlight(text, spans),
+                    "spans": spans, "match_score": score})
+    return out
+
+
+# ========= 5. 章节召回 =========
+#
+# 章节排序的三个档位直接写进 Lucene 查询：
+#   0: 原文中包含整串 query        → PhraseQuery，常数分 phrase_boost
+#   1: 原文中包含所有检索词        → 全部词都必须命中的 BooleanQuery，常数分 all_boost
+#   2: 其他情况                    → 各检索词的析取（BM25）
+# 两个 boost 按“析取分数的上界”取值（每个词的 BM25 分数 < idf 上界），
+# 保证档位高的一定排在前面，Lucene 的 top-k 就是最终顺序，不用多拉再在 Python 里扫原文。
+
+class RecallHit:
+    __slots__ = ("doc_id", "book", "chapter", "score", "has_phrase", "has_all")
+
+    def __init__(self, doc_id: str, book: str, chapter: str, score: float,
+                 has_phrase: bool = False, has_all: bool = False):
+        self.doc_id = doc_id
+        self.book = book
+        self.chapter = chapter
+        self.score = score              # 析取部分的 BM25 分数（不含档位加分）
+        self.has_phrase = has_phrase    # 档位 0：命中整串 query
+        self.has_all = has_all          # 档位 1：命中全部检索词
+
+    def rank_key(self):
+        return (not self.has_phrase, not self.has_all, -self.score)
+
+
+class ChapterRecall:
+    """一次章节级 Lucene 召回：检索词（分词后）、整串 phrase + 按档位/分数排好序的命中章节"""
+
+    def __init__(self, tokens: List[str], phrase: str, hits: List[RecallHit], max_hits: int):
+        self.tokens = tokens
+        self.phrase = phrase
+        self.hits = hits
+        self.max_hits = max_hits
+
+    def same_tokens(self, tokens: List[str]) -> bool:
+        return Counter(self.tokens) == Counter(tokens)
+
+    def matches(self, tokens: List[str], phrase: str) -> bool:
+        return self.phrase == phrase and self.same_tokens(tokens)
+
+
+def _tier_boosts(n_clauses: int, view: IndexView):
+    """
+    析取部分的分数 < 子句数 × idf 上界；档位加分取大于它的 2 的幂（留出 1.0 的余量），
+    所以总分落在哪一档只看它是否 ≥ 档位加分，判断是精确的。
+    拆回来的 BM25 分数并不精确：float32 下加上档位加分会把 BM25 部分舍入到
+    档位加分的 ulp（约 加分 × 2^-23，加分为 64 时约 7.6e-6），减回去也恢复不了被舍掉的低位。
+    这点误差远小于排序和展示关心的精度；同档内 Lucene 排序用的本来就是这个舍入后的总分。
+    """
+    bound = max(n_clauses, 1) * view.max_idf + 1.0
+    all_boost = 1.0
+    while all_boost <= bound:
+        all_boost *= 2
+    return all_boost, all_boost * 4
+
+
+def _content_phrase(text: str):
+    """整串 query 分词后在 content 上做短语查询（单个词时退化为 TermQuery）"""
+    return _term_query("content", text) if text else None
+
+
+def _recall_hits(tokens: List[str], phrase: str, max_hits: int) -> List[RecallHit]:
+    """
+    一次 Lucene 查询同时完成召回和三档排序：
+    析取 + 全词命中（minimumShouldMatch = 全部）+ 整串短语，三者 SHOULD 组合，至少命中一个
+    """
+    view = _current_view()
+    all_boost, phrase_boost = _tier_boosts(len(tokens), view)
+
+    b = BooleanQuery.Builder()
+    if tokens:
+        disjunction = BooleanQuery.Builder()
+        for t in tokens:
+            disjunction.add(TermQuery(Term("content", t)), BooleanClause.Occur.SHOULD)
+        b.add(disjunction.build(), BooleanClause.Occur.SHOULD)
+
+        unique = list(dict.fromkeys(tokens))
+        conj = BooleanQuery.Builder()
+        for t in unique:
+            conj.add(TermQuery(Term("content", t)), BooleanClause.Occur.SHOULD)
+        conj.setMinimumNumberShouldMatch(len(unique))
+        b.add(BoostQuery(ConstantScoreQuery(conj.build()), all_boost), BooleanClause.Occur.SHOULD)
+
+    phrase_q = _content_phrase(phrase)
+    if phrase_q is not None:
+        b.add(BoostQuery(ConstantScoreQuery(phrase_q), phrase_boost), BooleanClause.Occur.SHOULD)
+
+    if not tokens and phrase_q is None:
+        return []
+    b.setMinimumNumberShouldMatch(1)
+    lucene_query = chapter_query(b.build(), view)
+
+    with span("lucene"):
+        score_docs = view.searcher.search(lucene_query, max_hits).scoreDocs
+
+    hits = []
+    for hit in score_docs:
+        # 档位判断精确；减掉加分后的 score 是舍入过的 BM25（见 _tier_boosts）
+        score = float(hit.score)
+        has_phrase = phrase_q is not None and score >= phrase_boost
+        if has_phrase:
+            score -= phrase_boost
+        has_all = bool(tokens) and score >= all_boost
+        if has_all:
+            score -= all_boost
+        rec = view.record(hit.doc)
+        hits.append(RecallHit(str(rec.get("id")), rec.get("book", "") or "",
+                              rec.get("chapter", "") or "", score, has_phrase, has_all))
+    return hits
+
+
+def recall_chapters(ir_query: str, phrase: str = "", max_hits: int = None) -> ChapterRecall:
+    """
+    用 Lucene 在章节级 content 上召回，结果已按档位 + BM25 排好序。
+    phrase 为整串 query（命中则排最前）；max_hits 默认召回全部章节里能命中的。
+    """
+    _ensure_index()
+    maybe_refresh_index()
+    max_hits = min(max_hits or len(DOC_BY_ID), len(DOC_BY_ID))
+    phrase = (phrase or "").strip()
+    tokens = [t for t in tokenize_query(ir_query).split() if t]
+    with pinned_view():
+        return ChapterRecall(tokens, phrase, _recall_hits(tokens, phrase, max_hits), max_hits)
+
+
+def top_up_recall(base: ChapterRecall, ir_query: str, phrase: str = "") -> ChapterRecall:
+    """
+    在已有召回上补充检索词：只对多出来的词（以及变了的 phrase）再查一次 Lucene，按 doc_id 合并。
+      - 析取分数：各词 SHOULD 子句分数之和，两次相加即可
+      - 全词命中：两次都全部命中才算
+      - 整串命中：phrase 变了就以补查结果为准
+    只要两次召回都覆盖了全部命中章节，合并结果和直接查整串一致。
+    """
+    phrase = (phrase or "").strip()
+    tokens = [t for t in tokenize_query(ir_query).split() if t]
+    if base.matches(tokens, phrase):
+        return base
+
+    extra = Counter(tokens)
+    extra.subtract(Counter(base.tokens))
+    if any(n < 0 for n in extra.values()):
+        # 新检索词不是旧检索词的超集，没法只补差额
+        return recall_chapters(ir_query, phrase, base.max_hits)
+    extra_tokens = list(extra.elements())
+    phrase_changed = phrase != base.phrase
+
+    with pinned_view(), span("rerank"):
+        return _merge_recall(base, tokens, phrase, extra_tokens, phrase_changed)
+
+
+def _merge_recall(base: ChapterRecall, tokens: List[str], phrase: str,
+                  extra_tokens: List[str], phrase_changed: bool) -> ChapterRecall:
+    """top_up_recall 的合并部分：补查（Lucene 时间单独计在 lucene 阶段）+ 按档位重新排序"""
+    merged: Dict[str, RecallHit] = {}
+    for h in base.hits:
+        merged[h.doc_id] = RecallHit(h.doc_id, h.book, h.chapter, h.score,
+                                     h.has_phrase and not phrase_changed,
+                                     h.has_all and not extra_tokens)
+    if extra_tokens or phrase_changed:
+        base_all = {h.doc_id for h in base.hits if h.has_all} if base.tokens else None
+        for h in _recall_hits(extra_tokens, phrase if phrase_changed else "", base.max_hits):
+            m = merged.get(h.doc_id)
+            if m is None:
+                m = merged[h.doc_id] = RecallHit(h.doc_id, h.book, h.chapter, 0.0)
+            m.score += h.score
+            if phrase_changed:
+                m.has_phrase = h.has_phrase
+            if extra_tokens:
+                m.has_all = h.has_all and (base_all is None or h.doc_id in base_all)
+
+    hits = sorted(merged.values(), key=RecallHit.rank_key)[:base.max_hits]
+    return ChapterRecall(tokens, phrase, hits, base.max_hits)
+
+
+# ========= 6. 核心函数：多粒度搜索 =========
+
+# 热门查询（“黑暗森林”“程心是谁”“歌者”）反复出现，直接缓存整份结果；
+# 索引目录一旦重新 commit，缓存自动清空
+RESULT_CACHE = LRUCache(max_entries=512,
+                        max_bytes=64 * 1024 * 1024,
+                        ttl=600.0,
+                        version_fn=lambda: index_signature(INDEX_DIR))
 
-# ========= 4. 核心函数：多粒度搜索 =========
 
 def search_multi_granularity(query: str,
                              top_k_chapters: int = 10,
                              ir_query: str = None,
-                             snippet_mode: bool = False):
+                             snippet_mode: bool = False,
+                             use_unit_index: bool = None,
+                             recall: "ChapterRecall" = None):
     """
     输入：
       query: 用于 IR 的查询串（通常来自 LLM 的 search_query）
       top_k_chapters: 召回多少个章节
       ir_query: 用于 Lucene 的检索串（可以和 query 不同，一般是 query + 扩展词）
       snippet_mode: 是否是“原文片段/snippet 模式”
+      use_unit_index: 段落/句子是否直接走索引检索（None = 出现矩阵用不上、
+                      且索引里有段落/句子 Document 时才用；False = 只用矩阵 / 扫描）；
+                      走索引时 match_score 为 Lucene 打分，否则为 TermMatcher 的分数
+      recall: 预先做好的章节召回（recall_chapters / top_up_recall），检索词一致时复用
 
     输出结构：
       {
         "query": 原始查询,
+        "snippet_mode": 是否 snippet 模式（翻页时原样传给 chapter_hits）,
         "chapters": [
           {
             "doc_id": ...,
             "book": ...,
             "chapter": ...,
             "score": Lucene 打分,
-            "hit_sentences": [ { "index": i, "text": "句子文本", "match_score": 匹配分数 }, ... ],
-            "hit_paragraphs": [ { "index": j, "text": "段落文本", "match_score": 匹配分数 }, ... ],
+            "hit_sentences": [ { "index": i, "text": "句子文本", "spans": 高亮区间, "match_score": 匹配分数 }, ... ],
+            "hit_paragraphs": [ { "index": j, "text": "段落文本", "spans": 高亮区间, "match_score": 匹配分数 }, ... ],
+            "sentence_total" / "paragraph_total": 该章命中总数,
+            "sentence_cursor" / "paragraph_cursor": 还有更多命中时 chapter_hits 的起始游标，否则 None,
           },
           ...
         ],
-        "sentences": [ 全局句子列表，同样带 doc_id/book/chapter ],
-        "paragraphs": [ 全局段落列表，同样带 doc_id/book/chapter ],
+        "sentences": [ 全局句子列表（前 GLOBAL_TOP_N 条），同样带 doc_id/book/chapter ],
+        "paragraphs": [ 全局段落列表（前 GLOBAL_TOP_N 条），同样带 doc_id/book/chapter ],
       }
-    """
+    每章只高亮前 UNITS_PER_CHAPTER 条，其余按需由 chapter_hits 分页取。
 
-    # 1. 用 Lucene 检索章节（先多召回一些，再在 Python 里做简易重排）
+    结果带 LRU+TTL 缓存（见 RESULT_CACHE），返回值请当作只读。
+    """
+    _ensure_index()
+    maybe_refresh_index()
+    key = (normalize_query(query), normalize_query(ir_query or query),
+           int(top_k_chapters), bool(snippet_mode), use_unit_index)
+    res = RESULT_CACHE.get(key)
+    if res is None:
+        with pinned_view():
+            res = _search_multi_granularity(query, top_k_chapters, ir_query,
+                                            snippet_mode, use_unit_index, recall)
+        RESULT_CACHE.put(key, res)
+    return res
+
+
+def _search_multi_granularity(query: str,
+                              top_k_chapters: int = 10,
+                              ir_query: str = None,
+                              snippet_mode: bool = False,
+                              use_unit_index: bool = None,
+                              recall: "ChapterRecall" = None):
+    """search_multi_granularity 的实际实现（不经过缓存）"""
+    with span("scan"):
+        return _search_units_of_chapters(query, top_k_chapters, ir_query,
+                                         snippet_mode, use_unit_index, recall)
+
+
+def _search_units_of_chapters(query: str, top_k_chapters: int, ir_query: Optional[str],
+                              snippet_mode: bool, use_unit_index: Optional[bool],
+                              recall: Optional["ChapterRecall"]):
+    """章节召回 + 段落/句子匹配；其中的分词、Lucene 时间由各自的 span 扣除"""
+    # 1. 用 Lucene 检索章节，整串/全词/析取三档排序已在查询里完成，直接取 top-k
     q_ir = ir_query or query  # ir_query 中包含原查询及扩展词
-    q_str = tokenize_query(q_ir)
-    lucene_query = QP.parse(q_str)
-
-    # 根据章节数量限制 max_hits，避免每次多拉太多
-    max_hits = max(top_k_chapters * 3, 50)
-    max_hits = min(max_hits, len(DOC_BY_ID))
-
-    hits = SEARCHER.search(lucene_query, max_hits).scoreDocs
-
     raw_query = (query or "").strip()
-    query_tokens = [t for t in q_str.split() if t]
-
-    # 对章节进行简单重排：
-    # 0: 原文中包含整串 query
-    # 1: 原文中包含所有 query_tokens
-    # 2: 其他情况
-    ranked = []
-    for hit in hits:
-        lucene_doc = SEARCHER.doc(hit.doc)
-        doc_id = lucene_doc.get("id")
-
-        raw_content = ""
-        if doc_id in DOC_BY_ID:
-            raw_content = DOC_BY_ID[doc_id].get("content", "") or ""
-
-        has_raw_query = bool(raw_query and raw_query in raw_content)
-        has_all_tokens = bool(query_tokens) and all(t in raw_content for t in query_tokens)
-
-        if has_raw_query:
-            priority = 0
-        elif has_all_tokens:
-            priority = 1
-        else:
-            priority = 2
-
-        ranked.append((priority, -float(hit.score), hit))
+    max_hits = min(top_k_chapters, len(DOC_BY_ID))
 
-    ranked.sort(key=lambda x: (x[0], x[1]))
-    hits = [item[2] for item in ranked[:top_k_chapters]]
+    # 调用方提前召回过（如 /api/search 的预召回）且检索词、整串一致时直接复用
+    if recall is None or recall.max_hits < max_hits \
+            or not recall.matches(tokenize_query(q_ir).split(), raw_query):
+        recall = recall_chapters(q_ir, raw_query, max_hits)
+    hits = recall.hits[:top_k_chapters]
 
     # 2. 章节内部多粒度匹配（句子 & 段落）
-    # snippet 模式：用关键词决定命中，用整句 phrase 和第一个关键词大幅加权
-    if snippet_mode:
-        phrase = query.strip()
-        base_terms = get_query_terms(query)
-        query_terms = base_terms if base_terms else ([phrase] if phrase else [])
-        core_term = query_terms[0] if query_terms else ""   # ★ 第一个关键词，当作“虫子”这类核心词
+    query_terms, core_term, phrase, matcher = _unit_plan(query, snippet_mode)
 
-        # 高亮时同时高亮整句和关键词
-        highlight_terms = []
-        if phrase:
-            highlight_terms.append(phrase)
-        highlight_terms.extend(base_terms)
-        highlight_terms = [t for t in highlight_terms if t]
-        pattern = re.compile("|".join(map(re.escape, highlight_terms))) if highlight_terms else None
-    else:
-        phrase = ""
-        core_term = ""
-        query_terms = get_query_terms(query)
-        pattern = re.compile("|".join(map(re.escape, query_terms))) if query_terms else None
+    # 3. 取出召回章节的元数据；段落/句子默认用出现矩阵打分，用不上时才走索引检索
+    use_unit_index = _want_unit_index(use_unit_index, matcher)
+    hit_meta = [(hit.doc_id, hit.book, hit.chapter, hit.score) for hit in hits]
+
+    if use_unit_index:
+        doc_ids = [m[0] for m in hit_meta]
+        unit_paras = search_units(LEVEL_PARAGRAPH, doc_ids, query_terms, core_term, phrase)
+        unit_sents = search_units(LEVEL_SENTENCE, doc_ids, query_terms, core_term, phrase)
 
     chapter_results = []
     sentence_results = []
     paragraph_results = []
+    n_paras = UNITS_PER_CHAPTER[LEVEL_PARAGRAPH]
+    n_sents = UNITS_PER_CHAPTER[LEVEL_SENTENCE]
 
-    for hit in hits:
-        lucene_doc = SEARCHER.doc(hit.doc)
-        doc_id = lucene_doc.get("id")
-        book = lucene_doc.get("book")
-        chapter_title = lucene_doc.get("chapter")
-        score = float(hit.score)
+    for doc_id, book, chapter_title, score in hit_meta:
+        if use_unit_index:
+            para_scores = unit_paras.get(doc_id, [])
+            sent_scores = unit_sents.get(doc_id, [])
+        else:
+            para_scores = _unit_scores(LEVEL_PARAGRAPH, doc_id, matcher)
+            sent_scores = _unit_scores(LEVEL_SENTENCE, doc_id, matcher)
 
-        raw_content = ""
-        if doc_id in DOC_BY_ID:
-            raw_content = DOC_BY_ID[doc_id].get("content", "") or ""
-
-        paragraphs = split_paragraphs(raw_content)
-        sentences = split_sentences(raw_content)
-
-        # 段落匹配
-        hit_paras = []
-        for idx, para in enumerate(paragraphs):
-            # 基于关键词的基础分：词越长权重稍高
-            match_score = 0.0
-            for term in query_terms:
-                if term and term in para:
-                    w = len(term)
-                    # snippet 模式下，核心词（如“虫子”）额外提高权重
-                    if snippet_mode and core_term and term == core_term:
-                        w *= 3
-                    match_score += w
-
-            if match_score <= 0:
-                continue
-
-            # 整句 snippet 出现，再额外加一大笔分，保证排到最前
-            if snippet_mode and phrase and phrase in para:
-                match_score += 5 * len(phrase)
-
-            text = para
-            if pattern:
-                text = pattern.sub(lambda m: f"[{m.group(0)}]", text)
-            hit_paras.append({
-                "index": idx,
-                "text": text,
-                "match_score": match_score,
-            })
-
-        hit_paras.sort(key=lambda x: x["match_score"], reverse=True)
-
-        # 句子匹配
-        hit_sents = []
-        for idx, sent in enumerate(sentences):
-            match_score = 0.0
-            for term in query_terms:
-                if term and term in sent:
-                    w = len(term)
-                    if snippet_mode and core_term and term == core_term:
-                        w *= 3
-                    match_score += w
-
-            if match_score <= 0:
-                continue
-
-            if snippet_mode and phrase and phrase in sent:
-                match_score += 5 * len(phrase)
-
-            text = sent
-            if pattern:
-                text = pattern.sub(lambda m: f"[{m.group(0)}]", text)
-            hit_sents.append({
-                "index": idx,
-                "text": text,
-                "match_score": match_score,
-            })
-
-        hit_sents.sort(key=lambda x: x["match_score"], reverse=True)
+        # 只高亮要展示的前几条；其余留给 chapter_hits 翻页
+        hit_paras = _materialize(LEVEL_PARAGRAPH, doc_id, top_units(para_scores, n_paras), matcher)
+        hit_sents = _materialize(LEVEL_SENTENCE, doc_id, top_units(sent_scores, n_sents), matcher)
 
         chapter_entry = {
             "doc_id": doc_id,
@@ -318,6 +863,11 @@ def search_multi_granularity(query: str,
             "score": score,
             "hit_sentences": hit_sents,
             "hit_paragraphs": hit_paras,
+            "sentence_total": len(sent_scores),
+            "paragraph_total": len(para_scores),
+            # 还有没展示的命中时，给出 chapter_hits 的起始游标
+            "sentence_cursor": n_sents if len(sent_scores) > n_sents else None,
+            "paragraph_cursor": n_paras if len(para_scores) > n_paras else None,
         }
         chapter_results.append(chapter_entry)
 
@@ -331,20 +881,258 @@ def search_multi_granularity(query: str,
             entry.update({"doc_id": doc_id, "book": book, "chapter": chapter_title})
             paragraph_results.append(entry)
 
-    # 全局结果按匹配分数排序
-    sentence_results.sort(key=lambda x: x.get("match_score", 0), reverse=True)
-    paragraph_results.sort(key=lambda x: x.get("match_score", 0), reverse=True)
+    # 全局结果按匹配分数取前 GLOBAL_TOP_N
+    by_score = lambda x: x.get("match_score", 0)
+    sentence_results = heapq.nlargest(GLOBAL_TOP_N, sentence_results, key=by_score)
+    paragraph_results = heapq.nlargest(GLOBAL_TOP_N, paragraph_results, key=by_score)
 
     return {
         "query": query,
+        "snippet_mode": bool(snippet_mode),
         "chapters": chapter_results,
         "sentences": sentence_results,
         "paragraphs": paragraph_results,
     }
 
-# ========= 5. 简单命令行测试 =========
+
+def _unit_plan(query: str, snippet_mode: bool):
+    """段落/句子匹配用的 (query_terms, core_term, phrase, matcher)；首屏和翻页必须一致"""
+    # snippet 模式：用关键词决定命中，用整句 phrase 和第一个关键词大幅加权
+    if snippet_mode:
+        phrase = query.strip()
+        base_terms = get_query_terms(query)
+        query_terms = base_terms if base_terms else ([phrase] if phrase else [])
+        core_term = query_terms[0] if query_terms else ""   # ★ 第一个关键词，当作“虫子”这类核心词
+
+        # 高亮时同时高亮整句和关键词
+        highlight_terms = []
+        if phrase:
+            highlight_terms.append(phrase)
+        highlight_terms.extend(base_terms)
+        highlight_terms = [t for t in highlight_terms if t]
+    else:
+        phrase = ""
+        core_term = ""
+        query_terms = get_query_terms(query)
+        highlight_terms = query_terms
+
+    # 一次查询只建一个匹配器：打分和高亮共用
+    matcher = build_query_matcher(query_terms, highlight_terms, core_term, phrase)
+    return query_terms, core_term, phrase, matcher
+
+
+def _want_unit_index(use_unit_index: Optional[bool], matcher: TermMatcher) -> bool:
+    """段落/句子是否走 Lucene（search_units）；默认出现矩阵可用时不走"""
+    has_unit_docs = _current_view().has_unit_docs
+    if use_unit_index is None:
+        return has_unit_docs and not _matrix_usable(matcher)
+    return use_unit_index and has_unit_docs
+
+
+def chapter_hits(query: str, doc_id: str, level: str = LEVEL_PARAGRAPH,
+                 snippet_mode: bool = False, cursor: int = 0, limit: int = 10,
+                 use_unit_index: bool = None) -> Dict[str, Any]:
+    """
+    某一章里命中的段落/句子，按分数从高到低分页（给前端“展开更多”用）：
+      query / snippet_mode 与首屏 search_multi_granularity 的一致，
+      cursor：首屏结果里的 paragraph_cursor / sentence_cursor，之后用上一页返回的 next_cursor
+    返回 {"items": [...], "next_cursor": int 或 None, "total": 命中总数}
+    必须在已 attach 到 JVM 的线程里调用。
+    """
+    _ensure_index()
+    doc_id = str(doc_id)
+    limit = max(1, min(int(limit), HITS_PAGE_MAX))
+    cursor = max(0, int(cursor))
+
+    query_terms, core_term, phrase, matcher = _unit_plan(query, snippet_mode)
+    with pinned_view():
+        if _want_unit_index(use_unit_index, matcher):
+            scored = search_units(level, [doc_id], query_terms, core_term, phrase).get(doc_id, [])
+        else:
+            scored = _unit_scores(level, doc_id, matcher)
+
+        end = cursor + limit
+        page = top_units(scored, end)[cursor:]
+        return {
+            "items": _materialize(level, doc_id, page, matcher),
+            "next_cursor": end if end < len(scored) else None,
+            "total": len(scored),
+        }
+
+# ========= 7. 批量检索 =========
+
+# search_many 同时在途的检索数默认为线程数的两倍：结果边出边交给调用方，不在内存里堆积
+BATCH_WINDOW_PER_THREAD = 2
+
+
+def _attach_jvm():
+    lucene.getVMEnv().attachCurrentThread()
+
+
+def search_many(queries: List[str],
+                top_k_chapters: int = 10,
+                snippet_mode: bool = False,
+                use_unit_index: bool = None,
+                executor: ThreadPoolExecutor = None,
+                threads: int = None,
+                tokenize_workers: int = 1) -> Iterator[Tuple[List[int], Dict[str, Any]]]:
+    """
+    批量多粒度检索（离线评测、分析任务用，不经过 LLM）：
+      - 归一化后相同的查询只检索一次
+      - 先把全部查询整批分词（prime_query_tokens），逐条检索时不再分词
+      - 在 executor（必须是已 attach 到 JVM 的线程池，如 app.LUCENE_POOL）里并发检索；
+        不传时临时建一个 threads 个线程的池
+    按完成顺序逐条 yield (该查询在 queries 里的全部下标, search_multi_granularity 的结果)；
+    同时在途的检索不超过线程数的 BATCH_WINDOW_PER_THREAD 倍。
+    """
+    _ensure_index()
+    groups: Dict[str, List[int]] = {}
+    first: Dict[str, str] = {}
+    for i, q in enumerate(queries):
+        q = (q or "").strip()
+        if not q:
+            continue
+        key = normalize_query(q)
+        if key not in groups:
+            groups[key] = []
+            first[key] = q
+        groups[key].append(i)
+    if not groups:
+        return
+
+    prime_query_tokens(first.values(), workers=tokenize_workers)
+
+    own_pool = executor is None
+    if own_pool:
+        threads = threads or os.cpu_count() or 4
+        executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="search-many",
+                                      initializer=_attach_jvm)
+    window = max(1, (threads or getattr(executor, "_max_workers", 4)) * BATCH_WINDOW_PER_THREAD)
+
+    run = bind_context(search_multi_granularity)
+    todo = iter(groups)
+    pending = {}
+    try:
+        while True:
+            for key in todo:
+                fut = executor.submit(run, first[key], top_k_chapters,
+                                      snippet_mode=snippet_mode, use_unit_index=use_unit_index)
+                pending[fut] = key
+                if len(pending) >= window:
+                    break
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                yield groups[pending.pop(fut)], fut.result()
+    finally:
+        for fut in pending:
+            fut.cancel()
+        if own_pool:
+            executor.shutdown(wait=True)
+
+
+# ========= 8. 启动：显式初始化 + 预热 =========
+
+# 预热时回放的查询：环境变量 SEARCH_WARMUP_QUERIES 指向一个每行一条查询的文件，
+# 没有时用下面这几条；每条回放 SEARCH_WARMUP_ROUNDS 轮（让 JVM 把 Lucene 查询路径 JIT 掉）
+DEFAULT_WARMUP_QUERIES = ["阶梯计划", "叶文洁", "黑暗森林法则", "面壁者罗辑", "二向箔", "程心是谁"]
+WARMUP_QUERIES_FILE = os.environ.get("SEARCH_WARMUP_QUERIES", "")
+WARMUP_ROUNDS = int(os.environ.get("SEARCH_WARMUP_ROUNDS", "3"))
+
+# 启动进度：stage 依次为 cold → jieba → corpus → index → warmup → ready（失败为 failed）
+STARTUP: Dict[str, Any] = {"stage": "cold", "timings": {}, "error": None}
+_READY = threading.Event()
+_INIT_LOCK = threading.Lock()
+
+
+def load_warmup_queries() -> List[str]:
+    if WARMUP_QUERIES_FILE and os.path.exists(WARMUP_QUERIES_FILE):
+        with open(WARMUP_QUERIES_FILE, "r", encoding="utf-8") as f:
+            queries = [line.strip() for line in f if line.strip()]
+        if queries:
+            return queries
+    return list(DEFAULT_WARMUP_QUERIES)
+
+
+def _run_stage(name: str, fn, *args):
+    STARTUP["stage"] = name
+    t0 = time.perf_counter()
+    result = fn(*args)
+    STARTUP["timings"][name] = round(time.perf_counter() - t0, 3)
+    return result
+
+
+def _open_index():
+    global INDEX_VIEW
+    with _INDEX_LOCK:
+        if INDEX_VIEW is None:
+            INDEX_VIEW = IndexView(init_searcher(), DOC_BY_ID, SEGMENTS.snapshot())
+
+
+def warm_up(queries: List[str] = None, rounds: int = None) -> int:
+    """
+    绕过结果缓存回放查询（章节召回 + 段落/句子检索 + snippet 模式），返回执行次数。
+    必须在已 attach 到 JVM 的线程里调用。
+    """
+    queries = load_warmup_queries() if queries is None else queries
+    rounds = WARMUP_ROUNDS if rounds is None else rounds
+    n = 0
+    for _ in range(rounds):
+        for q in queries:
+            get_query_terms(q)
+            _search_multi_granularity(q, top_k_chapters=10)
+            _search_multi_granularity(q, top_k_chapters=10, snippet_mode=True)
+            n += 2
+    return n
+
+
+def init_search(warmup: bool = True):
+    """
+    显式初始化（重复调用无副作用）：
+      jieba 词典（只加载一次）→ 语料（mmap threebody.corpus）→ JVM + 索引 → 预热
+    全部完成后 search_ready() 才返回 True。在哪个线程调用，哪个线程就会启动/attach JVM。
+    """
+    with _INIT_LOCK:
+        if _READY.is_set():
+            return
+        t0 = time.perf_counter()
+        try:
+            _run_stage("jieba", init_jieba, USER_DICT)
+            _run_stage("corpus", _reload_corpus)
+            _run_stage("index", _open_index)
+            if warmup:
+                n = _run_stage("warmup", warm_up)
+                print(f"[startup] 预热完成：{n} 次查询")
+        except Exception as e:
+            STARTUP["stage"] = "failed"
+            STARTUP["error"] = repr(e)
+            raise
+        STARTUP["timings"]["total"] = round(time.perf_counter() - t0, 3)
+        STARTUP["stage"] = "ready"
+        _READY.set()
+        print(f"[startup] 搜索就绪，用时 {STARTUP['timings']}")
+
+
+def _ensure_index():
+    """没调用过 init_search 的脚本里直接检索时，兜底做一次不预热的初始化"""
+    if INDEX_VIEW is None:
+        init_search(warmup=False)
+
+
+def search_ready() -> bool:
+    return _READY.is_set()
+
+
+def startup_status() -> Dict[str, Any]:
+    return {"ready": _READY.is_set(), "stage": STARTUP["stage"],
+            "timings": dict(STARTUP["timings"]), "error": STARTUP["error"]}
+
+
+# ========= 9. 简单命令行测试 =========
 
 if __name__ == "__main__":
+    init_search(warmup=False)
     q = "阶梯计划"
     res = search_multi_granularity(q, top_k_chapters=10)
 
@@ -0,0 +1,122 @@
+# segments.py
+# -*- coding: utf-8 -*-
+"""
+segments.py
+
+章节分段 / 分句的偏移量存储：
+
+- 每章的段落、句子边界只在加载 threebody.json 时切一次，
+  存成紧凑的整数偏移数组（array('I')），外加 句子 → 段落 的映射
+- 查询时按偏移量直接切片取文本，不再对整章反复跑正则
+- 切分规则与原来的 split_paragraphs / split_sentences 完全一致
+- 全书的偏移表写在语料文件里，由 corpus.CorpusStore 读取
+"""
+
+import re
+from array import array
+from bisect import bisect_right
+from typing import List, Tuple
+
+
+# 段落分隔：空行
+PARA_SEP_RE = re.compile(r"\n\s*\n+")
+# 句末标点：中文句号/问号/叹号，以及英文 ? !
+SENT_END_RE = re.compile(r"[。！？!?]")
+
+
+# ========= 1. 计算偏移量 =========
+
+def _strip_span(raw: str, start: int, end: int) -> Tuple[int, int]:
+    """把 [start, end) 两端的空白去掉（等价于 str.strip）"""
+    while start < end and raw[start].isspace():
+        start += 1
+    while end > start and raw[end - 1].isspace():
+        end -= 1
+    return start, end
+
+
+def paragraph_spans(raw: str) -> List[Tuple[int, int]]:
+    """按空行拆段，返回每段在 raw 中的 (start, end)"""
+    spans = []
+    pos = 0
+    for m in PARA_SEP_RE.finditer(raw):
+        s, e = _strip_span(raw, pos, m.start())
+        if s < e:
+            spans.append((s, e))
+        pos = m.end()
+    s, e = _strip_span(raw, pos, len(raw))
+    if s < e:
+        spans.append((s, e))
+    return spans
+
+
+def sentence_spans(raw: str) -> List[Tuple[int, int]]:
+    """
+    按句末标点拆句，返回每句在 raw 中的 (start, end)。
+    句子文本需再把内部连续空白压成一个空格，见 normalize_sentence。
+    """
+    spans = []
+    pos = 0
+    for m in SENT_END_RE.finditer(raw):
+        s, e = _strip_span(raw, pos, m.end())
+        if s < e:
+            spans.append((s, e))
+        pos = m.end()
+    s, e = _strip_span(raw, pos, len(raw))
+    if s < e:
+        spans.append((s, e))
+    return spans
+
+
+def normalize_sentence(text: str) -> str:
+    """句子内部的连续空白压成一个空格（与旧版 re.sub(r"\\s+", " ") 一致）"""
+    return " ".join(text.split())
+
+
+# ========= 2. 单章偏移表 =========
+
+class ChapterSegments:
+    """一章的原文 + 段落/句子偏移数组"""
+
+    __slots__ = ("text", "para_starts", "para_ends",
+                 "sent_starts", "sent_ends", "sent_para")
+
+    def __init__(self, text: str):
+        self.text = text
+
+        paras = paragraph_spans(text)
+        self.para_starts = array("I", (s for s, _ in paras))
+        self.para_ends = array("I", (e for _, e in paras))
+
+        sents = sentence_spans(text)
+        self.sent_starts = array("I", (s for s, _ in sents))
+        self.sent_ends = array("I", (e for _, e in sents))
+
+        # 句子 → 段落：句子起点落在哪一段
+        last = max(len(paras) - 1, 0)
+        self.sent_para = array("I", (
+            min(max(bisect_right(self.para_starts, s) - 1, 0), last)
+            for s, _ in sents
+        ))
+
+    @property
+    def paragraph_count(self) -> int:
+        return len(self.para_starts)
+
+    @property
+    def sentence_count(self) -> int:
+        return len(self.sent_starts)
+
+    def paragraph(self, i: int) -> str:
+        return self.text[self.para_starts[i]:self.para_ends[i]]
+
+    def sentence(self, i: int) -> str:
+        return normalize_sentence(self.text[self.sent_starts[i]:self.sent_ends[i]])
+
+    def paragraphs(self) -> List[str]:
+        t = self.text
+        return [t[s:e] for s, e in zip(self.para_starts, self.para_ends)]
+
+    def sentences(self) -> List[str]:
+        t = self.text
+        return [normalize_sentence(t[s:e]) for s, e in zip(self.sent_starts, self.sent_ends)]
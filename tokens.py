@@ -0,0 +1,218 @@
+# tokens.py
+# -*- coding: utf-8 -*-
+"""
+tokens.py
+
+jieba 分词（建索引和查询共用，保证同源）：
+
+- init_jieba：加载 jieba 主词典 + vocab.txt 自定义词典，每个进程只加载一次。
+  主词典的前缀树缓存固定写在 JIEBA_CACHE_DIR/jieba.cache（默认当前目录），
+  部署时先跑一次 python tokens.py 生成，之后每个进程启动都直接读缓存
+- tokenize：单条文本分词，去掉纯空白的词
+- tokenize_many：批量分词。先查落盘的 TokenCache，未命中的文本交给进程池，
+  每个子进程启动时加载一次词典；文本少时直接在当前进程里分
+- TokenCache：按 (词典哈希, 文本哈希) 缓存分词结果。jieba 的切分首尾相接、覆盖整段文本，
+  所以只需存每个词的长度（array('H')），取出时按长度切原文即可，非常紧凑
+"""
+
+import os
+import sqlite3
+import hashlib
+import threading
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, Optional
+
+import jieba
+
+USER_DICT = "vocab.txt"
+TOKEN_CACHE_PATH = "token_cache.sqlite3"
+JIEBA_CACHE_DIR = os.environ.get("JIEBA_CACHE_DIR", ".")
+JIEBA_CACHE_FILE = "jieba.cache"
+
+# 未命中的文本少于这个数时不开进程池（进程启动 + 加载词典比分词本身还慢）
+PARALLEL_MIN_TEXTS = 200
+
+_dict_lock = threading.Lock()
+_dict_loaded: Optional[str] = None
+
+
+# ========= 1. 词典 & 单条分词 =========
+
+def init_jieba(user_dict: str = USER_DICT):
+    """加载主词典（读预生成的缓存）和自定义词典（重复调用无副作用）"""
+    global _dict_loaded
+    with _dict_lock:
+        if _dict_loaded == user_dict:
+            return
+        jieba.dt.tmp_dir = JIEBA_CACHE_DIR
+        jieba.dt.cache_file = JIEBA_CACHE_FILE
+        jieba.initialize()
+        if os.path.exists(user_dict):
+            print(f"[jieba] 加载自定义词典: {user_dict}")
+            jieba.load_userdict(user_dict)
+        else:
+            print(f"[jieba] 未找到自定义词典 {user_dict}，仅使用默认词典")
+        _dict_loaded = user_dict
+
+
+def tokenize(text: str) -> List[str]:
+    """jieba 分词，去掉纯空白的词（和建索引时完全一致）"""
+    return [t for t in jieba.lcut(text) if t.strip()]
+
+
+# ========= 2. 紧凑编码：只存词长 =========
+
+def text_key(text: str) -> bytes:
+    return hashlib.sha1(text.encode("utf-8")).digest()
+
+
+def encode_cut(text: str, raw_tokens: List[str]) -> Optional[bytes]:
+    """
+    raw_tokens 是 jieba.lcut 的原始输出（含空白词）。
+    切分首尾相接时返回各词长度（uint16）的字节串，否则返回 None（不缓存）
+    """
+    if "".join(raw_tokens) != text:
+        return None
+    lengths = [len(t) for t in raw_tokens]
+    if lengths and max(lengths) > 0xFFFF:
+        return None
+    return array("H", lengths).tobytes()
+
+
+def decode_cut(text: str, blob: bytes) -> List[str]:
+    """按词长把原文切回词列表，去掉纯空白的词"""
+    lengths = array("H")
+    lengths.frombytes(blob)
+    tokens = []
+    pos = 0
+    for n in lengths:
+        t = text[pos:pos + n]
+        pos += n
+        if t.strip():
+            tokens.append(t)
+    return tokens
+
+
+def _cut_encoded(text: str) -> Optional[bytes]:
+    """进程池里执行：只把词长传回父进程"""
+    return encode_cut(text, jieba.lcut(text))
+
+
+# ========= 3. 落盘缓存 =========
+
+class TokenCache:
+    """
+    SQLite 表 tokens(dict_hash, text_hash, lengths)：
+      - dict_hash：分词词典的哈希（见 manifest.dict_hash），词典变了旧条目自然失效
+      - text_hash：文本 sha1
+      - lengths：encode_cut 的结果
+    """
+
+    def __init__(self, path: str = TOKEN_CACHE_PATH):
+        self.path = path
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS tokens ("
+                " dict_hash TEXT NOT NULL,"
+                " text_hash BLOB NOT NULL,"
+                " lengths BLOB NOT NULL,"
+                " PRIMARY KEY (dict_hash, text_hash)) WITHOUT ROWID"
+            )
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get_many(self, dict_hash: str, keys: Iterable[bytes]) -> Dict[bytes, bytes]:
+        conn = self._conn()
+        keys = list(keys)
+        found = {}
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            marks = ",".join("?" * len(chunk))
+            rows = conn.execute(
+                f"SELECT text_hash, lengths FROM tokens WHERE dict_hash = ? AND text_hash IN ({marks})",
+                [dict_hash, *chunk],
+            )
+            found.update((bytes(k), bytes(v)) for k, v in rows)
+        return found
+
+    def put_many(self, dict_hash: str, items: Dict[bytes, bytes]):
+        conn = self._conn()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO tokens (dict_hash, text_hash, lengths) VALUES (?, ?, ?)",
+                [(dict_hash, k, v) for k, v in items.items()],
+            )
+
+    def purge_stale(self, dict_hash: str) -> int:
+        """删掉旧词典下的分词结果"""
+        conn = self._conn()
+        with conn:
+            cur = conn.execute("DELETE FROM tokens WHERE dict_hash != ?", (dict_hash,))
+        return cur.rowcount
+
+
+# ========= 4. 批量分词 =========
+
+def tokenize_many(texts: List[str], user_dict: str = USER_DICT,
+                  cache: Optional[TokenCache] = None, dict_hash: str = "",
+                  workers: Optional[int] = None) -> List[List[str]]:
+    """
+    批量分词，结果与逐条调用 tokenize 相同。
+      - cache + dict_hash：先查落盘缓存，新分出来的结果写回
+      - workers：进程数，默认 CPU 核数；1 表示不开进程池
+    """
+    keys = [text_key(t) for t in texts]
+    encoded: Dict[bytes, Optional[bytes]] = {}
+    if cache is not None and dict_hash:
+        encoded.update(cache.get_many(dict_hash, set(keys)))
+
+    # 同一文本只分一次
+    todo: Dict[bytes, str] = {}
+    for k, t in zip(keys, texts):
+        if k not in encoded:
+            todo[k] = t
+
+    if todo:
+        workers = workers or os.cpu_count() or 1
+        todo_keys = list(todo)
+        todo_texts = [todo[k] for k in todo_keys]
+        if workers > 1 and len(todo_texts) >= PARALLEL_MIN_TEXTS:
+            chunksize = max(1, len(todo_texts) // (workers * 8))
+            with ProcessPoolExecutor(max_workers=workers, initializer=init_jieba,
+                                     initargs=(user_dict,)) as pool:
+                results = list(pool.map(_cut_encoded, todo_texts, chunksize=chunksize))
+        else:
+            init_jieba(user_dict)
+            results = [_cut_encoded(t) for t in todo_texts]
+        fresh = {}
+        for k, blob in zip(todo_keys, results):
+            encoded[k] = blob
+            if blob is not None:
+                fresh[k] = blob
+        if cache is not None and dict_hash and fresh:
+            cache.put_many(dict_hash, fresh)
+
+    out = []
+    for k, t in zip(keys, texts):
+        blob = encoded.get(k)
+        if blob is None:
+            init_jieba(user_dict)
+            out.append(tokenize(t))
+        else:
+            out.append(decode_cut(t, blob))
+    return out
+
+
+if __name__ == "__main__":
+    # 预先生成 jieba 主词典缓存（部署 / 构建镜像时执行一次）
+    init_jieba()
+    print("jieba 词典缓存:", os.path.join(JIEBA_CACHE_DIR, JIEBA_CACHE_FILE))
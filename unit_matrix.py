@@ -0,0 +1,283 @@
+# unit_matrix.py
+# -*- coding: utf-8 -*-
+"""
+unit_matrix.py
+
+段落 / 句子 × 词表 的稀疏出现矩阵，文件 threebody.units（由 threebody.corpus 和分词词典生成）。
+build_index 生成，search 启动时只打开；段落/句子默认用它打分，代替 Lucene 段落/句子查询和逐条扫描原文：
+
+- 词表：vocab.txt 的词 + 全语料 jieba 分词得到的词（2 ~ MAX_TERM_CHARS 个字）
+- 出现：词作为子串出现在该段落/句子里记 1，和 matcher.TermMatcher 的子串匹配一致
+- 行号直接用语料文件里段落 / 句子的全局序号，一章的段落、句子各是连续的一段行
+- 按列存（CSC）：每个词一列升序的行号，mmap 后直接当数组用
+- 打分只取查询词那几列：二分截出本章的行区间，按权重累加（有 numpy 时整段向量化），
+  分数 = 命中的查询词权重之和，与 TermMatcher.score 的基础分相同
+- 有查询词不在词表里时返回 None，调用方退回索引检索或 TermMatcher 扫描
+"""
+
+import os
+import sys
+import json
+import mmap
+import struct
+from array import array
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from corpus import CorpusStore, CORPUS_PATH, read_source_hash, _u32_bytes, _pad8
+from manifest import dict_hash
+from tokens import tokenize_many, TokenCache, USER_DICT
+
+HAS_NUMPY = False
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    np = None
+
+UNITS_PATH = "threebody.units"
+
+MAGIC = b"TBUNITS\0"
+FORMAT_VERSION = 1
+
+# magic, version, meta_off, meta_len, 段落 indptr / indices、句子 indptr / indices 的偏移
+HEADER = struct.Struct("<8sIQQQQQQ")
+
+# 词表里最长的词（字）；更长的查询词不在词表里，走扫描
+MAX_TERM_CHARS = 12
+LEVELS = ("paragraph", "sentence")
+
+
+# ========= 1. 生成矩阵文件 =========
+
+def load_vocab(user_dict: str = USER_DICT) -> List[str]:
+    """自定义词典每行第一列"""
+    words = []
+    try:
+        with open(user_dict, "r", encoding="utf-8") as f:
+            for line in f:
+                parts = line.split()
+                if parts:
+                    words.append(parts[0])
+    except OSError:
+        pass
+    return words
+
+
+def corpus_vocab(store: CorpusStore, user_dict: str = USER_DICT,
+                 cache: Optional[TokenCache] = None, digest: str = "",
+                 workers: Optional[int] = None) -> List[str]:
+    """vocab.txt + 全语料分词得到的词，只保留 2 ~ MAX_TERM_CHARS 个字的"""
+    texts = [store.text(r["id"]) for r in store.records()]
+    terms = set(load_vocab(user_dict))
+    for tokens in tokenize_many(texts, user_dict=user_dict, cache=cache, dict_hash=digest,
+                                workers=workers):
+        terms.update(t.strip() for t in tokens)
+    return sorted(t for t in terms if 2 <= len(t) <= MAX_TERM_CHARS)
+
+
+def _occurrences(units: Iterable[str], vocab: Dict[str, int],
+                 lengths: List[int]) -> Dict[int, array]:
+    """词下标 → 出现的行号（升序）；每个位置按词表里出现过的长度取子串查表"""
+    postings: Dict[int, array] = {}
+    for row, text in enumerate(units):
+        seen = set()
+        n = len(text)
+        for i in range(n - 1):
+            for k in lengths:
+                if i + k > n:
+                    break
+                col = vocab.get(text[i:i + k])
+                if col is not None:
+                    seen.add(col)
+        for col in seen:
+            p = postings.get(col)
+            if p is None:
+                p = postings[col] = array("I")
+            p.append(row)
+    return postings
+
+
+def build_unit_matrix(store: CorpusStore, terms: List[str], path: str = UNITS_PATH,
+                      digest: str = ""):
+    """从已打开的语料和词表生成矩阵文件（先写临时文件再 rename）"""
+    vocab = {t: i for i, t in enumerate(terms)}
+    lengths = sorted({len(t) for t in terms})
+    records = store.records()
+
+    tables = []
+    levels = {}
+    for level in LEVELS:
+        fetch = store.paragraphs if level == "paragraph" else store.sentences
+        postings = _occurrences((u for r in records for u in fetch(r["id"])), vocab, lengths)
+        indptr = array("I", [0])
+        indices = array("I")
+        for col in range(len(terms)):
+            indices.extend(postings.get(col, ()))
+            indptr.append(len(indices))
+        n_rows = sum(store.unit_range(r["id"], level)[1] for r in records)
+        levels[level] = {"rows": n_rows, "nnz": len(indices)}
+        tables.extend((_u32_bytes(indptr), _u32_bytes(indices)))
+
+    meta = json.dumps({"source_hash": store.source_hash, "dict_hash": digest,
+                       "max_term_chars": MAX_TERM_CHARS, "terms": terms, "levels": levels},
+                      ensure_ascii=False).encode("utf-8")
+
+    meta_off = HEADER.size
+    offsets = []
+    off = _pad8(meta_off + len(meta))
+    for data in tables:
+        offsets.append(off)
+        off = _pad8(off + len(data))
+
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, meta_off, len(meta), *offsets))
+        for off, data in zip([meta_off] + offsets, [meta] + tables):
+            f.write(b"\0" * (off - f.tell()))
+            f.write(data)
+    os.replace(tmp, path)
+
+
+def _read_meta(path: str) -> Optional[dict]:
+    try:
+        with open(path, "rb") as f:
+            head = f.read(HEADER.size)
+            if len(head) < HEADER.size:
+                return None
+            magic, version, meta_off, meta_len = HEADER.unpack(head)[:4]
+            if magic != MAGIC or version != FORMAT_VERSION:
+                return None
+            f.seek(meta_off)
+            return json.loads(f.read(meta_len).decode("utf-8"))
+    except (OSError, ValueError):
+        return None
+
+
+def ensure_unit_matrix(corpus_path: str = CORPUS_PATH, path: str = UNITS_PATH,
+                       store: Optional[CorpusStore] = None, user_dict: str = USER_DICT,
+                       cache: Optional[TokenCache] = None, workers: Optional[int] = None) -> bool:
+    """
+    矩阵文件不存在、或语料 / 分词词典变了，就重新生成；返回是否重新生成了。
+    cache：分词缓存（建索引时已经分过的章节直接命中）；workers：分词进程数，见 tokens.tokenize_many
+    """
+    source_hash = read_source_hash(corpus_path)
+    digest = dict_hash(user_dict)
+    meta = _read_meta(path)
+    if meta is not None and meta.get("source_hash") == source_hash \
+            and meta.get("dict_hash") == digest and meta.get("max_term_chars") == MAX_TERM_CHARS:
+        return False
+    if store is None or store.source_hash != source_hash:
+        store = CorpusStore(corpus_path)
+    terms = corpus_vocab(store, user_dict, cache=cache, digest=digest, workers=workers)
+    build_unit_matrix(store, terms, path, digest)
+    print(f"[units] 已生成 {path}（{len(terms)} 个词）")
+    return True
+
+
+# ========= 2. 打分 =========
+
+class _MappedMatrix:
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, meta_off, meta_len, *offsets = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise RuntimeError(f"矩阵文件格式不对: {path}")
+        meta = json.loads(self.mm[meta_off:meta_off + meta_len].decode("utf-8"))
+        self.source_hash = meta.get("source_hash", "")
+        self.vocab = {t: i for i, t in enumerate(meta["terms"])}
+        n_terms = len(meta["terms"])
+        self.indptr = {}
+        self.indices = {}
+        for k, level in enumerate(LEVELS):
+            self.indptr[level] = self._table(offsets[2 * k], n_terms + 1)
+            self.indices[level] = self._table(offsets[2 * k + 1], meta["levels"][level]["nnz"])
+
+    def _table(self, off: int, n: int):
+        if HAS_NUMPY:
+            return np.frombuffer(self.mm, dtype="<u4", count=n, offset=off)
+        if sys.byteorder == "little":
+            return memoryview(self.mm)[off:off + 4 * n].cast("I")
+        values = array("I", self.mm[off:off + 4 * n])
+        values.byteswap()
+        return values
+
+
+class UnitMatrix:
+    """
+    score(level, first, count, weights) → [(本章内序号, 分数), ...]（只含分数 > 0 的）；
+    open() 换新文件时只替换内部映射，与 CorpusStore 一致。
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self._m: Optional[_MappedMatrix] = None
+        if path:
+            self.open(path)
+
+    def open(self, path: str = UNITS_PATH):
+        self._m = _MappedMatrix(path)
+
+    def __bool__(self) -> bool:
+        return self._m is not None
+
+    @property
+    def source_hash(self) -> str:
+        return self._m.source_hash if self._m else ""
+
+    def columns(self, terms: Iterable[str]) -> Optional[List[int]]:
+        """查询词对应的列；有词不在词表里返回 None"""
+        m = self._m
+        if m is None:
+            return None
+        cols = []
+        for t in terms:
+            col = m.vocab.get(t)
+            if col is None:
+                return None
+            cols.append(col)
+        return cols
+
+    def score(self, level: str, first: int, count: int,
+              weights: Dict[str, float]) -> Optional[List[Tuple[int, float]]]:
+        """
+        本章（全局行号 [first, first + count)）每个段落/句子的基础分：
+        命中的查询词权重之和。weights 里有词不在词表里时返回 None。
+        """
+        terms = [t for t, w in weights.items() if w]
+        cols = self.columns(terms)
+        if cols is None or count <= 0:
+            return None if cols is None else []
+        m = self._m
+        indptr, indices = m.indptr[level], m.indices[level]
+        end = first + count
+
+        if HAS_NUMPY:
+            scores = np.zeros(count)
+            for t, col in zip(terms, cols):
+                column = indices[indptr[col]:indptr[col + 1]]
+                lo, hi = np.searchsorted(column, (first, end))
+                scores[column[lo:hi] - first] += weights[t]
+            hit = np.flatnonzero(scores)
+            return list(zip(hit.tolist(), scores[hit].tolist()))
+
+        acc: Dict[int, float] = {}
+        for t, col in zip(terms, cols):
+            a, b = indptr[col], indptr[col + 1]
+            lo = bisect_left(indices, first, a, b)
+            hi = bisect_left(indices, end, lo, b)
+            w = weights[t]
+            for j in range(lo, hi):
+                row = indices[j] - first
+                acc[row] = acc.get(row, 0.0) + w
+        return sorted(acc.items())
+
+
+if __name__ == "__main__":
+    store = CorpusStore(CORPUS_PATH)
+    ensure_unit_matrix(CORPUS_PATH, UNITS_PATH, store, cache=TokenCache())
+    matrix = UnitMatrix(UNITS_PATH)
+    doc_id = store.records()[0]["id"]
+    terms = sys.argv[1:] or ["叶文洁"]
+    first, count = store.unit_range(doc_id, "sentence")
+    print(doc_id, matrix.score("sentence", first, count, {t: len(t) for t in terms}))
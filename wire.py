@@ -0,0 +1,103 @@
+# wire.py
+# -*- coding: utf-8 -*-
+"""
+wire.py
+
+HTTP 响应的编码：JSON 序列化 + 按 Accept-Encoding 压缩
+
+- 有 orjson 时用 orjson 序列化（直接得到 UTF-8 字节，比标准库 json 快一个数量级）；
+  没有时退回到 json.dumps(ensure_ascii=False)，输出一致
+- 压缩：客户端接受 br 且装了 brotli 时用 brotli，否则 gzip；
+  小于 COMPRESS_MIN_BYTES 的响应不压缩（压缩头的开销比省下的多）
+
+环境变量：
+  COMPRESS_MIN_BYTES   小于这个字节数不压缩，默认 1024
+  GZIP_LEVEL           gzip 压缩级别，默认 6
+  BROTLI_QUALITY       brotli 压缩质量，默认 5（在线压缩，比默认 11 快得多）
+"""
+
+import os
+import gzip
+import json
+from typing import Any, List, Optional
+
+HAS_ORJSON = False
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    orjson = None
+
+HAS_BROTLI = False
+try:
+    import brotli
+    HAS_BROTLI = True
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", "1024"))
+GZIP_LEVEL = int(os.environ.get("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.environ.get("BROTLI_QUALITY", "5"))
+
+# 值得压缩的响应类型
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/html",
+                      "text/plain", "text/css", "application/javascript")
+
+
+# ========= 1. 序列化 =========
+
+def dumps(obj: Any) -> bytes:
+    """序列化为 UTF-8 JSON 字节"""
+    if HAS_ORJSON:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def loads(data) -> Any:
+    if HAS_ORJSON:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+# ========= 2. 压缩 =========
+
+def _accepted(accept_encoding: str) -> List[str]:
+    """Accept-Encoding 里 q > 0 的编码（小写）"""
+    out = []
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if q > 0:
+            out.append(name)
+    return out
+
+
+def negotiate(accept_encoding: str) -> Optional[str]:
+    """选出本次响应用的编码："br" / "gzip" / None"""
+    accepted = _accepted(accept_encoding)
+    if HAS_BROTLI and ("br" in accepted or "*" in accepted):
+        return "br"
+    if "gzip" in accepted or "*" in accepted:
+        return "gzip"
+    return None
+
+
+def compressible(mimetype: str, size: int) -> bool:
+    return size >= COMPRESS_MIN_BYTES and (mimetype or "") in COMPRESSIBLE_TYPES
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=GZIP_LEVEL)
+    return body